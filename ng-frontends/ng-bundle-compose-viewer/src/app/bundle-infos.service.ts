@@ -112,7 +112,7 @@ export class BundleInfosService {
         (data: string[][]) => {
           this.bundleDeps.clear();
           for (const edge of data) {
-            if (edge.length === 2) {
+            if (edge.length >= 2) {
               const from = edge[0].replace("bundle/", "bundle:");
               const to = edge[1].replace("bundle/", "bundle:");
               const deps = this.bundleDeps.get(from) || [];
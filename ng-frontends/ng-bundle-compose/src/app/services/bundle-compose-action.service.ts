@@ -24,7 +24,9 @@ import {
   WorkflowMetadata,
   BackendLogEntry,
   SessionInfo,
-  AuthRef
+  AuthRef,
+  JobInfo,
+  JobProgress
 } from "shared";
 import {
   HttpClient,
@@ -95,42 +97,75 @@ export class BundleComposeActionService {
   }
 
   updateGitAndBundles(refs: AuthRef[], updateRefs: AuthRef[]): void {
-    const sp = this.messages.addSpinner("Git Pull / Rebase");
-    const params = new HttpParams().set("refs", JSON.stringify(refs));
-    this.http
-      .get<BackendLogEntry[]>(this.config.getApiUrl("gitPullRebase"), {
-        params: params
-      })
-      .subscribe(
-        (data: BackendLogEntry[]) => {
-          this.messages.unsetSpinner(sp);
-          this.messages.setMessages(data);
-          this.successfullAction.next(data);
-          this.updateBundles(updateRefs);
-        },
-        (errResp: HttpErrorResponse) => {
-          this.messages.unsetSpinner(sp);
-          this.messages.setErrorResponse("Git Pull / Rebase failed", errResp);
-        }
-      );
+    this.runJob("gitPullRebase", "Git Pull / Rebase", refs, () =>
+      this.updateBundles(updateRefs)
+    );
   }
 
   updateBundles(refs: AuthRef[]): void {
-    const sp = this.messages.addSpinner("Updating Bundles");
+    this.runJob("updateBundles", "Updating Bundles", refs);
+  }
+
+  /*
+   * Starts the job `name` in the backend and shows its log records and
+   * progress while it is running. `onSuccess` is called if the job is done
+   * without failure.
+   */
+  private runJob(
+    name: string,
+    title: string,
+    refs: AuthRef[],
+    onSuccess: () => void = null
+  ): void {
+    const sp = this.messages.addSpinner(title);
     const params = new HttpParams().set("refs", JSON.stringify(refs));
     this.http
-      .get<BackendLogEntry[]>(this.config.getApiUrl("updateBundles"), {
+      .post<JobInfo>(this.config.getApiUrl("jobs/" + name), null, {
         params: params
       })
       .subscribe(
-        (data: BackendLogEntry[]) => {
-          this.messages.unsetSpinner(sp);
-          this.messages.setMessages(data);
-          this.successfullAction.next(data);
+        (job: JobInfo) => {
+          const logs: BackendLogEntry[] = [];
+          const events = new EventSource(
+            this.config.getApiUrl("jobs/" + job.id + "/events")
+          );
+          events.addEventListener("log", (e: MessageEvent) => {
+            logs.push(JSON.parse(e.data) as BackendLogEntry);
+            this.messages.setMessages(logs.slice());
+          });
+          events.addEventListener("progress", (e: MessageEvent) => {
+            const progress = JSON.parse(e.data) as JobProgress;
+            this.messages.updateSpinner(
+              sp,
+              `${title} (${progress.done}/${progress.total})`
+            );
+          });
+          events.addEventListener("done", (e: MessageEvent) => {
+            events.close();
+            this.messages.unsetSpinner(sp);
+            const info = JSON.parse(e.data) as JobInfo;
+            if (info.state === "done") {
+              this.messages.setMessages(info.result);
+              this.successfullAction.next(info.result);
+              if (onSuccess) {
+                onSuccess();
+              }
+            } else {
+              this.messages.setMessages(logs);
+            }
+          });
+          events.onerror = () => {
+            if (events.readyState === EventSource.CLOSED) {
+              this.messages.unsetSpinner(sp);
+              this.messages.setError(
+                `${title} failed: lost connection to job ${job.id}`
+              );
+            }
+          };
         },
         (errResp: HttpErrorResponse) => {
           this.messages.unsetSpinner(sp);
-          this.messages.setErrorResponse("Update Bundles failed", errResp);
+          this.messages.setErrorResponse(`${title} failed`, errResp);
         }
       );
   }
@@ -202,22 +237,6 @@ export class BundleComposeActionService {
   }
 
   publishChanges(refs: AuthRef[]): void {
-    const sp = this.messages.addSpinner("Publishing Changes");
-    const params = new HttpParams().set("refs", JSON.stringify(refs));
-    this.http
-      .get<BackendLogEntry[]>(this.config.getApiUrl("publishChanges"), {
-        params: params
-      })
-      .subscribe(
-        (data: BackendLogEntry[]) => {
-          this.messages.unsetSpinner(sp);
-          this.messages.setMessages(data);
-          this.successfullAction.next(data);
-        },
-        (errResp: HttpErrorResponse) => {
-          this.messages.unsetSpinner(sp);
-          this.messages.setErrorResponse("Publish Changes failed", errResp);
-        }
-      );
+    this.runJob("publishChanges", "Publishing Changes", refs);
   }
 }
@@ -69,6 +69,22 @@ export interface BackendLogEntry {
   message: string;
 }
 
+export interface JobProgress {
+  done: number;
+  total: number;
+}
+
+export interface JobInfo {
+  id: string;
+  name: string;
+  state: string; // running, done or failed
+  progress: JobProgress;
+  result: any;
+  startedTime: number;
+  finishedTime: number;
+  logs?: BackendLogEntry[];
+}
+
 export interface VersionedChange {
   id: string;
   author: string;
@@ -50,6 +50,13 @@ export class MessagesService {
     return handle;
   }
 
+  updateSpinner(handle: number, message: string) {
+    if (this.spinners.has(handle)) {
+      this.spinners.set(handle, message);
+      this.emitSpinners();
+    }
+  }
+
   unsetSpinner(handle: number) {
     this.spinners.delete(handle);
     this.emitSpinners();
@@ -44,6 +44,7 @@ CANCEL_REMARK = "# Note: clean this file completely to CANCEL this current '{act
 import reprepro_bundle
 from reprepro_bundle import PROJECT_DIR, BundleError
 from .update_rule import UpdateRule
+from .suite_resolver import getSuiteResolver
 from .bundle import Bundle
 
 APT_REPOS_CMD = "apt-repos/bin/apt-repos"
@@ -564,9 +565,10 @@ def create_reprepro_config(bundle, readOnly=False):
             packages = suiteDict.get(package.suiteName, set())
             suiteDict[package.suiteName] = packages
             packages.add(package)
+    resolver = getSuiteResolver(bundle.getAptReposBasedir())
     for suite, packages in suiteDict.items():
         logger.info("Adding Update-Rules for suite {} with {} entries".format(suite, len(packages)))
-        updateRules.append(UpdateRule(suite, sorted(packages)))
+        updateRules.append(UpdateRule(suite, sorted(packages), resolver))
     return bundle.createConfigFiles(updateRules, readOnly=readOnly)
 
 
@@ -74,6 +74,7 @@ def registerRoutes(args, app):
         web.get('/api/bundleList', handle_get_bundleList),
         web.get('/api/getBundleMetadata', handle_get_metadata),
         web.get('/api/setBundleMetadata', handle_set_metadata),
+        common_app_server.metrics_route(),
     ])
     if not args.no_static_files:
         app.router.add_routes([
@@ -0,0 +1,240 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+import os
+import time
+import fnmatch
+import logging
+import threading
+import collections
+import apt_repos
+
+logger = logging.getLogger(__name__)
+
+APT_REPOS_CONFIG_SUFFIXES = ( ".suites", ".repos" )
+APT_REPOS_CACHE_DIR = ".apt-repos_cache"
+# the apt-repos configuration is checked for changes at most once per interval
+APT_REPOS_CONFIG_CHECK_INTERVAL_S = 10
+MAX_SUITE_RESOLVERS = 100
+
+# apt_repos.setAptReposBaseDir() changes the global state of the apt_repos module,
+# so all lookups need to be serialized by this lock.
+__aptReposLock = threading.RLock()
+__resolvers = collections.OrderedDict() # of realpath of the apt-repos base dir to SuiteResolver (least recently used first)
+
+
+def getAptReposLock():
+    '''
+        Returns the lock that needs to be held while the global state of the apt_repos
+        module is used (e.g. for calls to apt_repos.setAptReposBaseDir()).
+    '''
+    global __aptReposLock
+    return __aptReposLock
+
+
+def getSuiteResolver(baseDir):
+    '''
+        Returns the (shared) SuiteResolver for the apt-repos base directory `baseDir`.
+        At most MAX_SUITE_RESOLVERS resolvers are kept, the least recently used
+        resolver is dropped first.
+    '''
+    global __resolvers
+    path = os.path.realpath(baseDir)
+    with getAptReposLock():
+        resolver = __resolvers.get(path)
+        if resolver:
+            __resolvers.move_to_end(path)
+        else:
+            resolver = SuiteResolver(path)
+            __resolvers[path] = resolver
+            while len(__resolvers) > MAX_SUITE_RESOLVERS:
+                __resolvers.popitem(last=False)
+        return resolver
+
+
+def splitSelector(selector):
+    '''
+        Splits the suite selector `selector` into the tuple (key, pattern). The key is
+        the part before the first ':' (a repository prefix or a tag) or None if the
+        selector doesn't contain a ':'. An empty key or pattern matches everything.
+    '''
+    if not ":" in selector:
+        return (None, selector)
+    (key, pattern) = selector.split(":", 1)
+    return (key or None, pattern)
+
+
+class SuiteIndex:
+    '''
+        An in-memory index of the apt_repos.RepoSuite objects of one apt-repos
+        configuration by suite name and by key (repository prefix and tags).
+
+        The index is filled with the results of apt_repos.getSuites(). For each key
+        (and for all suites) it remembers if it was filled with the complete result
+        of the selector "key:" (or ":"), in which case all selectors of this key can
+        be answered from the index.
+    '''
+
+    def __init__(self):
+        self.__suites = dict() # of suite name to RepoSuite
+        self.__keys = dict() # of key to set of suite names
+        self.__complete = set() # of keys (None for all suites) that are complete
+        self.__selectors = dict() # of selector to sorted list of suite names
+
+    def add(self, selector, suites):
+        '''
+            Adds the suites `suites` resolved by apt_repos for the selector `selector`.
+        '''
+        for suite in suites:
+            name = suite.getSuiteName()
+            self.__suites[name] = suite
+            for key in set([ name.split(":", 1)[0] ]).union(suite.getTags()):
+                self.__keys.setdefault(key, set()).add(name)
+        (key, pattern) = splitSelector(selector)
+        if pattern == "":
+            self.__complete.add(key)
+        if len(suites) > 0 or pattern == "":
+            self.__selectors[selector] = sorted(s.getSuiteName() for s in suites)
+
+    def lookup(self, selector):
+        '''
+            Returns the list of suites matching `selector` or None if the selector
+            can't be answered from the index.
+        '''
+        names = self.__selectors.get(selector)
+        if names == None:
+            (key, pattern) = splitSelector(selector)
+            if not key in self.__complete and not None in self.__complete:
+                return None
+            candidates = self.__keys.get(key, set()) if key else self.__suites.keys()
+            names = sorted(n for n in candidates if pattern == "" or fnmatch.fnmatchcase(n.split(":", 1)[1], pattern))
+            if len(names) == 0:
+                # the suite could have been added after the index was filled (e.g. a new bundle)
+                return None
+            self.__selectors[selector] = names
+        return [ self.__suites[name] for name in names ]
+
+
+class SuiteResolver:
+    '''
+        This class answers suite selectors for one apt-repos base directory from a
+        SuiteIndex. The index is dropped as soon as one of the configuration files in
+        the base directory is changed, added or removed. The configuration files are
+        checked at most once per APT_REPOS_CONFIG_CHECK_INTERVAL_S seconds (or after
+        invalidate() was called).
+
+        Selectors that can't be answered from the index are resolved by
+        apt_repos.getSuites() and their result is added to the index. So the
+        configuration is parsed only once per selector key (e.g. "bundle:" or a tag
+        like "bundle-compose-target:") and all other selectors for this key are
+        answered from the index.
+    '''
+
+    def __init__(self, baseDir):
+        self.__baseDir = baseDir
+        self.__fingerprint = None # of the configuration the index was built for
+        self.__currentFingerprint = None
+        self.__checked = 0
+        self.__index = SuiteIndex()
+        self.__unresolved = dict() # of selector to the time it resolved no suites
+
+    def getBaseDir(self):
+        return self.__baseDir
+
+    def getSuites(self, selectors):
+        '''
+            Returns a sorted list of the apt_repos.RepoSuite objects matching the list of
+            suite `selectors` (e.g. ["bundle:"]).
+        '''
+        res = dict()
+        fingerprint = self.getFingerprint()
+        with getAptReposLock():
+            if fingerprint != self.__fingerprint:
+                if self.__fingerprint != None:
+                    logger.debug("apt-repos configuration in {} changed".format(self.__baseDir))
+                self.__index = SuiteIndex()
+                self.__unresolved.clear()
+                self.__fingerprint = fingerprint
+            for selector in selectors:
+                for suite in self.__resolve(selector):
+                    res[suite.getSuiteName()] = suite
+        return sorted(res.values())
+
+    def __resolve(self, selector):
+        suites = self.__index.lookup(selector)
+        if suites != None:
+            return suites
+        if time.time() - self.__unresolved.get(selector, 0) < APT_REPOS_CONFIG_CHECK_INTERVAL_S:
+            return []
+        apt_repos.setAptReposBaseDir(self.__baseDir)
+        suites = sorted(apt_repos.getSuites([selector]))
+        logger.debug("Resolved {} suites for '{}'".format(len(suites), selector))
+        self.__index.add(selector, suites)
+        if len(suites) == 0:
+            self.__unresolved[selector] = time.time()
+        return suites
+
+    def getFingerprint(self):
+        '''
+            Returns a tuple describing the names, symlink targets, sizes and mtimes of
+            the apt-repos configuration files (*.suites and *.repos) in the apt-repos
+            base directory. It changes whenever the configuration changes, but not if
+            suites are scanned (which only changes the files in APT_REPOS_CACHE_DIR).
+            The fingerprint is only recomputed if it is older than
+            APT_REPOS_CONFIG_CHECK_INTERVAL_S seconds.
+        '''
+        with getAptReposLock():
+            if self.__currentFingerprint != None and time.time() - self.__checked < APT_REPOS_CONFIG_CHECK_INTERVAL_S:
+                return self.__currentFingerprint
+        fingerprint = self.__computeFingerprint()
+        with getAptReposLock():
+            self.__currentFingerprint = fingerprint
+            self.__checked = time.time()
+        return fingerprint
+
+    def __computeFingerprint(self):
+        res = list()
+        for root, dirs, files in os.walk(self.__baseDir):
+            dirs[:] = sorted(d for d in dirs if d != APT_REPOS_CACHE_DIR)
+            for name in sorted(files):
+                if not name.endswith(APT_REPOS_CONFIG_SUFFIXES):
+                    continue
+                filename = os.path.join(root, name)
+                target = os.path.realpath(filename) if os.path.islink(filename) else None
+                try:
+                    st = os.stat(filename)
+                    res.append((os.path.relpath(filename, self.__baseDir), target, st.st_mtime_ns, st.st_size))
+                except OSError:
+                    res.append((os.path.relpath(filename, self.__baseDir), target, None, None))
+        return tuple(res)
+
+    def invalidate(self):
+        '''
+            Forces the apt-repos configuration to be checked for changes on the next
+            lookup (e.g. after the project was updated by git).
+        '''
+        with getAptReposLock():
+            self.__checked = 0
+
+    def clearCache(self):
+        with getAptReposLock():
+            self.__index = SuiteIndex()
+            self.__unresolved.clear()
+            self.__fingerprint = None
+            self.__currentFingerprint = None
@@ -31,10 +31,14 @@ class UpdateRule:
         It consists of a suiteName - the name of an apt-repos suite - that is the
         suite the update rule is build for and a list of Package-Objects defining
         the packagages form that suite (that should be listed in a corresponding
-        FilterSrcList in the end).
+        FilterSrcList in the end). If a SuiteResolver `resolver` is provided, the suite
+        is resolved using it's cache.
     '''
-    def __init__(self, suiteName, packages):
-        suites = sorted(apt_repos.getSuites([suiteName]))
+    def __init__(self, suiteName, packages, resolver=None):
+        if resolver:
+            suites = resolver.getSuites([suiteName])
+        else:
+            suites = sorted(apt_repos.getSuites([suiteName]))
         if len(suites) != 1:
             raise BundleError("Can't create UpdateRule for suite selector '{}' since it doesn't select exactly one suite.".format(suiteName))
         self.suite = suites[0]
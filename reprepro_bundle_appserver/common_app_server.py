@@ -25,14 +25,14 @@
 '''
 
 import time
+import heapq
+import hashlib
 import aiohttp
 import logging
-from logging import handlers
 import argparse
 import sys
 import os
 import io
-import queue
 import subprocess
 import uuid
 import json
@@ -43,7 +43,7 @@ from Crypto.Cipher import AES
 from aiohttp import web
 from aiohttp.web import run_app
 import asyncio
-from reprepro_bundle_appserver import common_interfaces, IllegalArgumentException
+from reprepro_bundle_appserver import common_interfaces, common_jobs, common_logging, session_store, IllegalArgumentException
 from reprepro_bundle_compose import PROJECT_DIR
 
 PROGNAME = "common_app_server"
@@ -54,10 +54,20 @@ DEFAULT_PORT = 4253
 RE_REGISTER_DELAY_SECONDS = 2
 
 events = set()
-__sessions = dict() # of session-id to dict (with session data)
+sessionStore = session_store.MemorySessionStore() # replaced in mainLoop according to --session-store
 SESSION_TIMEOUT_S = 60*60*24 # increased session timeout to 1d
+SESSION_RESCAN_INTERVAL_S = 60*10
 registeredClients = set()
-__storedPwds = dict() # storageId -> encryptedPwd
+cacheableRoutes = dict() # of route path to function(request) returning a key describing the response (or None)
+MIN_COMPRESS_SIZE = 1024
+__expiryHeap = list() # heap of (expiry timestamp, session-id)
+__scheduledSids = set() # session-ids contained in __expiryHeap
+__expiryTimer = None # asyncio.TimerHandle for the next entry in __expiryHeap
+metrics = {
+    'slowCallbacks': 0,             # number of callbacks that blocked the event loop too long
+    'slowCallbacksMaxSeconds': 0.0, # longest time a callback blocked the event loop
+    'lastSlowCallback': None        # description of the last slow callback
+}
 
 
 def setupLogging(loglevel):
@@ -75,7 +85,7 @@ def setupLogging(loglevel):
     logging.getLogger("apt_repos").setLevel(logging.ERROR if loglevel != logging.DEBUG else logging.INFO)
 
 
-def mainLoop(progname=PROGNAME, description=__doc__, registerRoutes=None, serveDistPath=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+def mainLoop(progname=PROGNAME, description=__doc__, registerRoutes=None, serveDistPath=None, host=DEFAULT_HOST, port=DEFAULT_PORT, addArguments=None):
     parser = argparse.ArgumentParser(description=description, prog=progname)
     parser.add_argument("-d", "--debug", action="store_true", default=False, help="Show debug messages.")
     parser.add_argument("--no-open-url", action="store_true", help="""
@@ -86,11 +96,32 @@ def mainLoop(progname=PROGNAME, description=__doc__, registerRoutes=None, serveD
             Hostname for the backend to listen on. Default is '{}'.""".format(host))
     parser.add_argument("--port", default=port, help="""
             Port for the backend to listen on. Default is '{}'.""".format(port))
+    parser.add_argument("--slow-callback-ms", type=int, default=None, help="""
+            Log and count (see /api/metrics) all callbacks that block the event loop
+            for more than the given number of milliseconds. This enables asyncio's debug
+            mode, which makes the backend noticeably slower (e.g. it records a traceback
+            for each scheduled callback), so it should only be used for diagnosis.""")
+    parser.add_argument("--session-store", default="memory", help="""
+            Where to store the sessions and the (encrypted) stored credentials. Either
+            'memory' (default) or 'sqlite:<path to database file>'. With a sqlite store
+            sessions survive restarts and can be shared by several backend processes.""")
+    parser.add_argument("--reuse-port", action="store_true", help="""
+            Allow several backend processes to listen on the same port (SO_REUSEPORT).
+            Should be combined with a shared --session-store. Background jobs and
+            caches are kept per process, so requests for a job (/api/jobs/...) need
+            to be routed to the process that started it (sticky sessions).""")
+    if addArguments:
+        addArguments(parser)
     args = parser.parse_args()
 
     setupLogging(logging.DEBUG if args.debug else logging.INFO)
 
+    global sessionStore
+    sessionStore = session_store.createSessionStore(args.session_store)
+
     loop = asyncio.get_event_loop()
+    if args.slow_callback_ms:
+        setupSlowCallbackMonitoring(loop, args.slow_callback_ms)
     (backendStarted, runner, url) = loop.run_until_complete(run_webserver(args, registerRoutes, serveDistPath))
     if not args.no_open_url:
         loop.run_until_complete(start_browser(url))
@@ -99,6 +130,46 @@ def mainLoop(progname=PROGNAME, description=__doc__, registerRoutes=None, serveD
         loop.run_until_complete(runner.cleanup())
 
 
+class SlowCallbackHandler(logging.Handler):
+    '''
+        Counts the slow callbacks reported by asyncio's debug mode into `metrics`.
+    '''
+    def emit(self, record):
+        if not str(record.msg).startswith("Executing ") or not record.args or len(record.args) != 2:
+            return
+        (callback, duration) = record.args
+        metrics['slowCallbacks'] += 1
+        metrics['slowCallbacksMaxSeconds'] = max(metrics['slowCallbacksMaxSeconds'], duration)
+        metrics['lastSlowCallback'] = "{} took {:.3f} seconds".format(callback, duration)
+
+
+def setupSlowCallbackMonitoring(loop, slowCallbackMs):
+    '''
+        Enables asyncio's debug mode for `loop` so that callbacks blocking the loop
+        for more than `slowCallbackMs` milliseconds are logged and counted.
+    '''
+    loop.set_debug(True)
+    loop.slow_callback_duration = slowCallbackMs / 1000.0
+    logging.getLogger("asyncio").addHandler(SlowCallbackHandler())
+    logger.info("monitoring callbacks blocking the event loop for more than {} ms".format(slowCallbackMs))
+
+
+def metrics_route(validateRequest=None):
+    '''
+        Returns the route for `/api/metrics`. The optional function `validateRequest(request)`
+        needs to raise an Exception if the request is not allowed to read the metrics. It
+        should protect the metrics the same way as the other routes of the app.
+    '''
+    async def handle_metrics(request):
+        if validateRequest:
+            try:
+                validateRequest(request)
+            except Exception as e:
+                return web.Response(text="Access denied: {}".format(e), status=401)
+        return web.json_response(metrics)
+    return web.get('/api/metrics', handle_metrics)
+
+
 def create_session(expireSessionCallback=None):
     '''
         This method creates and returns a new session object as a (generic) dict
@@ -110,63 +181,146 @@ def create_session(expireSessionCallback=None):
             be called for at destruction time with the session object as first
             argument. It could contain app specific code for cleaning up the session.
     '''
-    global __sessions
     session = dict()
     sid = None
-    while not sid or sid in __sessions:
+    while not sid or sessionStore.getSession(sid):
         sid = str(uuid.uuid4())
     session['id'] = sid
     session['touchedTime'] = datetime.datetime.now()
     if expireSessionCallback:
         session['expireSessionCallback'] = expireSessionCallback
-    __sessions[sid] = session
+    sessionStore.putSession(session)
+    __schedule_expiry(session)
     return session
 
 
+def save_session(session):
+    '''
+        This method needs to be called after attributes of the session were changed,
+        so that they are also stored in a persistent session store.
+    '''
+    sessionStore.putSession(session)
+
+
 def get_session(sid):
     '''
-        This method first calls __gc_expired_session() and then returns the session for session
-        id `sid` or None, if there is no such valid session.
-        It also updates the 'touchedTime' attribute of the session to the datetime.datetime.now().
+        This method returns the session for session id `sid` or None, if there is no
+        such valid session. It also updates the 'touchedTime' attribute of the session
+        to the datetime.datetime.now().
     '''
-    __gc_expired_session()
-    global __sessions
-    session = __sessions.get(sid)
+    session = sessionStore.getSession(sid)
     if session:
         session['touchedTime'] = datetime.datetime.now()
+        sessionStore.touchSession(session)
     return session
 
 
-def __gc_expired_session():
+def __get_expiry_time(session):
+    return session['touchedTime'].timestamp() + SESSION_TIMEOUT_S
+
+
+def __schedule_expiry(session):
     '''
-        This method garbage-collects timed-out sessions and expires them.
+        Adds the session to the expiry heap (if it is not already contained) and
+        (re)starts the timer for the next expiry.
     '''
-    global __sessions
-    keys = list(__sessions.keys())
-    for sid in keys:
-        session = __sessions.get(sid)
-        if session and (datetime.datetime.now() - session['touchedTime']).seconds > SESSION_TIMEOUT_S:
-            expire_session(session)
+    sid = session['id']
+    if sid in __scheduledSids:
+        return
+    heapq.heappush(__expiryHeap, (__get_expiry_time(session), sid))
+    __scheduledSids.add(sid)
+    __restart_expiry_timer()
+
+
+def __restart_expiry_timer():
+    global __expiryTimer
+    if __expiryTimer:
+        __expiryTimer.cancel()
+        __expiryTimer = None
+    if len(__expiryHeap) == 0:
+        return
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        return # not called from the event loop's thread: the next timer run will pick it up
+    delay = max(0, __expiryHeap[0][0] - time.time())
+    __expiryTimer = loop.call_later(delay, __expire_due_sessions)
 
 
-def expire_session(session):
+def __expire_due_sessions():
+    '''
+        Expires all sessions from the expiry heap that are due. Sessions touched
+        since they were scheduled are scheduled again with their new expiry time.
+    '''
+    global __expiryTimer
+    __expiryTimer = None
+    now = time.time()
+    while len(__expiryHeap) > 0 and __expiryHeap[0][0] <= now:
+        (unused_expiry, sid) = heapq.heappop(__expiryHeap)
+        __scheduledSids.discard(sid)
+        try:
+            session = sessionStore.getSession(sid)
+            if not session:
+                continue
+            expiry = __get_expiry_time(session)
+            if expiry <= now:
+                logger.debug("expiring session {}".format(sid))
+                expire_session(session)
+            else:
+                heapq.heappush(__expiryHeap, (expiry, sid))
+                __scheduledSids.add(sid)
+        except Exception as e:
+            logger.error("Expiring session {} failed: {}".format(sid, e))
+    __restart_expiry_timer()
+
+
+def schedule_session_rescan():
+    '''
+        Adds all sessions of the session store to the expiry heap, also those
+        created by other processes sharing a persistent session store. This runs
+        every SESSION_RESCAN_INTERVAL_S seconds if the session store is persistent.
+    '''
+    try:
+        for session in sessionStore.getSessions():
+            __schedule_expiry(session)
+    except Exception as e:
+        logger.error("Scanning sessions failed: {}".format(e))
+    if sessionStore.isPersistent():
+        asyncio.get_event_loop().call_later(SESSION_RESCAN_INTERVAL_S, schedule_session_rescan)
+
+
+def expire_session(session, inBackground=True):
+    '''
+        Removes the session from the session store. The session's expireSessionCallback
+        is then executed in the default executor of the event loop (or directly if
+        `inBackground` is False) as it may take a while (e.g. removing a directory).
+    '''
     sid = session['id']
+    if not sessionStore.deleteSession(sid):
+        # already expired (e.g. by another backend process sharing the session store)
+        return
     expireSessionCallback = session.get('expireSessionCallback')
-    if expireSessionCallback:
+    if not expireSessionCallback:
+        return
+    if not inBackground:
         expireSessionCallback(session)
-    del __sessions[sid]
+        return
+    future = asyncio.get_event_loop().run_in_executor(None, expireSessionCallback, session)
+    def logResult(f):
+        if f.exception():
+            logger.error("Cleaning up session {} failed: {}".format(sid, f.exception()))
+    future.add_done_callback(logResult)
 
 
 def __expire_all_session():
-    keys = list(__sessions.keys())
-    for sid in keys:
-        session = __sessions.get(sid)
-        if session:
-            expire_session(session)
+    if sessionStore.isPersistent():
+        logger.info("keeping sessions in the persistent session store")
+        return
+    for session in sessionStore.getSessions():
+        expire_session(session, inBackground=False)
 
 
 async def handle_store_credentials(request):
-    global __storedPwds
     res = list()
     try:
         refs = common_interfaces.AuthRefList_validate(json.loads(request.rel_url.query['refs']))
@@ -174,7 +328,7 @@ async def handle_store_credentials(request):
         for x, authRef in enumerate(refs):
             slotId = str(uuid.uuid4())
             authRef['storageSlotId'] = slotId
-            __storedPwds[slotId] = pwds[x]
+            sessionStore.putCredential(slotId, pwds[x])
             res.append(authRef)
             logger.info("stored encrypted password for authId '{}'".format(authRef.get('authId')))
         return web.json_response(res)
@@ -221,8 +375,78 @@ async def start_browser(url):
     subprocess.call(["xdg-open", url])
 
 
+def register_cacheable_route(path, etagKeyProvider=None):
+    '''
+        Marks the GET route `path` as read-only, so that it's responses get ETags and
+        requests with a matching If-None-Match header are answered with 304. The
+        optional function (or coroutine function) `etagKeyProvider(request)` returns a
+        string that changes whenever the response would change (e.g. the HEAD commit
+        of the session's working directory) or None if it can't tell. This key
+        (together with the request's query string) is used as ETag, so the route's
+        handler isn't called at all for matching requests. Without a key, the ETag is
+        computed from the response body.
+    '''
+    cacheableRoutes[path] = etagKeyProvider
+
+
+def etag_matches(request, etag):
+    '''
+        Returns True if the If-None-Match header of `request` matches `etag`, also
+        if the client got the gzip compressed variant of the response.
+    '''
+    for tag in request.headers.get('If-None-Match', "").split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.replace("-gzip\"", "\"") == etag:
+            return True
+    return False
+
+
+@web.middleware
+async def etag_and_compression_middleware(request, handler):
+    '''
+        Compresses large responses of GET requests to /api/ routes with gzip if the
+        client accepts it. For routes registered with register_cacheable_route(),
+        ETags are added and requests with a matching If-None-Match header are
+        answered with 304. Responses setting cookies are never answered with 304.
+    '''
+    if request.method != "GET" or not request.path.startswith("/api/"):
+        return await handler(request)
+    cacheable = request.path in cacheableRoutes
+    etag = None
+    provider = cacheableRoutes.get(request.path)
+    if provider:
+        key = None
+        try:
+            key = provider(request)
+            if asyncio.iscoroutine(key):
+                key = await key
+        except Exception as e:
+            logger.debug("No ETag for {}: {}".format(request.path, e))
+        if key != None:
+            etag = '"{}"'.format(hashlib.sha1("{}?{}#{}".format(request.path, request.query_string, key).encode("utf-8")).hexdigest())
+            if etag_matches(request, etag):
+                return web.Response(status=304, headers={ 'ETag': etag })
+    response = await handler(request)
+    if type(response) != web.Response or response.status != 200 or not isinstance(response.body, bytes):
+        return response
+    etag = response.headers.get('ETag', etag) # keep ETags set by the handler
+    if cacheable and not etag:
+        etag = '"{}"'.format(hashlib.sha1(response.body).hexdigest())
+        if etag_matches(request, etag) and len(response.cookies) == 0:
+            return web.Response(status=304, headers={ 'ETag': etag })
+    if len(response.body) >= MIN_COMPRESS_SIZE and "gzip" in request.headers.get('Accept-Encoding', ""):
+        response.enable_compression(web.ContentCoding.gzip)
+        if etag:
+            etag = etag[:-1] + "-gzip\""
+    if etag:
+        response.headers['ETag'] = etag
+        response.headers.setdefault('Cache-Control', "no-cache")
+    response.headers['Vary'] = "Accept-Encoding"
+    return response
+
+
 async def run_webserver(args, registerAdditionalRoutes=None, serveDistPath=None):
-    app = web.Application()
+    app = web.Application(middlewares=[etag_and_compression_middleware])
 
     app.router.add_routes([
         # api routes
@@ -230,19 +454,23 @@ async def run_webserver(args, registerAdditionalRoutes=None, serveDistPath=None)
         web.get('/api/register', handle_register),
         web.get('/api/storeCredentials', handle_store_credentials)
     ])
+    common_jobs.registerJobRoutes(app)
     if registerAdditionalRoutes:
         registerAdditionalRoutes(args, app)
     if serveDistPath and not args.no_static_files:
         app.router.add_static('/', serveDistPath)
 
+    if args.reuse_port:
+        logger.warning("Background jobs are only known to the process that started them - make sure requests are routed to the same process")
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, args.host, args.port)
+    site = web.TCPSite(runner, args.host, args.port, reuse_port=args.reuse_port or None)
     url = "http://{}:{}/".format(args.host, args.port)
     started = False
     try:
         await site.start()
         started = True
+        schedule_session_rescan()
         logger.info("starting backend at url '{}'".format(url))
     except OSError as e:
         logger.info("could not start backend: {}".format(e))
@@ -250,17 +478,14 @@ async def run_webserver(args, registerAdditionalRoutes=None, serveDistPath=None)
 
 
 def is_valid_authRef(authRef):
-    global __storedPwds
-    return authRef['storageSlotId'] in __storedPwds
+    return sessionStore.getCredential(authRef['storageSlotId']) != None
 
 
 def invalidate_credentials(storageSlotId):
-    global __storedPwds
-    __storedPwds.pop(storageSlotId, None)
+    sessionStore.deleteCredential(storageSlotId)
 
 
 def get_credentials(request, authId):
-    global __storedPwds
     authRefs = common_interfaces.AuthRefList_validate(json.loads(request.rel_url.query['refs']))
     ref = None
     for _, r in enumerate(authRefs):
@@ -270,7 +495,9 @@ def get_credentials(request, authId):
     if not ref:
         raise IllegalArgumentException("No AuthRef for authId='{}' found.".format(authId))
     slotId = ref['storageSlotId']
-    aesCipherParamsStr = __storedPwds[slotId]
+    aesCipherParamsStr = sessionStore.getCredential(slotId)
+    if aesCipherParamsStr == None:
+        raise KeyError(slotId)
     username = ref['user']
     try:
         pwd = decrypt(aesCipherParamsStr, ref['key'])
@@ -293,27 +520,9 @@ def decrypt(aesCipherParamsStr, key):
     return res.decode("utf-8")
 
 
-class WebappLoggingHandler(logging.handlers.QueueHandler):
-    def toBackendLogEntryList(self):
-        res = list()
-        while not self.queue.empty():
-          res.append(common_interfaces.BackendLogEntry(self.queue.get()))
-        return res
-
-
-import contextlib
-@contextlib.contextmanager
 def logging_redirect_for_webapp():
-    que = queue.Queue(-1)
-    hndlr = WebappLoggingHandler(que)
-    logger.addHandler(hndlr)
-    logging.getLogger('reprepro_bundle').addHandler(hndlr)
-    logging.getLogger('reprepro_bundle_compose').addHandler(hndlr)
-    logging.getLogger('reprepro_bundle_appserver').addHandler(hndlr)
-    logging.getLogger('apt_repos').addHandler(hndlr)
-    yield hndlr
-    logging.getLogger('apt_repos').removeHandler(hndlr)
-    logging.getLogger('reprepro_bundle_appserver').removeHandler(hndlr)
-    logging.getLogger('reprepro_bundle_compose').removeHandler(hndlr)
-    logging.getLogger('reprepro_bundle').removeHandler(hndlr)
-    logger.removeHandler(hndlr)
+    '''
+        Collects the log records of the current operation for the webapp.
+        See common_logging.collect_logs().
+    '''
+    return common_logging.collect_logs()
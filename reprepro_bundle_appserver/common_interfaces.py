@@ -147,6 +147,16 @@ def Package(packageName, version, packageSuite, architecture, section, source):
         'sourcePackageName': source
     }
 
+def BundlePackage(bundleId, packageName, version, architecture, source, status):
+    return {
+        'bundle': bundleId,
+        'name': packageName,
+        'version': version,
+        'architecture': architecture,
+        'sourcePackageName': source,
+        'status': str(status) if status else None
+    }
+
 def WorkflowMetadata(status):
     return {
         'ord': status.value.get('ord'),
@@ -167,12 +177,57 @@ def BackendLogEntry(record):
         'message': record.message
     }
 
+def JobInfo(job, withLogs=True):
+    res = {
+        'id': job.id,
+        'name': job.name,
+        'state': job.state, # running, done or failed
+        'progress': job.progress,
+        'result': job.result,
+        'startedTime': job.startedTime,
+        'finishedTime': job.finishedTime
+    }
+    if withLogs:
+        res['logs'] = list(job.logs)
+    return res
+
+def CommandRunInfo(run):
+    return {
+        'id': run.id,
+        'cmd': run.cmd,
+        'users': run.users,
+        'state': run.state, # queued, running or done
+        'returncode': run.returncode,
+        'queuedTime': run.queuedTime,
+        'startedTime': run.startedTime,
+        'finishedTime': run.finishedTime
+    }
+
+def CommandResult(run):
+    return {
+        'returncode': run.returncode # None if the command timed out or could not be started
+    }
+
+def ExecutionRecord(run):
+    res = CommandRunInfo(run)
+    res['output'] = list(run.logs)
+    return res
+
+def JobProgress(done, total):
+    return {
+        'done': done,
+        'total': total
+    }
+
 def VersionedChange(commit, published):
+    return VersionedChangeData(commit.hexsha, commit.author.name, commit.message, commit.authored_date, published)
+
+def VersionedChangeData(hexsha, author, message, date, published):
     return {
-        'id': commit.hexsha,
-        'author': commit.author.name,
-        'message': commit.message,
-        'date': commit.authored_date,
+        'id': hexsha,
+        'author': author,
+        'message': message,
+        'date': date,
         'published': published
     }
 
@@ -0,0 +1,262 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module contains shared code for long running operations (jobs) of the
+   app_servers. A job is started by start_job() which immediately returns a
+   job id. The job's function runs in an executor while its log records and
+   progress counters are streamed to the frontend via Server-Sent Events
+   (`/api/jobs/{jobId}/events`). The state and the result of a job can be
+   requested via `/api/jobs/{jobId}` until JOB_RETENTION_S seconds after the
+   job finished.
+
+   Jobs are only known to the backend process that started them. If several
+   backend processes share a port (--reuse-port), requests for a job need to be
+   routed to the same process (e.g. by a load balancer with sticky sessions).
+'''
+
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import uuid
+from aiohttp import web
+from reprepro_bundle_appserver import common_interfaces, common_logging
+
+logger = logging.getLogger(__name__)
+
+JOB_RETENTION_S = 60*60
+EVENT_PUMP_THREADS = 2 # number of threads shared by all jobs to read the job's event queues
+EVENT_POLL_INTERVAL_S = 0.5
+
+__jobs = dict() # of job-id to Job
+__manager = None # multiprocessing.Manager providing queues that work across processes
+__pumpExecutor = None # ThreadPoolExecutor used to poll the job's event queues
+__currentJobQueue = contextvars.ContextVar('currentJobQueue', default=None) # queue of the job running in this context
+
+
+class Job:
+    '''
+        This class describes the state of a job as seen by the main process.
+    '''
+
+    def __init__(self, name, owner=None):
+        self.id = "{}-{}".format(os.getpid(), uuid.uuid4())
+        self.name = name
+        self.owner = owner
+        self.state = "running"
+        self.progress = None
+        self.logs = collections.deque(maxlen=common_logging.DEFAULT_MAX_ENTRIES)
+        self.result = None
+        self.startedTime = time.time()
+        self.finishedTime = None
+        self.listeners = set()
+
+    def addEvent(self, event, data):
+        if event == "log":
+            self.logs.append(data)
+        elif event == "progress":
+            self.progress = data
+        for listener in self.listeners:
+            listener.put_nowait((event, data))
+
+    def finish(self, state, result):
+        self.state = state
+        self.result = result
+        self.finishedTime = time.time()
+        self.addEvent("done", common_interfaces.JobInfo(self, withLogs=False))
+
+    def isFinished(self):
+        return self.finishedTime != None
+
+
+def run_job_function(que, func, *args):
+    '''
+        This function is executed in the executor and calls `func` with `args` while
+        log records and progress counters are forwarded to the queue `que`. As the queue
+        is bound to the current context, multiple jobs can run in the threads of the same
+        process.
+    '''
+    token = __currentJobQueue.set(que)
+    try:
+        with common_logging.collect_logs(forward=lambda entry: que.put(("log", entry))):
+            return func(*args)
+    finally:
+        __currentJobQueue.reset(token)
+
+
+def reportProgress(done, total):
+    '''
+        Reports the progress of the job running in the current context. This
+        function does nothing if it is not called from within a job.
+    '''
+    que = __currentJobQueue.get()
+    if que:
+        que.put(("progress", common_interfaces.JobProgress(done, total)))
+
+
+def __getManager():
+    global __manager
+    if not __manager:
+        __manager = multiprocessing.Manager()
+    return __manager
+
+
+def start_job(executor, name, func, *args, owner=None, onDone=None):
+    '''
+        Starts a job with name `name` that runs `func(*args)` in the `executor` and
+        returns the Job object. If `onDone` is provided, it is called in the main
+        process with the return value of `func` (or None if `func` failed) and the
+        value it returns is stored as the result of the job.
+    '''
+    global __jobs
+    __gc_finished_jobs()
+    job = Job(name, owner)
+    __jobs[job.id] = job
+    que = __getManager().Queue()
+    asyncio.ensure_future(__run_job(job, executor, func, args, que, onDone))
+    logger.debug("started job {} '{}'".format(job.id, name))
+    return job
+
+
+async def __run_job(job, executor, func, args, que, onDone):
+    pump = asyncio.ensure_future(__pump_events(job, que))
+    state, result = "done", None
+    try:
+        result = await asyncio.wrap_future(executor.submit(run_job_function, que, func, *args))
+    except Exception as e:
+        state = "failed"
+        msg = "Job failed: {}".format(e)
+        que.put(("log", common_interfaces.BackendLogEntry(logging.makeLogRecord({
+            'name': __name__, 'levelno': logging.ERROR, 'levelname': "ERROR", 'msg': msg, 'message': msg}))))
+    finally:
+        que.put(None)
+        await pump
+    if onDone:
+        try:
+            result = onDone(result)
+        except Exception as e:
+            logger.error("Finishing job {} failed: {}".format(job.id, e))
+            state = "failed"
+    job.finish(state, result)
+    logger.debug("finished job {} '{}' with state '{}'".format(job.id, job.name, state))
+
+
+async def __pump_events(job, que):
+    '''
+        Forwards the events from the job's queue `que` to `job` until the end marker
+        None is received. The queue is polled in a small thread pool shared by all
+        jobs, so the number of threads doesn't grow with the number of running jobs.
+    '''
+    global __pumpExecutor
+    if not __pumpExecutor:
+        __pumpExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=EVENT_PUMP_THREADS)
+    loop = asyncio.get_event_loop()
+    while True:
+        for item in await loop.run_in_executor(__pumpExecutor, __poll_events, que):
+            if item == None:
+                return
+            (event, data) = item
+            job.addEvent(event, data)
+
+
+def __poll_events(que):
+    '''
+        Returns the list of events available in `que` after waiting at most
+        EVENT_POLL_INTERVAL_S seconds for the first one.
+    '''
+    res = list()
+    try:
+        res.append(que.get(timeout=EVENT_POLL_INTERVAL_S))
+        while res[-1] != None:
+            res.append(que.get_nowait())
+    except queue.Empty:
+        pass
+    return res
+
+
+def __gc_finished_jobs():
+    global __jobs
+    now = time.time()
+    for jobId, job in list(__jobs.items()):
+        if job.isFinished() and now - job.finishedTime > JOB_RETENTION_S:
+            del __jobs[jobId]
+
+
+def get_job(request):
+    '''
+        Returns the job referenced by the request's path parameter `jobId` or raises
+        a KeyError if there is no such job or it belongs to another session.
+    '''
+    __gc_finished_jobs()
+    jobId = request.match_info['jobId']
+    if not jobId in __jobs and not jobId.startswith("{}-".format(os.getpid())):
+        raise KeyError("{} (started by another backend process)".format(jobId))
+    job = __jobs[jobId]
+    if job.owner and job.owner != request.cookies.get('sessionId'):
+        raise KeyError(job.id)
+    return job
+
+
+async def handle_get_job(request):
+    try:
+        job = get_job(request)
+    except KeyError as e:
+        return web.Response(text="Unknown Job: {}".format(e), status=404)
+    return web.json_response(common_interfaces.JobInfo(job))
+
+
+async def handle_job_events(request):
+    try:
+        job = get_job(request)
+    except KeyError as e:
+        return web.Response(text="Unknown Job: {}".format(e), status=404)
+    response = web.StreamResponse(headers={ 'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache' })
+    await response.prepare(request)
+    listener = asyncio.Queue()
+    for entry in list(job.logs):
+        listener.put_nowait(("log", entry))
+    if job.progress:
+        listener.put_nowait(("progress", job.progress))
+    if job.isFinished():
+        listener.put_nowait(("done", common_interfaces.JobInfo(job, withLogs=False)))
+    else:
+        job.listeners.add(listener)
+    try:
+        while True:
+            (event, data) = await listener.get()
+            await response.write("event: {}\ndata: {}\n\n".format(event, json.dumps(data)).encode("utf-8"))
+            if event == "done":
+                break
+    finally:
+        job.listeners.discard(listener)
+    return response
+
+
+def registerJobRoutes(app):
+    app.router.add_routes([
+        web.get('/api/jobs/{jobId}', handle_get_job),
+        web.get('/api/jobs/{jobId}/events', handle_job_events),
+    ])
@@ -0,0 +1,135 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module collects the log records of an operation (a request or a job) so
+   that they can be sent to the frontend. The collector of the current operation
+   is stored in a context variable, so log records are routed to the operation
+   that emitted them even if several operations run concurrently in the same
+   process (in different threads or asyncio tasks). Functions that an operation
+   submits to a thread pool need to be run in a copy of the operation's context
+   (`executor.submit(contextvars.copy_context().run, func, *args)`), as new threads
+   start with an empty context.
+'''
+
+import collections
+import contextlib
+import contextvars
+import logging
+import threading
+from reprepro_bundle_appserver import common_interfaces
+
+logger = logging.getLogger(__name__)
+
+COLLECTED_LOGGERS = [ 'reprepro_bundle', 'reprepro_bundle_compose', 'reprepro_bundle_appserver', 'apt_repos' ]
+DEFAULT_MAX_ENTRIES = 10000
+
+__currentCollector = contextvars.ContextVar('currentLogCollector', default=None)
+__handlerLock = threading.Lock()
+__handler = None
+
+
+class LogCollector:
+    '''
+        Collects the log entries of one operation in a bounded queue. If more than
+        `maxEntries` entries are collected, the oldest entries are dropped. If `forward`
+        is provided, each entry is additionally passed to `forward` (e.g. to stream
+        it to the frontend while the operation is running). If `parent` is provided
+        (the collector of an enclosing operation), each entry is also added to the
+        parent, so that nested operations don't hide their logs from e.g. a job.
+    '''
+
+    def __init__(self, maxEntries=DEFAULT_MAX_ENTRIES, forward=None, parent=None):
+        self.__entries = collections.deque(maxlen=maxEntries)
+        self.__dropped = 0
+        self.__lock = threading.Lock()
+        self.forward = forward
+        self.parent = parent
+
+    def add(self, entry):
+        with self.__lock:
+            if len(self.__entries) == self.__entries.maxlen:
+                self.__dropped += 1
+            self.__entries.append(entry)
+        if self.forward:
+            self.forward(entry)
+        if self.parent:
+            self.parent.add(entry)
+
+    def toBackendLogEntryList(self):
+        '''
+            Returns the collected entries and clears the collector.
+        '''
+        with self.__lock:
+            res = list(self.__entries)
+            self.__entries.clear()
+            dropped, self.__dropped = self.__dropped, 0
+        if dropped > 0:
+            msg = "{} older log entries were dropped".format(dropped)
+            res.insert(0, common_interfaces.BackendLogEntry(logging.makeLogRecord({
+                'name': __name__, 'levelname': "WARNING", 'msg': msg, 'message': msg})))
+        return res
+
+
+class ContextLoggingHandler(logging.Handler):
+    '''
+        Passes log records to the LogCollector of the current context (if any).
+    '''
+    def emit(self, record):
+        collector = getCurrentCollector()
+        if not collector:
+            return
+        try:
+            record.message = record.getMessage()
+            collector.add(common_interfaces.BackendLogEntry(record))
+        except Exception:
+            self.handleError(record)
+
+
+def installContextLoggingHandler():
+    '''
+        Adds the ContextLoggingHandler to the COLLECTED_LOGGERS once per process.
+    '''
+    global __handler
+    with __handlerLock:
+        if __handler:
+            return
+        __handler = ContextLoggingHandler()
+        for name in COLLECTED_LOGGERS:
+            logging.getLogger(name).addHandler(__handler)
+
+
+def getCurrentCollector():
+    return __currentCollector.get()
+
+
+@contextlib.contextmanager
+def collect_logs(maxEntries=DEFAULT_MAX_ENTRIES, forward=None):
+    '''
+        Collects all log records emitted in the current context (thread or asyncio
+        task) until the with-block is left and yields the LogCollector. The records
+        are also passed to the collector of an enclosing collect_logs() block.
+    '''
+    installContextLoggingHandler()
+    collector = LogCollector(maxEntries, forward, parent=__currentCollector.get())
+    token = __currentCollector.set(collector)
+    try:
+        yield collector
+    finally:
+        __currentCollector.reset(token)
@@ -0,0 +1,213 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module contains the stores for the sessions and the (encrypted) stored
+   credentials of the app_servers. The MemorySessionStore keeps everything in the
+   current process. The SqliteSessionStore keeps the data in a sqlite database, so
+   that several app_server processes can serve the same users and sessions survive
+   restarts of the app_server.
+'''
+
+import datetime
+import importlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# keys of the session dict that are only held in the current process
+TRANSIENT_SESSION_KEYS = [ 'expireSessionCallback', 'stateCache', 'storedTouchedTime' ]
+# touching a persisted session is only written if it is older than this
+TOUCH_WRITE_INTERVAL_S = 60
+
+
+def createSessionStore(spec):
+    '''
+        Creates the session store described by `spec`, which is either "memory" or
+        "sqlite:<path to database file>".
+    '''
+    if spec == "memory":
+        return MemorySessionStore()
+    if spec.startswith("sqlite:") and len(spec) > len("sqlite:"):
+        return SqliteSessionStore(spec[len("sqlite:"):])
+    raise ValueError("Unsupported session store '{}'".format(spec))
+
+
+def getCallbackName(callback):
+    return "{}:{}".format(callback.__module__, callback.__qualname__)
+
+
+def resolveCallback(name):
+    (moduleName, qualname) = name.split(":", 1)
+    res = importlib.import_module(moduleName)
+    for part in qualname.split("."):
+        res = getattr(res, part)
+    return res
+
+
+class MemorySessionStore:
+    '''
+        Keeps sessions and credentials in dicts of the current process.
+    '''
+
+    def __init__(self):
+        self.__sessions = dict() # of session-id to dict (with session data)
+        self.__credentials = dict() # of storageId -> encryptedPwd
+
+    def isPersistent(self):
+        return False
+
+    def getSession(self, sid):
+        return self.__sessions.get(sid)
+
+    def putSession(self, session):
+        self.__sessions[session['id']] = session
+
+    def touchSession(self, session):
+        '''This store holds the session object itself, so nothing is to do here'''
+
+    def deleteSession(self, sid):
+        '''Returns True if the session existed and was deleted by this call'''
+        return self.__sessions.pop(sid, None) != None
+
+    def getSessions(self):
+        return list(self.__sessions.values())
+
+    def putCredential(self, slotId, data):
+        self.__credentials[slotId] = data
+
+    def getCredential(self, slotId):
+        return self.__credentials.get(slotId)
+
+    def deleteCredential(self, slotId):
+        self.__credentials.pop(slotId, None)
+
+
+class SqliteSessionStore:
+    '''
+        Keeps sessions and credentials in the sqlite database `filename`. The session
+        dicts are cached in the current process so that transient session data (see
+        TRANSIENT_SESSION_KEYS) is kept between requests. The expireSessionCallback
+        of a session is stored by name, so that any process is able to expire it.
+    '''
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__local = threading.local()
+        self.__cache = dict() # of session-id to the session dict of this process
+        db = self.__db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, touched REAL, data TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS credentials (id TEXT PRIMARY KEY, data TEXT)")
+        os.chmod(filename, 0o600)
+        logger.info("using session store {}".format(filename))
+
+    def __db(self):
+        db = getattr(self.__local, 'db', None)
+        if not db:
+            db = sqlite3.connect(self.__filename, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            self.__local.db = db
+        return db
+
+    def isPersistent(self):
+        return True
+
+    def __toSession(self, sid, touched, data):
+        session = self.__cache.get(sid)
+        if not session:
+            session = dict()
+            self.__cache[sid] = session
+        for key, value in json.loads(data).items():
+            if key == 'expireSessionCallback':
+                try:
+                    value = resolveCallback(value)
+                except Exception as e:
+                    logger.warning("Could not resolve expireSessionCallback '{}': {}".format(value, e))
+                    continue
+            session[key] = value
+        session['id'] = sid
+        session['touchedTime'] = datetime.datetime.fromtimestamp(touched)
+        session['storedTouchedTime'] = session['touchedTime']
+        return session
+
+    def getSession(self, sid):
+        row = self.__db().execute("SELECT touched, data FROM sessions WHERE id = ?", (sid,)).fetchone()
+        if not row:
+            self.__cache.pop(sid, None)
+            return None
+        return self.__toSession(sid, row[0], row[1])
+
+    def putSession(self, session):
+        data = dict()
+        for key, value in session.items():
+            if key in ['id', 'touchedTime'] or key in TRANSIENT_SESSION_KEYS:
+                continue
+            data[key] = value
+        callback = session.get('expireSessionCallback')
+        if callback:
+            data['expireSessionCallback'] = getCallbackName(callback)
+        db = self.__db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO sessions (id, touched, data) VALUES (?, ?, ?)",
+                       (session['id'], session['touchedTime'].timestamp(), json.dumps(data)))
+        self.__cache[session['id']] = session
+        session['storedTouchedTime'] = session['touchedTime']
+
+    def touchSession(self, session):
+        stored = session.get('storedTouchedTime')
+        if stored and (session['touchedTime'] - stored).total_seconds() < TOUCH_WRITE_INTERVAL_S:
+            return
+        db = self.__db()
+        with db:
+            db.execute("UPDATE sessions SET touched = ? WHERE id = ?", (session['touchedTime'].timestamp(), session['id']))
+        session['storedTouchedTime'] = session['touchedTime']
+
+    def deleteSession(self, sid):
+        '''
+            Returns True if the session existed and was deleted by this call. As the
+            DELETE is atomic, only one process gets True for the same session.
+        '''
+        db = self.__db()
+        with db:
+            deleted = db.execute("DELETE FROM sessions WHERE id = ?", (sid,)).rowcount > 0
+        self.__cache.pop(sid, None)
+        return deleted
+
+    def getSessions(self):
+        rows = self.__db().execute("SELECT id, touched, data FROM sessions").fetchall()
+        return [ self.__toSession(sid, touched, data) for (sid, touched, data) in rows ]
+
+    def putCredential(self, slotId, data):
+        db = self.__db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO credentials (id, data) VALUES (?, ?)", (slotId, data))
+
+    def getCredential(self, slotId):
+        row = self.__db().execute("SELECT data FROM credentials WHERE id = ?", (slotId,)).fetchone()
+        return row[0] if row else None
+
+    def deleteCredential(self, slotId):
+        db = self.__db()
+        with db:
+            db.execute("DELETE FROM credentials WHERE id = ?", (slotId,))
@@ -28,21 +28,30 @@ import logging
 import re
 import subprocess
 import json
+import hashlib
+import filecmp
+import time
+import concurrent.futures
 import apt_pkg
 import apt_repos
 from apt_repos import PackageField
 import reprepro_bundle_compose
-from reprepro_bundle_compose import PROJECT_DIR, BUNDLES_LIST_FILE, progname, parseBundles, updateBundles, markBundlesForStatus, getBundleRepoSuites, getTargetRepoSuites, trac_api, getTracConfig, getParentTicketsFromBundleInfo
+from reprepro_bundle_compose import PROJECT_DIR, BUNDLES_LIST_FILE, BUNDLES_ARCHIVE_FILE, progname, parseBundles, updateBundles, markBundlesForStatus, getBundleRepoSuites, getTargetRepoSuites, getTargetKeys, getBaseDist, trac_api, getTracConfig, getParentTicketsFromBundleInfo
 from reprepro_bundle_compose.bundle_status import BundleStatus
 from reprepro_bundle_compose.managed_bundle import ManagedBundle
 from reprepro_bundle_compose.distribution import Distribution
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
+from reprepro_bundle_compose.package_index import whichBundles
+from reprepro_bundle_compose.conflict_check import findConflicts
 from os.path import expanduser
-from shutil import copyfile
+from shutil import copyfile, which
+from functools import cmp_to_key
 from urllib.parse import urljoin, urlparse
 from jinja2 import Environment, FileSystemLoader
 
 
 TEMPLATES_DIR = os.path.join(PROJECT_DIR, "templates", "bundle_compose")
+APPLY_STATE_FILE = '.bundle-compose.applied'
 logger = logging.getLogger(progname)
 templateEnv = Environment(loader=FileSystemLoader(TEMPLATES_DIR))
 
@@ -71,7 +80,7 @@ def main():
     """
     # fixup to get help-messages for subcommands that require positional argmuments
     # so that "apt-repos -h <subcommand>" prints a help-message and not an error
-    for subcmd in ['mark-for-stage', 'stage', 'mark' ]:
+    for subcmd in ['mark-for-stage', 'stage', 'mark', 'which' ]:
         if ("-h" in sys.argv or "--help" in sys.argv) and subcmd in sys.argv:
             sys.argv.append("drop")
 
@@ -87,35 +96,68 @@ def main():
     parse_stage    = subparsers.add_parser("mark-for-stage", help=cmd_stage.__doc__, description=cmd_stage.__doc__, aliases=['stage', 'mark'])
     parse_list     = subparsers.add_parser("list", help=cmd_list.__doc__, description=cmd_list.__doc__, aliases=['ls', 'lsb'])
     parse_apply    = subparsers.add_parser("apply", help=cmd_apply.__doc__, description=cmd_apply.__doc__)
+    parse_update   = subparsers.add_parser("update-targets", help=cmd_update_targets.__doc__, description=cmd_update_targets.__doc__)
     parse_jsondump = subparsers.add_parser("jsondump", help=cmd_jsondump.__doc__, description=cmd_jsondump.__doc__)
     parse_jsondeps = subparsers.add_parser("jsondeps", help=cmd_jsondeps.__doc__, description=cmd_jsondeps.__doc__)
+    parse_which    = subparsers.add_parser("which", help=cmd_which.__doc__, description=cmd_which.__doc__)
 
     parse_ub.set_defaults(sub_function=cmd_update_bundles, sub_parser=parse_ub)
     parse_stage.set_defaults(sub_function=cmd_stage, sub_parser=parse_stage)
     parse_list.set_defaults(sub_function=cmd_list, sub_parser=parse_list)
     parse_apply.set_defaults(sub_function=cmd_apply, sub_parser=parse_apply)
+    parse_update.set_defaults(sub_function=cmd_update_targets, sub_parser=parse_update)
     parse_jsondump.set_defaults(sub_function=cmd_jsondump, sub_parser=parse_jsondump)
     parse_jsondeps.set_defaults(sub_function=cmd_jsondeps, sub_parser=parse_jsondeps)
+    parse_which.set_defaults(sub_function=cmd_which, sub_parser=parse_which)
 
     for p in [parse_ub]:
         p.add_argument("--no-trac", action="store_true", help="""
                         Don't sync against trac.""")
 
+    for p in [parse_apply]:
+        p.add_argument("-i", "--incremental", action="store_true", help="""
+                        Only create the configuration for repositories with targets that are affected
+                        by bundles changed since the last apply and print the affected target distributions.""")
+
+    for p in [parse_update]:
+        p.add_argument("-j", "--jobs", type=positiveInt, default=4, help="""
+                        Maximum number of repositories that are updated in parallel (default: 4).""")
+        p.add_argument("--noskipold", action="store_true", help="""
+                        Pass the option --noskipold to reprepro.""")
+        p.add_argument('targetSuite', nargs='*', help="""
+                        Name of a target suite (as listed by apt-repos, e.g. 'target:mybionic').
+                        Default are all target suites changed by 'apply' and not yet updated.""")
+
     for p in [parse_jsondump, parse_jsondeps]:
         p.add_argument('outputFilename', nargs=1, help="""
                         Name of the ouptFile for the json-dump.""")
 
+    for p in [parse_jsondeps]:
+        p.add_argument("--with-versions", action="store_true", help="""
+                        Add the conflicting versions of the shared binary packages to each dependency.""")
+
+    for p in [parse_which]:
+        p.add_argument("-n", "--no-update", action="store_true", help="""
+                        Answer from the package index without scanning new or changed bundles.""")
+        p.add_argument('packageName', nargs='+', help="""
+                        Name of a binary or source package.""")
+
     for p in [parse_list]:
         p.add_argument("-s", "--stage", default=None, choices=sorted(BundleStatus.getAvailableStages()), help="""
                         Select only bundles in the provided stage.""")
         p.add_argument("-c", "--candidates", action="store_true", help="""
                         Print the list of candidates for each (selected) status.""")
 
+    for p in [parse_list, parse_jsondump, parse_jsondeps]:
+        p.add_argument("--include-archived", action="store_true", help="""
+                        Also consider the bundles that were moved to the archive file '{}'.""".format(BUNDLES_ARCHIVE_FILE))
+
     for p in [parse_stage]:
         p.add_argument("-c", "--candidates", action="store_true", help="""
                         Automatically add all candiates for this stage. Available candidates can be viewed with '{} list -c'.""".format(progname))
         p.add_argument("-f", "--force", action="store_true", help="""
-                        Don't check if a bundle is ready for being put into the new stage.""")
+                        Don't check if a bundle is ready for being put into the new stage and
+                        don't refuse bundles with package conflicts in the new stage.""")
         p.add_argument('stage', nargs=1, choices=sorted(BundleStatus.getAvailableStages()), help="""
                         The stage bundles should be marked for.""")
         p.add_argument('bundleName', nargs='*', help="""
@@ -124,7 +166,6 @@ def main():
     parser.set_defaults()
     args = parser.parse_args()
     setupLogging(logging.DEBUG if args.debug else logging.INFO)
-    apt_repos.setAptReposBaseDir(os.path.join(PROJECT_DIR, ".apt-repos"))
 
     if "sub_function" in args.__dict__:
         if args.help:
@@ -159,7 +200,7 @@ def cmd_update_bundles(args):
         except Exception as e:
             logger.warn("Trac will not be synchronized: {}".format(e))
 
-    updateBundles(tracApi, parentTicketsField=parentTicketsField)
+    updateBundles(tracApi, parentTicketsField=parentTicketsField, context=AptReposContext.forProject(PROJECT_DIR))
 
 
 def cmd_stage(args):
@@ -167,13 +208,24 @@ def cmd_stage(args):
         Marks specified bundles to be put into a particular stage.
     '''
     stageStatus = BundleStatus.getByStage(args.stage[0])
-    bundles = parseBundles(getBundleRepoSuites())
+    context = AptReposContext.forProject(PROJECT_DIR)
+    bundles = parseBundles(getBundleRepoSuites(context=context))
     ids = set()
     if args.bundleName:
         ids = ids.union(args.bundleName)
     if args.candidates:
         candidates = filterBundles(bundles, stageStatus.getCandidates())
         ids = ids.union([bundle.getID() for bundle in candidates])
+    # not forked (like cmd_which) as the exit code needs to reflect a refusal
+    conflicts = findConflicts(ids, stageStatus, context=context)
+    for conflict in conflicts:
+        if args.force:
+            logger.warning(conflict)
+        else:
+            logger.error(conflict)
+    if len(conflicts) > 0 and not args.force:
+        logger.error("Refusing to mark bundles for stage '{}' due to package conflicts (use -f to ignore them)".format(args.stage[0]))
+        sys.exit(1)
     markBundlesForStatus(bundles, ids, stageStatus, args.force)
 
 
@@ -181,7 +233,7 @@ def cmd_list(args):
     '''
         List all bundles grouped by their status / stage.
     '''
-    bundles = parseBundles(getBundleRepoSuites())
+    bundles = parseBundles(getBundleRepoSuites(context=AptReposContext.forProject(PROJECT_DIR)), includeArchived=args.include_archived)
     tracUrl = getTracConfig().get('TracUrl')
     nl = ""
     for status in BundleStatus:
@@ -202,7 +254,7 @@ def cmd_jsondump(args):
     '''
     with open(args.outputFilename[0], "w", encoding="utf-8") as jsonFile:
         logger.info("Scanning Bundles")
-        bundles = parseBundles(getBundleRepoSuites())
+        bundles = parseBundles(getBundleRepoSuites(context=AptReposContext.forProject(PROJECT_DIR)), includeArchived=args.include_archived)
         config = getTracConfig()
         tracUrl = config.get('TracUrl')
         parentTicketsField = config.get('UseParentTicketsFromInfoField')
@@ -223,7 +275,7 @@ def cmd_jsondeps(args):
     with apt_repos.suppress_unwanted_apt_pkg_messages() as forked:
         if forked:
             logger.info("Scanning Bundles")
-            bundles = parseBundles(getBundleRepoSuites())
+            bundles = parseBundles(getBundleRepoSuites(context=AptReposContext.forProject(PROJECT_DIR)), includeArchived=args.include_archived)
             logger.info("Extracting Bundle-Dependencies")
 
             packages = list()
@@ -233,65 +285,237 @@ def cmd_jsondeps(args):
                     logger.debug("Querying Packages for {} [{}]".format(bid, bundle.getStatus()))
                     suite.scan(True)
                     res = suite.queryPackages(".", True, None, None, [ PackageField.BINARY_PACKAGE_NAME, PackageField.VERSION, PackageField.SUITE ])
-                    packages.extend(res)
-
-            bundleDeps = list()
-            packageDeps = list()
-            knownRelations = set()
-            last = None
-            for p in sorted(packages):
-                (package, unused_version, suite) = p.getData()
-                if package != last:
-                    last = package
-                    packageDeps.clear()
-                for dep in packageDeps:
-                    rel = "{}:{}".format(suite, dep)
-                    if not rel in knownRelations:
-                        knownRelations.add(rel)
-                        bundleDeps.append([ str(suite), str(dep) ])
-                packageDeps.append(suite)
+                    packages.extend([p.getData() for p in res])
+
+            bundleDeps = computeBundleDependencies(packages, args.with_versions)
 
             with open(args.outputFilename[0], "w", encoding="utf-8") as jsonFile:
-                print(json.dumps(sorted(bundleDeps, reverse=True), sort_keys=True, indent=4), file=jsonFile)
+                print(json.dumps(bundleDeps, sort_keys=True, indent=4), file=jsonFile)
             logger.info("Bundle-Dependencies SUCCESSFULLY dumped to file '{}'".format(args.outputFilename[0]))
 
 
+def cmd_which(args):
+    '''
+        List the bundles providing a binary or source package, with the package's
+        version and the bundle's status.
+    '''
+    with apt_repos.suppress_unwanted_apt_pkg_messages() as forked:
+        if forked:
+            context = AptReposContext.forProject(PROJECT_DIR)
+            for (n, packageName) in enumerate(args.packageName):
+                providers = whichBundles(packageName, context=context, update=(not args.no_update and n == 0))
+                if len(providers) == 0:
+                    logger.info("No bundle provides the package '{}'".format(packageName))
+                for (bid, name, version, architecture, source, status) in providers:
+                    print("{} [{}] {} {} {}{}".format(bid, status or "unknown", name, version, architecture,
+                                                      " (source: {})".format(source) if source and source != name else ""))
+
+
+def computeBundleDependencies(packages, withVersions=False):
+    '''
+        Computes the dependencies between bundles that share the same binary packages.
+        `packages` is an iterable of (binaryPackageName, version, suite) tuples. The result
+        is a list of [suite, dependsOnSuite] pairs in which `suite` provides the newer (or,
+        for equal versions, the later) version of a shared package. If `withVersions` is
+        True, each pair is extended by a dict mapping the shared package names to the
+        [version, dependsOnVersion] of both bundles.
+
+        Packages are grouped by name in a hash index (name --> bundle --> versions) so that
+        only packages provided by more than one bundle need to be looked at. Bundles are
+        referred by integer IDs while the relations are collected.
+    '''
+    suiteIds = dict()
+    suites = list()
+    index = dict()
+    for (package, version, suite) in packages:
+        name = str(suite)
+        sid = suiteIds.get(name)
+        if sid is None:
+            sid = len(suites)
+            suiteIds[name] = sid
+            suites.append(name)
+        index.setdefault(package, dict()).setdefault(sid, set()).add(version)
+
+    versionKey = cmp_to_key(apt_pkg.version_compare)
+    relations = set()
+    conflicts = dict()
+    for package, versionsBySuite in index.items():
+        if len(versionsBySuite) < 2:
+            continue
+        entries = sorted([ (max(versions, key=versionKey), sid) for sid, versions in versionsBySuite.items() ],
+                         key=lambda e: (versionKey(e[0]), suites[e[1]]))
+        for i, (version, sid) in enumerate(entries):
+            for (depVersion, depSid) in entries[:i]:
+                relations.add((sid, depSid))
+                if withVersions:
+                    conflicts.setdefault((sid, depSid), dict())[package] = [ version, depVersion ]
+
+    res = list()
+    for (sid, depSid) in relations:
+        if withVersions:
+            res.append([ suites[sid], suites[depSid], conflicts[(sid, depSid)] ])
+        else:
+            res.append([ suites[sid], suites[depSid] ])
+    return sorted(res, key=lambda r: (r[0], r[1]), reverse=True)
+
+
 def cmd_apply(args):
     '''
         Applies the bundles list to the reprepro configuration for all target suites.
     '''
-    bundles = parseBundles(getBundleRepoSuites())
-    createTargetRepreproConfigs(bundles)
+    # archived bundles in status 'production' still need to be part of their targets
+    context = AptReposContext.forProject(PROJECT_DIR)
+    bundles = parseBundles(getBundleRepoSuites(context=context), includeArchived=True)
+    changed = createTargetRepreproConfigs(bundles, incremental=args.incremental, context=context)
+    if args.incremental:
+        if len(changed) > 0:
+            logger.info("Affected target distributions:\n  {}".format("\n  ".join(sorted(set(changed.values())))))
+            logger.info("Use '{} update-targets' to run 'reprepro update' for them.".format(progname))
+        else:
+            logger.info("No target distributions affected.")
 
 
-def createTargetRepreproConfigs(bundles):
+def cmd_update_targets(args):
+    '''
+        Runs 'reprepro update' for the specified target suites or (by default) for all
+        target suites whose configuration was changed by 'apply' and not yet updated.
+        Target repositories not served from a file:// url are only updated if their
+        conf folder is a symlink into the real repository.
+    '''
+    state = loadApplyState()
+    names = args.targetSuite if args.targetSuite else state.get('pendingUpdates', [])
+    if len(names) == 0:
+        logger.info("There are no changed target suites to update.")
+        return
+    if not which("reprepro"):
+        logger.error("Could not find the command 'reprepro' - please install it.")
+        sys.exit(1)
+    allTargets = getTargetRepoSuites(context=AptReposContext.forProject(PROJECT_DIR))
+    repoDists = dict()
+    failed = False
+    for name in sorted(set(names)):
+        target = allTargets.get(name)
+        if not target:
+            logger.error("Skipping unknown target suite '{}'".format(name))
+            continue
+        repoDir = getTargetRepoDir(target.getRepoUrl())
+        if not repoDir:
+            logger.error("Skipping target suite '{}' as the reprepro repository of {} could not be found from it's conf folder '{}'".format(name, target.getRepoUrl(), getRepoConfDir(target.getRepoUrl())))
+            failed = True
+            continue
+        repoDists.setdefault(repoDir, list()).append((name, target.getAptSuite()))
+
+    options = ["--noskipold"] if args.noskipold else []
+    results = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = { executor.submit(updateTargetRepository, repoDir, dists, options): repoDir
+                    for repoDir, dists in sorted(repoDists.items()) }
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+
+    updated = set()
+    for repoDir, (duration, distResults) in sorted(results.items()):
+        logger.info("Updated repository '{}' in {:.1f}s:".format(repoDir, duration))
+        for (name, codename, distDuration, ok) in distResults:
+            logger.info("  {} {} ({:.1f}s)".format(codename, "OK" if ok else "FAILED", distDuration))
+            if ok:
+                updated.add(name)
+            else:
+                failed = True
+    state['pendingUpdates'] = sorted(set(state.get('pendingUpdates', [])).difference(updated))
+    storeApplyState(state)
+    if failed:
+        sys.exit(1)
+
+
+def positiveInt(value):
+    res = int(value)
+    if res < 1:
+        raise argparse.ArgumentTypeError("'{}' is not a positive number".format(value))
+    return res
+
+
+def updateTargetRepository(repoDir, dists, options=None):
+    '''
+        Runs 'reprepro update' for each of the (targetSuiteName, codename) tuples in `dists`
+        one after the other, as reprepro doesn't allow concurrent changes to the same
+        repository. Returns a tuple (duration, [(targetSuiteName, codename, duration, success)]).
+    '''
+    res = list()
+    start = time.time()
+    for (name, codename) in dists:
+        distStart = time.time()
+        cmd = ["reprepro", "-b", repoDir] + (options or []) + ["update", codename]
+        logger.debug("Calling '{}'".format(" ".join(cmd)))
+        ok = True
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logger.error("Updating {} in '{}' failed with return code {}:\n{}".format(codename, repoDir, e.returncode, e.output.decode('utf-8')))
+            ok = False
+        except OSError as e:
+            logger.error("Updating {} in '{}' failed: {}".format(codename, repoDir, e))
+            ok = False
+        res.append((name, codename, time.time() - distStart, ok))
+    return (time.time() - start, res)
+
+
+def createTargetRepreproConfigs(bundles, incremental=False, context=None):
     """
-        Creates reprepro config files for targets in all known stages
+        Creates reprepro config files for targets in all known stages. apt-repos suites
+        are resolved using the AptReposContext `context`.
+
+        If `incremental` is True, the bundles are compared with the state recorded at the
+        last successful apply (see APPLY_STATE_FILE) and only the repositories containing
+        targets affected by changed bundles are created again. A complete run is done if
+        there is no such state or if the target configuration changed in between.
+
+        Returns a dict of target suite name to the reprepro codename (as rendered into the
+        distributions file) for all target suites whose reprepro configuration changed.
     """
     dist_template = templateEnv.get_template("target_distributions.skel")
     bundle_update_template = templateEnv.get_template("bundle_updates.skel")
     bundle_base_update_template = templateEnv.get_template("bundle-base_updates.skel")
 
+    context = context or AptReposContext.forProject(PROJECT_DIR)
+    allTargets = getTargetRepoSuites(context=context)
     updateUrls = set()
     for stage in sorted(BundleStatus.getAvailableStages()):
-        targets = getTargetRepoSuites(stage)
+        stageTag = "bundle-stage.{}".format(stage)
+        targets = [target for _, target in sorted(allTargets.items()) if stageTag in target.getTags()]
         logger.info("Found {} targets for stage '{}'".format(len(targets), stage))
-        for _, target in sorted(targets.items()):
+        for target in targets:
             logger.debug("Adding target {} with Url {}".format(target, target.getRepoUrl()))
             updateUrls.add(target.getRepoUrl())
 
+    targetsByUrl = dict()
+    for _, target in sorted(allTargets.items()):
+        targetsByUrl.setdefault(target.getRepoUrl(), list()).append(target)
+
+    bundlesIndex = indexBundlesByTargetKey(bundles)
+    baseSuites = dict()
+    publicKeyIDs = dict()
+    codenames = dict()
+
+    oldState = loadApplyState()
+    newState = {
+        'config': getTargetConfigFingerprint(allTargets, baseSuites, context),
+        'bundles': { bid: getBundleApplyState(bundle) for bid, bundle in bundles.items() },
+        'targets': dict(oldState.get('targets', dict())),
+    }
+    if incremental and oldState.get('config') == newState['config']:
+        affected = getAffectedTargets(allTargets, oldState.get('bundles', dict()), newState['bundles'])
+        updateUrls = updateUrls.intersection([target.getRepoUrl() for target in affected])
+        logger.info("Found {} targets affected by changed bundles".format(len(affected)))
+    elif incremental:
+        logger.info("No matching state of a previous apply found --> applying all targets")
+
     for url in sorted(updateUrls):
-        p = urlparse(url)
-        repoConfDir = None
-        if p.scheme == "file":
-            urlFilepath = p.path.replace("%20", " ")
-            repoConfDir = os.path.join(urlFilepath, 'conf')
-            if not os.path.isdir(repoConfDir):
+        repoConfDir = getRepoConfDir(url)
+        if not os.path.isdir(repoConfDir):
+            if urlparse(url).scheme == "file":
                 os.makedirs(repoConfDir)
-        else:
-            urlFilepath = re.sub("[^a-zA-z0-9]", "_", url)
-            repoConfDir = os.path.join(PROJECT_DIR, 'repo', urlFilepath, 'conf')
-            if not os.path.isdir(repoConfDir):
+            else:
                 # we expect 'conf' to be a preconfigured symlink in this case,
                 # so use "mkdir" instead of "mkdirs"
                 os.mkdir(repoConfDir)
@@ -310,28 +534,175 @@ def createTargetRepreproConfigs(bundles):
         if not os.path.isdir(updatesDir):
             os.mkdir(updatesDir)
 
-        repoTargets = list()
-        for _, target in sorted(getTargetRepoSuites().items()):
-            if target.getRepoUrl() == url:
-                repoTargets.append(target)
-        createTargetRepreproConfigForRepository(bundles, repoTargets, repoConfDir, bundle_update_template, bundle_base_update_template, dist_template)
+        repoTargets = targetsByUrl.get(url, list())
+        digests = createTargetRepreproConfigForRepository(bundlesIndex, repoTargets, repoConfDir, bundle_update_template, bundle_base_update_template, dist_template, baseSuites, publicKeyIDs, context, codenames)
+        newState['targets'].update(digests)
+
+    for name in list(newState['targets'].keys()):
+        if not name in allTargets:
+            del newState['targets'][name]
+    oldDigests = oldState.get('targets', dict())
+    changed = sorted([name for name, digest in newState['targets'].items() if oldDigests.get(name) != digest])
+    pending = set(oldState.get('pendingUpdates', [])).union(changed)
+    newState['pendingUpdates'] = sorted([name for name in pending if name in allTargets])
+    storeApplyState(newState)
+    return dict((name, codenames.get(name, allTargets[name].getAptSuite())) for name in changed)
 
 
-def createTargetRepreproConfigForRepository(bundles, repoTargets, repoConfDir, bundle_update_template, bundle_base_update_template, dist_template):
+def getTargetRepoDir(url):
+    '''
+        Returns the base directory of the reprepro repository for the target repository
+        with the url `url` or None if it is not available locally. The base directory is
+        the parent of the real path of the generated conf folder (see getRepoConfDir()).
+        For repositories that are not served from a file:// url, the conf folder needs
+        to be a symlink into the real repository (as on the repository server).
     '''
-        creates the complete configuration for all suites (targets) belonging to the same repository
+    confDir = getRepoConfDir(url)
+    realConfDir = os.path.realpath(confDir)
+    if not os.path.isdir(realConfDir):
+        return None
+    if urlparse(url).scheme != "file" and realConfDir == os.path.abspath(confDir):
+        # just the generated conf folder without a repository
+        return None
+    return os.path.dirname(realConfDir)
+
+
+def getRepoConfDir(url):
+    '''
+        Returns the path of the reprepro conf directory for the target repository with the url `url`.
+    '''
+    p = urlparse(url)
+    if p.scheme == "file":
+        urlFilepath = p.path.replace("%20", " ")
+        return os.path.join(urlFilepath, 'conf')
+    urlFilepath = re.sub("[^a-zA-z0-9]", "_", url)
+    return os.path.join(PROJECT_DIR, 'repo', urlFilepath, 'conf')
+
+
+def loadApplyState():
+    '''
+        Returns the state recorded at the last successful apply or an empty dict.
+    '''
+    stateFile = os.path.join(PROJECT_DIR, APPLY_STATE_FILE)
+    if not os.path.isfile(stateFile):
+        return dict()
+    try:
+        with open(stateFile, "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except ValueError as e:
+        logger.warning("Ignoring invalid file '{}': {}".format(APPLY_STATE_FILE, e))
+        return dict()
+
+
+def storeApplyState(state):
+    with open(os.path.join(PROJECT_DIR, APPLY_STATE_FILE), "w", encoding="utf-8") as fh:
+        json.dump(state, fh, sort_keys=True, indent=1)
+
+
+def getBundleApplyState(bundle):
+    '''
+        Returns a (json serializable) list of all bundle properties that influence
+        the reprepro configuration of the targets the bundle is supposed for.
+    '''
+    (stage, dist, target) = bundle.getTargetKey()
+    return [ stage, dist, target, bundle.getRepoUrl(),
+             list(bundle.getComponents() or []), list(bundle.getArchitectures() or []) ]
+
+
+def getTargetConfigFingerprint(allTargets, baseSuites, context):
+    '''
+        Returns a checksum over the target suites, their bundle-base suites and the
+        templates. If the checksum differs from the one of the last apply, all targets
+        need to be applied again. `baseSuites` is filled with the bundle-base suites
+        per base-dist as a side effect.
+    '''
+    h = hashlib.sha1()
+    for name, target in sorted(allTargets.items()):
+        h.update(json.dumps([ name, sorted(target.getTags()), target.getRepoUrl(), target.getAptSuite(),
+                              list(target.getComponents()), list(target.getArchitectures()),
+                              str(target.getTrustedGPGFile()) ]).encode("utf-8"))
+        baseDist = getBaseDist(target)
+        if baseDist and not baseDist in baseSuites:
+            baseSuites[baseDist] = context.getSuites(["bundle-base.{}:".format(baseDist)])
+        for suite in baseSuites.get(baseDist, []):
+            h.update(json.dumps([ suite.getSuiteName(), suite.getRepoUrl(), suite.getAptSuite(),
+                                  list(suite.getComponents()), list(suite.getArchitectures()),
+                                  str(suite.getTrustedGPGFile()) ]).encode("utf-8"))
+    for root, unused_dirs, files in sorted(os.walk(TEMPLATES_DIR)):
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            h.update(os.path.relpath(path, TEMPLATES_DIR).encode("utf-8"))
+            with open(path, "rb") as fh:
+                h.update(hashlib.sha1(fh.read()).digest())
+    return h.hexdigest()
+
+
+def getAffectedTargets(allTargets, oldBundles, newBundles):
+    '''
+        Returns the list of target suites from `allTargets` that are affected by the
+        differences between the bundle states `oldBundles` and `newBundles` (dicts of
+        bundle ID to getBundleApplyState()).
+    '''
+    changedKeys = set()
+    for bid in set(oldBundles.keys()).union(newBundles.keys()):
+        old, new = oldBundles.get(bid), newBundles.get(bid)
+        if old == new:
+            continue
+        for state in [old, new]:
+            if state:
+                changedKeys.add(tuple(state[0:3]))
+    return [ target for _, target in sorted(allTargets.items())
+             if not changedKeys.isdisjoint(getTargetKeys(target)) ]
+
+
+def indexBundlesByTargetKey(bundles):
+    '''
+        Returns a dict that maps the target key (stage, dist, target) of the bundles
+        (see ManagedBundle.getTargetKey()) to the list of bundles with that key.
+    '''
+    index = dict()
+    for _, bundle in sorted(bundles.items()):
+        index.setdefault(bundle.getTargetKey(), list()).append(bundle)
+    return index
+
+
+def getBundlesForTarget(bundlesIndex, targetSuite):
+    '''
+        Returns the sorted list of bundles from `bundlesIndex` (see indexBundlesByTargetKey)
+        that are supposed to be contained in `targetSuite`. This is the indexed equivalent
+        of calling ManagedBundle.isSupposedForTarget(targetSuite) for each bundle.
+    '''
+    res = list()
+    for key in getTargetKeys(targetSuite):
+        res.extend(bundlesIndex.get(key, []))
+    return sorted(res, key=lambda b: b.getID())
+
+
+def createTargetRepreproConfigForRepository(bundlesIndex, repoTargets, repoConfDir, bundle_update_template, bundle_base_update_template, dist_template, baseSuites=None, publicKeyIDs=None, context=None, codenames=None):
+    '''
+        creates the complete configuration for all suites (targets) belonging to the same repository.
+        `baseSuites` and `publicKeyIDs` are optional dicts used to share the bundle-base suites per
+        base-dist and the public key IDs per gpg-file between calls for different repositories.
+        bundle-base suites are resolved using the AptReposContext `context`. If the optional dict
+        `codenames` is given, it is filled with the target suite name to the Codename rendered
+        into the distributions file. Files are only written if their content changes.
+
+        Returns a dict of target suite name to a checksum of the target's distribution
+        and update rules.
     '''
     logger.info("Creating reprepro-config at '{}' with {} suites".format(repoConfDir, len(repoTargets)))
     autogenerated = "# This file is auto-generated by '{}'. Don't edit it manually!\n".format(progname)
+    baseSuites = dict() if baseSuites is None else baseSuites
+    publicKeyIDs = dict() if publicKeyIDs is None else publicKeyIDs
+    context = context or AptReposContext.forProject(PROJECT_DIR)
     update_line = {}
     update_rules = dict()
+    target_rules = dict()
     # create update rules for bundles
     for target in repoTargets:
-        for unused_bid, bundle in sorted(bundles.items()):
-            if not bundle.isSupposedForTarget(target):
-                continue
+        keyIds = getCachedPublicKeyIDs(publicKeyIDs, target.getTrustedGPGFile())
+        for bundle in getBundlesForTarget(bundlesIndex, target):
             ruleName = 'update-' + bundle.getID()
-            keyIds = sorted(getPublicKeyIDs(target.getTrustedGPGFile()))
             chunk = bundle_update_template.render(
                 ruleName=ruleName,
                 repoUrl=bundle.getRepoUrl(),
@@ -341,40 +712,48 @@ def createTargetRepreproConfigForRepository(bundles, repoTargets, repoConfDir, b
                 publicKeys=("!|".join(keyIds)+"!" if len(keyIds) > 0 else ""))
             update_rules[ruleName] = chunk
             update_line[target] = update_line.get(target, "") + '\n ' + ruleName
-    with open(os.path.join(repoConfDir, 'distributions', 'bundle-compose_dynamic.conf'), "w") as upconf:
-        upconf.write(autogenerated)
-        for target in repoTargets:
-            # create update rule for bundle-base suites
-            updates = update_line.get(target, "")
-            baseDist = getBaseDist(target)
-            if not baseDist:
-                logger.warning("Skipping target {} as it has no 'base-dist.*' tag and no 'bundle-dist.*' tag!".format(target))
-                continue
-            for suite in sorted(apt_repos.getSuites(["bundle-base.{}:".format(baseDist)])):
-                ruleName = "update-" + suite.getSuiteName()
-                keyIds = sorted(getPublicKeyIDs(suite.getTrustedGPGFile()))
-                updates += '\n ' + ruleName
-                chunk = bundle_base_update_template.render(
-                    ruleName=ruleName,
-                    repoUrl=suite.getRepoUrl(),
-                    suite=suite.getAptSuite(),
-                    components=" ".join(suite.getComponents()),
-                    architectures=" ".join(suite.getArchitectures()),
-                    targetDistribution = baseDist,
-                    publicKeys=("!|".join(keyIds)+"!" if len(keyIds) > 0 else ""))
-                update_rules[ruleName] = chunk
-
-            # create distribution file
-            logger.debug("Updating target {}".format(target))
-            upconf.write(dist_template.render(
-                updates=updates,
-                suite=target.getAptSuite(),
-                components=" ".join(target.getComponents()),
-                architectures=" ".join(target.getArchitectures())))
+            target_rules.setdefault(target, list()).append(ruleName)
+    distributions = autogenerated
+    target_dists = dict()
+    for target in repoTargets:
+        # create update rule for bundle-base suites
+        updates = update_line.get(target, "")
+        baseDist = getBaseDist(target)
+        if not baseDist:
+            logger.warning("Skipping target {} as it has no 'base-dist.*' tag and no 'bundle-dist.*' tag!".format(target))
+            continue
+        if not baseDist in baseSuites:
+            baseSuites[baseDist] = context.getSuites(["bundle-base.{}:".format(baseDist)])
+        for suite in baseSuites[baseDist]:
+            ruleName = "update-" + suite.getSuiteName()
+            keyIds = getCachedPublicKeyIDs(publicKeyIDs, suite.getTrustedGPGFile())
+            updates += '\n ' + ruleName
+            chunk = bundle_base_update_template.render(
+                ruleName=ruleName,
+                repoUrl=suite.getRepoUrl(),
+                suite=suite.getAptSuite(),
+                components=" ".join(suite.getComponents()),
+                architectures=" ".join(suite.getArchitectures()),
+                targetDistribution = baseDist,
+                publicKeys=("!|".join(keyIds)+"!" if len(keyIds) > 0 else ""))
+            update_rules[ruleName] = chunk
+            target_rules.setdefault(target, list()).append(ruleName)
+
+        # create distribution file
+        logger.debug("Updating target {}".format(target))
+        target_dists[target] = dist_template.render(
+            updates=updates,
+            suite=target.getAptSuite(),
+            components=" ".join(target.getComponents()),
+            architectures=" ".join(target.getArchitectures()))
+        if codenames is not None:
+            m = re.search(r"^Codename:\s*(\S+)", target_dists[target], re.MULTILINE)
+            codenames[target.getSuiteName()] = m.group(1) if m else target.getAptSuite()
+        distributions += target_dists[target]
+    writeIfChanged(os.path.join(repoConfDir, 'distributions', 'bundle-compose_dynamic.conf'), distributions)
     # create updates file
-    with open(os.path.join(repoConfDir, 'updates', 'bundle-compose_dynamic.conf'), "w") as upconf:
-        upconf.write(autogenerated)
-        upconf.write("".join([v for _, v in sorted(update_rules.items())]))
+    writeIfChanged(os.path.join(repoConfDir, 'updates', 'bundle-compose_dynamic.conf'),
+                   autogenerated + "".join([v for _, v in sorted(update_rules.items())]))
     for root, dirs, files in os.walk(TEMPLATES_DIR):
         path = os.path.relpath(root, TEMPLATES_DIR)
         for f in dirs:
@@ -391,8 +770,10 @@ def createTargetRepreproConfigForRepository(bundles, repoTargets, repoConfDir, b
                 relPath = os.path.relpath(srcPath, repoConfDir)
                 name = f[:-len(".symlink")]
                 targetPath = os.path.join(repoConfDir, path, name)
+                if os.path.islink(targetPath) and os.readlink(targetPath) == relPath:
+                    continue
                 logger.debug("Creating symlink {} --> {}".format(relPath, targetPath))
-                if os.path.exists(targetPath):
+                if os.path.lexists(targetPath):
                     os.remove(targetPath)
                 os.symlink(relPath, targetPath)
             elif f.endswith(".once"):
@@ -402,24 +783,33 @@ def createTargetRepreproConfigForRepository(bundles, repoTargets, repoConfDir, b
                     copyfile(srcPath, targetPath)
             else:
                 targetPath = os.path.join(repoConfDir, path, f)
+                if os.path.isfile(targetPath) and filecmp.cmp(srcPath, targetPath, shallow=False):
+                    continue
                 logger.debug("Copying file {} --> {}".format(srcPath, targetPath))
                 copyfile(srcPath, targetPath)
 
+    res = dict()
+    for target in repoTargets:
+        h = hashlib.sha1(target_dists.get(target, "").encode("utf-8"))
+        for ruleName in target_rules.get(target, []):
+            h.update(update_rules[ruleName].encode("utf-8"))
+        res[target.getSuiteName()] = h.hexdigest()
+    return res
 
-def getBaseDist(targetRepoSuite):
+
+def writeIfChanged(filename, content):
     '''
-        Returns the base-dist defined for the supplied targetRepoSuite or None, if there is
-        is no base-dist defined for the target. The base-dist is
-        * either the {value} defined by a "base-dist.{value}"-tag (if defined) or
-        * the {value} defined by a "bundle-dist.{value}"-tag (as fallback).
+        Writes `content` to the file `filename` if the file doesn't already have this content.
+        Returns True if the file was written.
     '''
-    bundleDist, baseDist = None, None
-    for tag in targetRepoSuite.getTags():
-        if tag.startswith("base-dist."):
-            baseDist = tag[len("base-dist."):]
-        if tag.startswith("bundle-dist."):
-            bundleDist = tag[len("bundle-dist."):]
-    return baseDist if baseDist else bundleDist
+    if os.path.isfile(filename):
+        with open(filename, "r") as fh:
+            if fh.read() == content:
+                logger.debug("Unchanged file {}".format(filename))
+                return False
+    with open(filename, "w") as fh:
+        fh.write(content)
+    return True
 
 
 def filterBundles(bundles, status):
@@ -463,6 +853,15 @@ def __extractBundleInfos(bundle, tracUrl=None, parentTicketsField=None):
     return bundleInfo
 
 
+def getCachedPublicKeyIDs(cache, gpgFile):
+    '''
+        Returns the sorted list of public key IDs from `gpgFile` and remembers it in the dict `cache`.
+    '''
+    if not gpgFile in cache:
+        cache[gpgFile] = sorted(getPublicKeyIDs(gpgFile))
+    return cache[gpgFile]
+
+
 def getPublicKeyIDs(gpgFile):
     ids = set()
     if gpgFile:
@@ -27,21 +27,26 @@ import subprocess
 import apt_pkg
 import git
 import re
+import datetime
+import itertools
 import git.exc
 from git.exc import GitCommandError
 from reprepro_bundle_compose.bundle_status import BundleStatus
 from reprepro_bundle_compose.managed_bundle import ManagedBundle
 from reprepro_bundle_compose.distribution import Distribution
+from reprepro_bundle_compose.status_store import getStatusStore
 
 logger = logging.getLogger(__name__)
 
 BUNDLES_LIST_FILE = 'bundle-compose.status'
+BUNDLES_ARCHIVE_FILE = 'bundle-compose.archive'
 
 PROJECT_DIR = os.getcwd()
 local_apt_repos = os.path.join(PROJECT_DIR, "apt-repos")
 if os.path.isdir(local_apt_repos):
     sys.path.insert(0, local_apt_repos)
 import apt_repos
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
 
 HERE = os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + "/..")
 if os.path.isdir(os.path.join(HERE, "reprepro_bundle_compose")):
@@ -54,7 +59,12 @@ if not os.path.exists(APT_REPOS_CMD):
     APT_REPOS_CMD = "apt-repos"
 
 
-def updateBundles(tracApi=None, parentTicketsField=None, cwd=PROJECT_DIR):
+def updateBundles(tracApi=None, parentTicketsField=None, cwd=PROJECT_DIR, context=None, progress=None):
+    '''
+        Updates the file BUNDLES_LIST_FILE against the currently available bundles and
+        synchronizes them with trac if `tracApi` is provided. If `progress` is provided,
+        it is called with the number of processed bundles and the total number of bundles.
+    '''
     preUpdateHook = getHooksConfig(cwd=cwd).get('pre_update_bundles', None)
     if preUpdateHook:
         cmd = preUpdateHook.split()
@@ -64,11 +74,14 @@ def updateBundles(tracApi=None, parentTicketsField=None, cwd=PROJECT_DIR):
         except subprocess.CalledProcessError as e:
             logger.warning("Hook execution failed with return code {}:\n{}".format(e.returncode, e.output.decode('utf-8')))
 
-    repo_suites = getBundleRepoSuites(cwd=cwd)
+    repo_suites = getBundleRepoSuites(cwd=cwd, context=context)
     managed_bundles = parseBundles(cwd=cwd)
-    ids = set(repo_suites.keys()).union(managed_bundles.keys())
+    archivedIds = getStatusStore(os.path.join(cwd, BUNDLES_ARCHIVE_FILE)).getIds()
+    ids = set(repo_suites.keys()).difference(archivedIds).union(managed_bundles.keys())
 
-    for id in sorted(ids):
+    for (index, id) in enumerate(sorted(ids)):
+        if progress:
+            progress(index, len(ids))
         logger.debug("Updating {}".format(id))
         bundle = managed_bundles.get(id)
         suite = repo_suites.get(id)
@@ -124,15 +137,28 @@ def updateBundles(tracApi=None, parentTicketsField=None, cwd=PROJECT_DIR):
                 })
                 logger.info("Updated Trac-Ticket #{} of {} to Target '{}'".format(bundle.getTrac(), bundle, pushTarget))
 
+    if progress:
+        progress(len(ids), len(ids))
+    archiveAfterDays = getArchiveAfterDays(cwd=cwd)
+    if archiveAfterDays != None:
+        stampTerminalSince(managed_bundles.values())
+        archiveBundles(managed_bundles, archiveAfterDays, cwd=cwd)
     storeBundles(managed_bundles, cwd=cwd)
 
 
-def parseBundles(repoSuites=None, selectIds=None, cwd=PROJECT_DIR):
+def parseBundles(repoSuites=None, selectIds=None, cwd=PROJECT_DIR, includeArchived=False):
     '''
-        Parses the file BUNDLES_LIST_FILE and returns a dict of ID to ManagedBundle-Objects mappings
+        Parses the file BUNDLES_LIST_FILE and returns a dict of ID to ManagedBundle-Objects mappings.
+        If `includeArchived` is True, the bundles from BUNDLES_ARCHIVE_FILE are added, too.
     '''
     bundlesListFile = os.path.join(cwd, BUNDLES_LIST_FILE)
-    return parseBundlesListFile(bundlesListFile, repoSuites, selectIds)
+    res = parseBundlesListFile(bundlesListFile, repoSuites, selectIds)
+    archiveFile = os.path.join(cwd, BUNDLES_ARCHIVE_FILE)
+    if includeArchived and os.path.isfile(archiveFile):
+        archived = parseBundlesListFile(archiveFile, repoSuites, selectIds)
+        archived.update(res)
+        res = archived
+    return res
 
 
 def parseBundlesListFile(bundlesListFile, repoSuites=None, selectIds=None):
@@ -143,6 +169,17 @@ def parseBundlesListFile(bundlesListFile, repoSuites=None, selectIds=None):
     if not os.path.isfile(bundlesListFile):
         logger.warning("File {} not found.".format(bundlesListFile))
         return res
+    if selectIds != None:
+        sections = getStatusStore(bundlesListFile).loadSections(selectIds)
+        for (bid, section) in sorted(sections.items()):
+            try:
+                bundle = ManagedBundle(section)
+                if repoSuites and bundle.getID() in repoSuites:
+                    bundle.setRepoSuite(repoSuites[bundle.getID()])
+                res[bundle.getID()] = bundle
+            except KeyError as e:
+                logger.warning("Skipping invalid section of {} in bundles file: Missing Key {} in\n{}".format(bid, e, str(section).rstrip()))
+        return res
     file_bundles = apt_pkg.TagFile(bundlesListFile)
     try:
         for section in file_bundles:
@@ -170,38 +207,146 @@ def storeBundles(bundlesDict, cwd=PROJECT_DIR):
         logger.debug("Updated file '{}'".format(BUNDLES_LIST_FILE))
 
 
-def getBundleRepoSuites(ids=["bundle:"], cwd=PROJECT_DIR):
+def storeChangedBundles(bundles, bundlesListFile=BUNDLES_LIST_FILE, cwd=PROJECT_DIR, bundlesDict=None):
+    '''
+        Expects a list of ManagedBundle-Objects and only rewrites their sections in the
+        file `bundlesListFile`. The sections of all other bundles are left untouched.
+        If the dict of ID to ManagedBundle-Objects `bundlesDict` is provided, it's
+        bundles that are neither contained in `bundlesListFile` nor in the file
+        BUNDLES_ARCHIVE_FILE are added, too (like storeBundles() would do).
+    '''
+    store = getStatusStore(os.path.join(cwd, bundlesListFile))
+    if bundlesDict:
+        known = store.getIds().union(getStatusStore(os.path.join(cwd, BUNDLES_ARCHIVE_FILE)).getIds())
+        known = known.union(b.getID() for b in bundles)
+        bundles = list(bundles) + [ b for (bid, b) in sorted(bundlesDict.items()) if not bid in known ]
+    store.rewriteSections(dict((bundle.getID(), bundle.serialize()) for bundle in bundles))
+    logger.debug("Updated {} sections in file '{}'".format(len(bundles), bundlesListFile))
+
+
+def stampTerminalSince(bundles, today=None):
+    '''
+        Sets the field `Terminal-Since` to the current date for all `bundles` that reached
+        a terminal status and removes it from bundles that are not in a terminal status.
+        Bundles in a terminal status that don't define this field yet (e.g. in status files
+        created before archiving was configured) are stamped with the current date, too.
+    '''
+    today = today or datetime.date.today().isoformat()
+    for bundle in bundles:
+        if bundle.getStatus().isTerminal():
+            if not bundle.getTerminalSince():
+                bundle.setTerminalSince(today)
+        elif bundle.getTerminalSince():
+            bundle.setTerminalSince(None)
+
+
+def archiveBundles(bundlesDict, archiveAfterDays, cwd=PROJECT_DIR):
+    '''
+        Moves all bundles from `bundlesDict` that are in a terminal status for more than
+        `archiveAfterDays` days to the file BUNDLES_ARCHIVE_FILE. The moved bundles are
+        removed from `bundlesDict`, the caller is responsible for storing it. Returns the
+        list of IDs of the archived bundles.
+    '''
+    limit = datetime.date.today() - datetime.timedelta(days=archiveAfterDays)
+    archived = list()
+    for (bid, bundle) in sorted(bundlesDict.items()):
+        since = bundle.getTerminalSince()
+        if not bundle.getStatus().isTerminal() or not since:
+            continue
+        try:
+            sinceDate = datetime.datetime.strptime(since, "%Y-%m-%d").date()
+        except ValueError:
+            logger.warning("Invalid value '{}' in field Terminal-Since of {} - Please check!".format(since, bid))
+            continue
+        if sinceDate <= limit:
+            archived.append(bundle)
+    if len(archived) > 0:
+        storeChangedBundles(archived, bundlesListFile=BUNDLES_ARCHIVE_FILE, cwd=cwd)
+        for bundle in archived:
+            del bundlesDict[bundle.getID()]
+            logger.info("Moved {} with status '{}' to {}".format(bundle, bundle.getStatus(), BUNDLES_ARCHIVE_FILE))
+    return [bundle.getID() for bundle in archived]
+
+
+def getArchiveAfterDays(cwd=PROJECT_DIR):
+    '''
+        Returns the number of days configured by the key `ArchiveAfterDays` in the
+        archive configuration or None if archiving is not configured.
+    '''
+    value = getArchiveConfig(cwd=cwd).get('ArchiveAfterDays')
+    if value == None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning("Invalid value '{}' for ArchiveAfterDays --> no bundles will be archived!".format(value))
+        return None
+
+
+def getBundleRepoSuites(ids=["bundle:"], cwd=PROJECT_DIR, context=None):
     '''
        This method uses apt-repos to get a list of all currently available (rolled out)
-       bundles as a dict of ID to apt_repos.RepoSuite Objects
+       bundles as a dict of ID to apt_repos.RepoSuite Objects.
 
-       WARNING: This method modifies the global apt-repos base directory and therefore must
-                not be used in a multithreaded environment!
+       The suites are resolved using the AptReposContext `context`. If no context is
+       provided, a new context for the project `cwd` is used.
     '''
+    context = context or AptReposContext.forProject(cwd)
     res = dict()
-    apt_repos.setAptReposBaseDir(os.path.join(cwd, ".apt-repos"))
-    for suite in sorted(apt_repos.getSuites(ids)):
+    for suite in context.getSuites(ids):
         res[suite.getSuiteName()] = suite
     return res
 
 
-def getTargetRepoSuites(stage=None, cwd=PROJECT_DIR):
+def getTargetRepoSuites(stage=None, cwd=PROJECT_DIR, context=None):
     '''
        This method uses apt-repos to get a list of all currently available target
        repositories/suites. If `stage` is specified, only target suites for this
        stage are returned. The result is a dict of ID to apt_repos.RepoSuite Objects.
 
-       WARNING: This method modifies the global apt-repos base directory and therefore must
-                not be used in a multithreaded environment!
+       The suites are resolved using the AptReposContext `context`. If no context is
+       provided, a new context for the project `cwd` is used.
     '''
+    context = context or AptReposContext.forProject(cwd)
     res = dict()
-    apt_repos.setAptReposBaseDir(os.path.join(cwd, ".apt-repos"))
-    for suite in sorted(apt_repos.getSuites(["bundle-compose-target:"])):
+    for suite in context.getSuites(["bundle-compose-target:"]):
         if not stage or "bundle-stage.{}".format(stage) in suite.getTags():
             res[suite.getSuiteName()] = suite
     return res
 
 
+def getTargetKeys(targetSuite):
+    '''
+        Returns the set of target keys (stage, dist, target) defined by the
+        "bundle-stage.*", "bundle-dist.*" and "bundle-target.*" tags of `targetSuite`.
+    '''
+    stages, dists, targets = set(), set(), set()
+    for tag in targetSuite.getTags():
+        if tag.startswith("bundle-stage."):
+            stages.add(tag[len("bundle-stage."):])
+        elif tag.startswith("bundle-dist."):
+            dists.add(tag[len("bundle-dist."):])
+        elif tag.startswith("bundle-target."):
+            targets.add(tag[len("bundle-target."):])
+    return set(itertools.product(stages, dists, targets))
+
+
+def getBaseDist(targetRepoSuite):
+    '''
+        Returns the base-dist defined for the supplied targetRepoSuite or None, if there is
+        is no base-dist defined for the target. The base-dist is
+        * either the {value} defined by a "base-dist.{value}"-tag (if defined) or
+        * the {value} defined by a "bundle-dist.{value}"-tag (as fallback).
+    '''
+    bundleDist, baseDist = None, None
+    for tag in targetRepoSuite.getTags():
+        if tag.startswith("base-dist."):
+            baseDist = tag[len("base-dist."):]
+        if tag.startswith("bundle-dist."):
+            bundleDist = tag[len("bundle-dist."):]
+    return baseDist if baseDist else bundleDist
+
+
 def getGitRepoConfig(required=False, cwd=PROJECT_DIR):
     gitRepoConfFiles = [
         os.path.join(cwd, ".bundle-compose.git-repo.conf"),
@@ -218,6 +363,13 @@ def getTracConfig(required=False, cwd=PROJECT_DIR):
     return __getConfig(tracConfFiles, confType="trac", required=required)
 
 
+def getArchiveConfig(required=False, cwd=PROJECT_DIR):
+    archiveConfFiles = [
+        os.path.join(cwd, ".bundle-compose.archive.conf")
+    ]
+    return __getConfig(archiveConfFiles, confType="archive", required=required)
+
+
 def getHooksConfig(required=False, cwd=PROJECT_DIR):
     hooksConfFiles = [
         os.path.join(cwd, ".bundle-compose.hooks.conf")
@@ -282,7 +434,7 @@ def splitReleasenotes(info):
 
 def markBundlesForStatus(bundles, bundleIds, status, force=False, checkOwnSuite=True, cwd=PROJECT_DIR):
     ids = set(bundleIds)
-    changed = False
+    changed = list()
     for (bid, bundle) in sorted(bundles.items()):
         if not bid in ids:
             continue
@@ -301,16 +453,18 @@ def markBundlesForStatus(bundles, bundleIds, status, force=False, checkOwnSuite=
         ids.remove(bid)
         bundle.setStatus(status)
         logger.info("marked {} for status '{}'".format(bid, status))
-        changed = True
+        changed.append(bundle)
     if len(ids) > 0:
         logger.error("the following bundles are not defined: '{}'".format("', '".join(ids)))
     if changed:
-        storeBundles(bundles, cwd=cwd)
+        if getArchiveAfterDays(cwd=cwd) != None:
+            stampTerminalSince(changed)
+        storeChangedBundles(changed, cwd=cwd, bundlesDict=bundles)
 
 
 def markBundlesForTarget(bundles, bundleIds, target, cwd=PROJECT_DIR, ignoreTargetFromInfoFile=None):
     ids = set(bundleIds)
-    changed = False
+    changed = list()
     for (bid, bundle) in sorted(bundles.items()):
         if not bid in ids:
             continue
@@ -318,15 +472,16 @@ def markBundlesForTarget(bundles, bundleIds, target, cwd=PROJECT_DIR, ignoreTarg
         if ignoreTargetFromInfoFile != None and bundle.ignoresTargetFromInfoFile() != ignoreTargetFromInfoFile:
             bundle.setIgnoreTargetFromInfoFile(ignoreTargetFromInfoFile)
             logger.info("{}gnoring 'TargetFromInfoFile' for {}".format(("I" if ignoreTargetFromInfoFile else "No longer i"), bundle))
-            changed = True
+            changed.append(bundle)
         if bundle.getTarget() != target:
             bundle.setTarget(target)
             logger.info("Marked {} for target '{}'".format(bid, target))
-            changed = True
+            if not bundle in changed:
+                changed.append(bundle)
     if len(ids) > 0:
         logger.error("The following bundles are not defined: '{}'".format("', '".join(ids)))
     if changed:
-        storeBundles(bundles, cwd)
+        storeChangedBundles(changed, cwd=cwd, bundlesDict=bundles)
 
 
 def git_commit(repo, git_add_list, msg):
@@ -26,6 +26,12 @@
 import logging
 import json
 import os
+import hashlib
+import re
+import collections
+import threading
+import fcntl
+import time
 import io
 import sys
 from aiohttp import web
@@ -41,11 +47,16 @@ import apt_repos
 from urllib.parse import urlparse
 import reprepro_bundle_compose
 from reprepro_bundle_compose import \
-        BUNDLES_LIST_FILE, BundleStatus, getTargetRepoSuites, \
+        BUNDLES_LIST_FILE, BUNDLES_ARCHIVE_FILE, BundleStatus, getTargetRepoSuites, \
         getBundleRepoSuites, parseBundles, trac_api, \
         getTracConfig, getGitRepoConfig, git_commit, \
         ensure_clean_git_repo, GitNotCleanException
-from reprepro_bundle_appserver import common_app_server, common_interfaces
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
+from reprepro_bundle_compose.package_search import PackageIndexCache, getSuiteKeys, searchPackages
+from reprepro_bundle_compose.package_index import whichBundles, getBundlePackageIndex, updateBundlePackageIndex
+from reprepro_bundle_compose.conflict_check import findConflicts
+from reprepro_bundle.suite_resolver import getSuiteResolver
+from reprepro_bundle_appserver import common_app_server, common_interfaces, common_jobs, IllegalArgumentException
 from apt_repos import RepoSuite, PackageField, QueryResult
 
 
@@ -63,10 +74,20 @@ if os.path.isdir(local_apt_repos):
 import apt_repos
 
 MAX_GIT_LIST_CHANGES = 200
-publishedCommitsCache = set()
-publishedCommitsLastHead = None
+
+MAX_CONFIGURED_STAGES_CACHE = 100
+configuredStagesCache = collections.OrderedDict() # of apt-repos base dir to (fingerprint, list of stages), least recently used first
+configuredStagesLock = threading.Lock()
+
+GIT_MIRRORS_DIR = os.path.join(os.path.expanduser("~"), ".cache", progname, "mirrors")
+GIT_MIRROR_REFRESH_S = 300
+gitMirrorsRefreshed = dict() # of RepoUrl to time of the last refresh
+
+bundlePackageIndexUpdate = None # future of the running background update of the bundle package index
 
 ppe = None # ProcessPoolExecutor set in main
+tpe = None # ThreadPoolExecutor set in main
+packageIndexCache = None # PackageIndexCache set in main
 
 async def handle_get_suites(request):
     try:
@@ -75,14 +96,14 @@ async def handle_get_suites(request):
         return web.Response(text="Invalid Session: {}".format(e), status=401)
     searchStringArray = json.loads(request.rel_url.query['suiteTag'])
     logger.info("Handling get_suites(suiteTag='{}')".format(searchStringArray))
-    res = await asyncio.wrap_future(ppe.submit(apt_repos_get_suites, searchStringArray, cwd = cwd))
+    res = await asyncio.wrap_future(tpe.submit(apt_repos_get_suites, searchStringArray, cwd = cwd))
     logger.debug("Handling get_suites finished")
     return web.json_response(res)
 
-def apt_repos_get_suites(suiteSelectors, cwd=PROJECT_DIR):
+def apt_repos_get_suites(suiteSelectors, cwd=PROJECT_DIR, context=None):
     res = []
-    apt_repos.setAptReposBaseDir(os.path.join(cwd, ".apt-repos"))
-    for suite in sorted(apt_repos.getSuites(suiteSelectors)):
+    context = context or AptReposContext.forProject(cwd)
+    for suite in context.getSuites(suiteSelectors):
         res.append(common_interfaces.Suite(suite))
     return res
 
@@ -92,25 +113,65 @@ async def handle_get_custom_packages(request):
         unused_session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
-    searchStringArraySuites = json.loads(request.rel_url.query['suiteTag'])
-    searchStringArrayPackages = json.loads(request.rel_url.query['searchString'])
+    try:
+        searchStringArraySuites = json.loads(request.rel_url.query['suiteTag'])
+        searchStringArrayPackages = json.loads(request.rel_url.query['searchString'])
+        offset = int(request.rel_url.query.get('offset', 0))
+        limit = int(request.rel_url.query['limit']) if 'limit' in request.rel_url.query else None
+        if offset < 0 or (limit != None and limit < 0):
+            raise ValueError("offset and limit must not be negative")
+    except Exception as e:
+        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
     logger.info("Handling get_custom_packages(suiteTag='{}', searchString='{}')".format(searchStringArraySuites, searchStringArrayPackages))
-    res = await asyncio.wrap_future(ppe.submit(apt_repos_query_packages, searchStringArraySuites, searchStringArrayPackages, cwd = cwd))
-    logger.debug("Mark for target finished")
+    suiteKeys = await asyncio.wrap_future(tpe.submit(getSuiteKeys, searchStringArraySuites, cwd))
+    indexes = await packageIndexCache.getIndexes(suiteKeys, cwd)
+    try:
+        packages = await asyncio.wrap_future(tpe.submit(searchPackages, indexes, searchStringArrayPackages))
+    except re.error as e:
+        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
+    page = packages[offset:] if limit == None else packages[offset:offset+limit]
+    for package in page:
+        res.append(common_interfaces.Package(*package))
+    logger.debug("Handling get_custom_packages finished")
+    return web.json_response(res, headers={ 'X-Total-Count': str(len(packages)) })
+
+async def handle_which_bundles(request):
+    try:
+        unused_session, cwd = validateSession(request)
+    except Exception as e:
+        return web.Response(text="Invalid Session: {}".format(e), status=401)
+    try:
+        packageName = request.rel_url.query['package']
+    except Exception as e:
+        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
+    logger.info("Handling which_bundles(package='{}')".format(packageName))
+    res = await asyncio.wrap_future(ppe.submit(which_bundles, packageName, cwd))
+    scheduleBundlePackageIndexUpdate(cwd)
+    logger.debug("Handling which_bundles finished")
     return web.json_response(res)
 
-def apt_repos_query_packages(suiteSelectors, searchStrings, cwd = PROJECT_DIR):
-    apt_repos.setAptReposBaseDir(os.path.join(cwd, ".apt-repos"))
-    requestFields = PackageField.getByFieldsString("pvsaSC")
-    packages = []
-    for suite in sorted(apt_repos.getSuites(suiteSelectors)):
-        suite.scan(True)
-        packages.extend(suite.queryPackages(searchStrings, True, None, None, requestFields))
-    res = []
-    for package in sorted(packages):
-        (packageName, version, packageSuite, architecture, section, source) = package.getData()
-        res.append(common_interfaces.Package(packageName, version, packageSuite, architecture, section, source))
-    return res
+def which_bundles(packageName, cwd):
+    '''
+        Answers from the package index. The index is only updated synchronously if
+        it is still empty, otherwise it is updated in the background (see
+        scheduleBundlePackageIndexUpdate()).
+    '''
+    update = getBundlePackageIndex().isEmpty()
+    return [ common_interfaces.BundlePackage(*provider) for provider in whichBundles(packageName, cwd=cwd, update=update) ]
+
+def scheduleBundlePackageIndexUpdate(cwd):
+    '''
+        Updates the bundle package index in the background unless such an update is
+        already running.
+    '''
+    global bundlePackageIndexUpdate
+    if bundlePackageIndexUpdate and not bundlePackageIndexUpdate.done():
+        return
+    bundlePackageIndexUpdate = ppe.submit(updateBundlePackageIndex, cwd)
+    def logResult(f):
+        if f.exception():
+            logger.warning("Updating the bundle package index failed: {}".format(f.exception()))
+    bundlePackageIndexUpdate.add_done_callback(logResult)
 
 async def handle_required_auth(request):
     res = list()
@@ -130,37 +191,37 @@ async def handle_required_auth(request):
                 "Please enter your {CredentialType} authentication data in order to clone the GIT Reposiory!"
             ))
         elif actionId == "bundleSync":
-            cwd = None
+            session, cwd = None, None
             try:
-                unused_session, cwd = validateSession(request)
+                session, cwd = validateSession(request)
             except Exception as e:
                 return web.Response(text="Invalid Session: {}".format(e), status=401)
             res.extend(getRequiredAuthForConfig(
                 availableRefs,
-                getTracConfig(cwd=cwd),
+                await getCachedState(session, cwd, 'tracConfig', lambda: getTracConfig(cwd=cwd)),
                 "TracUrl",
                 "Please enter your {CredentialType} authentication data to sync with Trac!"
             ))
         elif actionId == "gitPullRebase":
-            cwd = None
+            session, cwd = None, None
             try:
-                unused_session, cwd = validateSession(request)
+                session, cwd = validateSession(request)
             except Exception as e:
                 return web.Response(text="Invalid Session: {}".format(e), status=401)
             res.extend(getRequiredAuthForConfig(
                 availableRefs,
-                getGitRepoConfig(cwd=cwd),
+                await getCachedState(session, cwd, 'gitRepoConfig', lambda: getGitRepoConfig(cwd=cwd)),
                 "RepoUrl",
                 "Please enter your {CredentialType} authentication data to pull changes from the Git-Server!"
             ))
         elif actionId == "publishChanges":
             try:
-                unused_session, cwd = validateSession(request)
+                session, cwd = validateSession(request)
             except Exception as e:
                 return web.Response(text="Invalid Session: {}".format(e), status=401)
             res.extend(getRequiredAuthForConfig(
                 availableRefs,
-                getGitRepoConfig(cwd=cwd),
+                await getCachedState(session, cwd, 'gitRepoConfig', lambda: getGitRepoConfig(cwd=cwd)),
                 "RepoUrl",
                 "Please enter your {CredentialType} authentication data to publish changes to GIT!"
             ))
@@ -205,11 +266,16 @@ async def handle_login(request):
         try:
             tmpDir = tempfile.mkdtemp()
             logger.debug("Cloning '{}' to '{}'".format(repoUrl, tmpDir))
-            await asyncio.wrap_future(ppe.submit(git_clone_repository, repoUrl, branch, tmpDir, useAuthentication, user, password))
+            mirrorCreated = await asyncio.wrap_future(ppe.submit(git_clone_repository, repoUrl, branch, tmpDir, useAuthentication, user, password))
             logger.info("Successfully cloned {} to a (temporary) local working directory, branch '{}'.".format(repoUrl, branch))
             session = createSession(tmpDir)
             session["RepoUrl"] = repoUrl
             session["Branch"] = branch
+            common_app_server.save_session(session)
+            if mirrorCreated:
+                gitMirrorsRefreshed[repoUrl] = time.time()
+            else:
+                scheduleMirrorRefresh(repoUrl, useAuthentication, user, password)
         except (Exception, GitCommandError) as e:
             logger.error(str(e))
             common_app_server.invalidate_credentials(ssId)
@@ -220,12 +286,70 @@ async def handle_login(request):
 
 
 def git_clone_repository(repoUrl, branch, tmpDir, useAuthentication, user, password):
-    repo = git.Repo.init(tmpDir)
-    repo.create_remote("origin", url=repoUrl)
+    '''
+        Creates a session working directory in `tmpDir`. The clone shares the objects
+        of the server side mirror of `repoUrl` (see ensure_git_mirror), so that only the
+        changes since the last refresh of the mirror need to be fetched from `repoUrl`.
+        The local branch is reset to the fetched `branch`, as the clone creates it at
+        the (possibly outdated) commit of the mirror. Returns True if the mirror was
+        created by this call.
+    '''
+    (mirrorDir, created) = ensure_git_mirror(repoUrl, useAuthentication, user, password)
+    repo = git.Repo.clone_from(mirrorDir, tmpDir, shared=True, no_checkout=True)
+    repo.git.remote("set-url", "origin", repoUrl)
     if useAuthentication:
         configureGitCredentialHelper(repo, repoUrl, user, password)
     repo.git.fetch("origin", branch)
-    repo.git.checkout(branch)
+    repo.git.checkout("-B", branch, "origin/" + branch)
+    return created
+
+
+def getGitMirrorDir(repoUrl):
+    return os.path.join(GIT_MIRRORS_DIR, hashlib.sha1(repoUrl.encode("utf-8")).hexdigest() + ".git")
+
+
+def ensure_git_mirror(repoUrl, useAuthentication, user, password, refresh=False):
+    '''
+        Returns the tuple (path, created) of a bare mirror of `repoUrl` that is shared
+        by all sessions. The mirror is created if it doesn't exist yet (`created` is
+        True in this case) and fetched again if `refresh` is True. Automatic garbage
+        collection is disabled in the mirror as sessions refer to its objects.
+    '''
+    mirrorDir = getGitMirrorDir(repoUrl)
+    os.makedirs(GIT_MIRRORS_DIR, exist_ok=True)
+    with open(mirrorDir + ".lock", "w") as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        created = False
+        if not os.path.isdir(mirrorDir):
+            repo = git.Repo.init(mirrorDir, bare=True)
+            repo.git.config("gc.auto", "0")
+            repo.git.remote("add", "--mirror=fetch", "origin", repoUrl)
+            created = True
+        else:
+            repo = git.Repo(mirrorDir)
+        if created or refresh:
+            if useAuthentication:
+                configureGitCredentialHelper(repo, repoUrl, user, password)
+            repo.git.fetch("--prune", "origin")
+            logger.debug("{} git mirror of {} at {}".format("Created" if created else "Refreshed", repoUrl, mirrorDir))
+    return (mirrorDir, created)
+
+
+def scheduleMirrorRefresh(repoUrl, useAuthentication, user, password):
+    '''
+        Refreshes the git mirror of `repoUrl` in the background if it was not
+        refreshed during the last GIT_MIRROR_REFRESH_S seconds.
+    '''
+    now = time.time()
+    if now - gitMirrorsRefreshed.get(repoUrl, 0) < GIT_MIRROR_REFRESH_S:
+        return
+    gitMirrorsRefreshed[repoUrl] = now
+    future = ppe.submit(ensure_git_mirror, repoUrl, useAuthentication, user, password, refresh=True)
+    def logResult(f):
+        if f.exception():
+            logger.warning("Refreshing the git mirror of {} failed: {}".format(repoUrl, f.exception()))
+            gitMirrorsRefreshed.pop(repoUrl, None)
+    future.add_done_callback(logResult)
 
 
 async def handle_logout(request):
@@ -253,58 +377,116 @@ async def handle_latest_published_change(request):
 
 
 async def handle_list_changes(request):
-    session, cwd = None, None
+    cwd = None
     try:
-        session, cwd = validateSession(request)
+        unused_session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
-    repo = git.Repo(cwd)
-    published = getPublishedCommits(repo, session)
+    cursor, limit = None, MAX_GIT_LIST_CHANGES
+    try:
+        cursor = request.rel_url.query.get('cursor') or None
+        if cursor and not re.match(r"^[0-9a-f]{40}$", cursor):
+            raise IllegalArgumentException("Invalid cursor '{}'".format(cursor))
+        limit = min(max(int(request.rel_url.query.get('limit', MAX_GIT_LIST_CHANGES)), 1), MAX_GIT_LIST_CHANGES)
+    except Exception as e:
+        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
     logger.debug("Handling 'List Changes'")
-    res = await asyncio.wrap_future(ppe.submit(list_changes, published, cwd))
+    etag = await asyncio.wrap_future(tpe.submit(getListChangesETag, cwd, cursor, limit))
+    if etag and common_app_server.etag_matches(request, etag):
+        return web.Response(status=304, headers={ 'ETag': etag })
+    (res, nextCursor) = await asyncio.wrap_future(tpe.submit(list_changes, cwd, cursor, limit))
+    response = web.json_response(res)
+    if etag:
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = "no-cache"
+    if nextCursor:
+        response.headers['X-Next-Cursor'] = nextCursor
     logger.debug("Handling 'List Changes' finished")
-    return web.json_response(res)
+    return response
 
 
-def list_changes(publishedCommits, cwd):
-    res = []
-    count = MAX_GIT_LIST_CHANGES
-    repo = git.Repo(cwd)
-    c = repo.head.commit
-    while c and count > 0:
-        res.append(common_interfaces.VersionedChange(c, c.hexsha in publishedCommits))
-        c = c.parents[0] if len(c.parents) > 0 else None
-        count-=1
-    return res
+def getListChangesETag(cwd, cursor, limit):
+    '''
+        Returns an ETag for a page of the list of changes that changes whenever HEAD
+        or the tracking branch (which defines the published changes) changes.
+    '''
+    try:
+        repo = git.Repo(cwd)
+        remote = repo.head.ref.tracking_branch()
+        remoteSha = remote.commit.hexsha if remote and remote.is_valid() else ""
+        return '"{}"'.format(hashlib.sha1("{} {} {} {}".format(repo.head.commit.hexsha, remoteSha, cursor, limit).encode("utf-8")).hexdigest())
+    except (ValueError, TypeError, git.exc.GitError):
+        return None
 
 
-def getPublishedCommits(repo, session):
-    publishedCommitsLastHead = session.get("publishedCommitsLastHead")
-    publishedCommitsCache = session.get("publishedCommitsCache", set())
-    commits = set()
+def list_changes(cwd, cursor=None, limit=MAX_GIT_LIST_CHANGES):
+    '''
+        Returns a tuple of the list of (at most `limit`) first-parent changes starting
+        with HEAD or (if provided) with the parent of the change `cursor` and the cursor
+        for the next page (or None if there are no more changes).
+        The page is read from a single `git log` process whose output is parsed while
+        it is streamed.
+    '''
+    start = cursor or "HEAD"
+    skip = 1 if cursor else 0
+    repo = git.Repo(cwd)
+    unpublished = getUnpublishedCommits(repo, limit + 1, start, skip)
+    cmd = ["git", "log", "--first-parent", "--format=%H%x1f%an%x1f%at%x1f%B%x1e",
+           "--max-count={}".format(limit + 1), "--skip={}".format(skip), start, "--"]
+    res = list()
+    nextCursor = None
+    with subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE) as proc:
+        for (hexsha, author, date, message) in parseGitLogRecords(proc.stdout):
+            if len(res) == limit:
+                nextCursor = res[-1]['id']
+                break
+            published = unpublished != None and not hexsha in unpublished
+            res.append(common_interfaces.VersionedChangeData(hexsha, author, message, int(date), published))
+        proc.stdout.close()
+        proc.wait()
+    return (res, nextCursor)
+
+
+def parseGitLogRecords(stream, chunkSize=65536):
+    '''
+        Yields the tuples of fields of the records read incrementally from `stream`.
+        Records are separated by the ASCII record separator, fields by the unit separator.
+    '''
+    buf = b""
+    while True:
+        chunk = stream.read(chunkSize)
+        if not chunk:
+            break
+        buf += chunk
+        *records, buf = buf.split(b"\x1e")
+        for record in records:
+            yield tuple(record.lstrip(b"\n").decode("utf-8", errors="replace").split("\x1f", 3))
+
+
+def getUnpublishedCommits(repo, maxCount, start="HEAD", skip=0):
+    '''
+        Returns the set of hexshas of the (at most `maxCount`) first-parent commits of
+        `start` (skipping the first `skip` ones) that are not reachable from the tracking
+        branch, or None if there is no tracking branch. All other commits within this
+        window are published.
+    '''
     remote = repo.head.ref.tracking_branch()
-    if not remote or not remote.commit:
-        return commits
-    if remote.commit.hexsha == publishedCommitsLastHead:
-        return publishedCommitsCache
-    c = remote.commit if remote else None
-    while c:
-        commits.add(c.hexsha)
-        c = c.parents[0] if len(c.parents) > 0 else None
-    session['publishedCommitsCache'] = commits
-    session['publishedCommitsLastHead'] = remote.commit.hexsha
-    return commits
+    if not remote or not remote.is_valid():
+        return None
+    out = repo.git.rev_list("--first-parent", "--max-count={}".format(maxCount), "--skip={}".format(skip), start, "^{}".format(remote.path))
+    return set(out.split())
 
 
 async def handle_undo_last_change(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
     logger.info("Handling 'Undo last Change'")
     res = await asyncio.wrap_future(ppe.submit(undo_last_change, cwd))
+    invalidateCachedState(session)
     logger.debug("Handling 'Undo last Change' finished")
     return web.json_response(res)
 
@@ -327,11 +509,36 @@ def undo_last_change(cwd):
 
 
 async def handle_publish_changes(request):
-    cwd = None
+    (errorResponse, session, ssId, args) = prepareGitRemoteOperation(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Handling 'Publish Changes'")
+    res, auth_ok = await asyncio.wrap_future(ppe.submit(publish_changes, *args))
+    finishAuthenticatedOperation(session, ssId, auth_ok)
+    logger.debug("Handling 'Publish Changes' finished")
+    return web.json_response(res)
+
+
+async def handle_start_publish_changes(request):
+    (errorResponse, session, ssId, args) = prepareGitRemoteOperation(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Starting job 'Publish Changes'")
+    return startAuthenticatedJob("publishChanges", publish_changes, args, session, ssId)
+
+
+def prepareGitRemoteOperation(request):
+    '''
+        Validates the session and collects the arguments (repoUrl, useAuthentication, user,
+        password, cwd) needed for operations on the git server. Returns a tuple
+        (errorResponse, session, ssId, args) in which errorResponse is not None if the
+        operation can't be executed.
+    '''
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
-        return web.Response(text="Invalid Session: {}".format(e), status=401)
+        return (web.Response(text="Invalid Session: {}".format(e), status=401), None, None, None)
 
     repoUrl, credType, useAuthentication = None, None, None
     try:
@@ -340,20 +547,38 @@ async def handle_publish_changes(request):
         credType = config.get("CredentialType", "").upper()
         useAuthentication = len(credType) > 0
     except Exception as e:
-        return web.Response(text="Invalid Configuration: {}".format(e), status=500)
+        return (web.Response(text="Invalid Configuration: {}".format(e), status=500), None, None, None)
 
     user, password, ssId = "", "", None
     try:
         if useAuthentication:
             (user, password, ssId) = common_app_server.get_credentials(request, credType)
     except Exception as e:
-        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
-    logger.info("Handling 'Publish Changes'")
-    res, auth_ok = await asyncio.wrap_future(ppe.submit(publish_changes, repoUrl, useAuthentication, user, password, cwd))
+        return (web.Response(text="Illegal Arguments Provided: {}".format(e), status=400), None, None, None)
+    return (None, session, ssId, (repoUrl, useAuthentication, user, password, cwd))
+
+
+def finishAuthenticatedOperation(session, ssId, auth_ok):
     if not auth_ok:
         common_app_server.invalidate_credentials(ssId)
-    logger.debug("Handling 'Publish Changes' finished")
-    return web.json_response(res)
+    invalidateCachedState(session)
+
+
+def startAuthenticatedJob(name, func, args, session, ssId):
+    '''
+        Starts `func(*args)` (returning a tuple of log entries and auth_ok) as a job and
+        returns a response containing the job info. The log entries are the job's result.
+    '''
+    def onDone(result):
+        if not result:
+            # `func` raised an exception that is already reported as the job's failure
+            invalidateCachedState(session)
+            return []
+        (res, auth_ok) = result
+        finishAuthenticatedOperation(session, ssId, auth_ok)
+        return res
+    job = common_jobs.start_job(ppe, name, func, *args, owner=session['id'], onDone=onDone)
+    return web.json_response(common_interfaces.JobInfo(job, withLogs=False))
 
 
 def publish_changes(repoUrl, useAuthentication, user, password, cwd):
@@ -374,9 +599,9 @@ def publish_changes(repoUrl, useAuthentication, user, password, cwd):
 
 
 async def handle_mark_for_status(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
@@ -384,6 +609,8 @@ async def handle_mark_for_status(request):
     ids = json.loads(request.rel_url.query['bundles'])
     logger.info("Mark for status: {} --> {}".format(ids, status))
     res = await asyncio.wrap_future(ppe.submit(mark_bundles_for_status, ids, status, cwd))
+    invalidateCachedState(session)
+    scheduleBundlePackageIndexUpdate(cwd)
     logger.debug("Mark for status finished")
     return web.json_response(res)
 
@@ -394,6 +621,11 @@ def mark_bundles_for_status(bundleIds, status, cwd):
         try:
             repo = git.Repo(cwd)
             ensure_clean_git_repo(repo)
+            # the frontend has no way to confirm conflicts, so they are only reported.
+            # Scanning suites is too expensive for a request, so we use the package index
+            # as it is and update it in the background (see handle_mark_for_status()).
+            for conflict in findConflicts(bundleIds, status, cwd=cwd, update=False):
+                logger.warning(conflict)
             bundles = parseBundles(cwd=cwd)
             reprepro_bundle_compose.markBundlesForStatus(bundles, bundleIds, status, force=True, checkOwnSuite=False, cwd=cwd)
             msg = "MARKED for status '{}'\n\n - {}".format(status, "\n - ".join(sorted(bundleIds)))
@@ -408,9 +640,9 @@ def mark_bundles_for_status(bundleIds, status, cwd):
 
 
 async def handle_set_target(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
@@ -421,6 +653,7 @@ async def handle_set_target(request):
         ignoreTargetFromInfoFile = (ignoreTargetFromInfoFile.lower() == "true")
     logger.info("Mark for target: {} --> {}".format(ids, target))
     res = await asyncio.wrap_future(ppe.submit(mark_bundles_for_target, set(ids), target, ignoreTargetFromInfoFile, cwd))
+    invalidateCachedState(session)
     logger.debug("Mark for target finished")
     return web.json_response(res)
 
@@ -445,38 +678,40 @@ def mark_bundles_for_target(bundleIds, target, ignoreTargetFromInfoFile, cwd):
 
 
 async def handle_git_pull_rebase(request):
-    cwd = None
+    (errorResponse, session, ssId, args) = prepareGitRemoteOperation(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Updating git-repository from the git-server")
     try:
-        unused_session, cwd = validateSession(request)
-    except Exception as e:
-        return web.Response(text="Invalid Session: {}".format(e), status=401)
+        res, auth_ok = await asyncio.wrap_future(ppe.submit(git_pull_rebase, *args))
+    except RebaseConflictException as e:
+        invalidateCachedState(session)
+        return web.Response(text=str(e), status=409)
+    finishAuthenticatedOperation(session, ssId, auth_ok)
+    return web.json_response(res)
 
-    logger.info("Updating git-repository from the git-server")
 
-    repoUrl, credType, useAuthentication = None, None, None
-    try:
-        config = getGitRepoConfig(required=True, cwd=cwd)
-        repoUrl = config["RepoUrl"]
-        credType = config.get("CredentialType", "").upper()
-        useAuthentication = len(credType) > 0
-    except Exception as e:
-        return web.Response(text="Invalid Configuration: {}".format(e), status=500)
+async def handle_start_git_pull_rebase(request):
+    (errorResponse, session, ssId, args) = prepareGitRemoteOperation(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Starting job 'Update git-repository from the git-server'")
+    return startAuthenticatedJob("gitPullRebase", git_pull_rebase, args, session, ssId)
 
-    user, password, ssId = "", "", None
-    try:
-        if useAuthentication:
-            (user, password, ssId) = common_app_server.get_credentials(request, credType)
-    except Exception as e:
-        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
-    res, auth_ok = await asyncio.wrap_future(ppe.submit(git_pull_rebase, repoUrl, useAuthentication, user, password, cwd))
-    if not auth_ok:
-        common_app_server.invalidate_credentials(ssId)
-    return web.json_response(res)
+
+class RebaseConflictException(Exception):
+    def __init__(self, msg="Rebase is not possible due to merge-conflicts! Please UNDO your local changes and try again!"):
+        Exception.__init__(self, msg)
 
 
 def git_pull_rebase(repoUrl, useAuthentication, user, password, cwd):
+    '''
+        Returns a tuple of the log entries and auth_ok. Raises a RebaseConflictException
+        if the local changes could not be rebased (the rebase is aborted in this case).
+    '''
     res = []
     auth_ok = True
+    conflict = False
     with common_app_server.logging_redirect_for_webapp() as logs:
         try:
             repo = git.Repo(cwd)
@@ -485,25 +720,46 @@ def git_pull_rebase(repoUrl, useAuthentication, user, password, cwd):
             repo.git.fetch()
             try:
                 repo.git.rebase()
+                logger.info("Successfully pulled changes and rebased your repository")
             except GitCommandError as e:
                 repo.git.rebase("--abort")
-                return web.Response(text="Rebase is not possible due to merge-conflicts! Please UNDO your local changes and try again!", status=409)
-            logger.info("Successfully pulled changes and rebased your repository")
+                conflict = True
         except (Exception, GitCommandError) as e:
             logger.error("Updating git-repository from the git-server failed:\n{}".format(e))
             auth_ok = False
         res = logs.toBackendLogEntryList()
+    if conflict:
+        raise RebaseConflictException()
     return res, auth_ok
 
 
 async def handle_update_bundles(request):
-    cwd = None
+    (errorResponse, session, ssId, args) = await prepareUpdateBundles(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Handling 'Update Bundles'")
+    res, auth_ok = await asyncio.wrap_future(ppe.submit(update_bundles, *args))
+    finishAuthenticatedOperation(session, ssId, auth_ok)
+    logger.debug("Handling 'Update Bundles' finished")
+    return web.json_response(res)
+
+
+async def handle_start_update_bundles(request):
+    (errorResponse, session, ssId, args) = await prepareUpdateBundles(request)
+    if errorResponse:
+        return errorResponse
+    logger.info("Starting job 'Update Bundles'")
+    return startAuthenticatedJob("updateBundles", update_bundles, args, session, ssId)
+
+
+async def prepareUpdateBundles(request):
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
-        return web.Response(text="Invalid Session: {}".format(e), status=401)
+        return (web.Response(text="Invalid Session: {}".format(e), status=401), None, None, None)
 
-    config = getTracConfig(cwd=cwd)
+    config = await getCachedState(session, cwd, 'tracConfig', lambda: getTracConfig(cwd=cwd))
     tracUrl  = config.get("TracUrl")
     credType = config.get("CredentialType", "").upper()
     parentTicketsField = config.get('UseParentTicketsFromInfoField')
@@ -514,13 +770,7 @@ async def handle_update_bundles(request):
             (user, password, ssId) = common_app_server.get_credentials(request, credType)
     except Exception as e:
         '''Credentials are not mandatory for update_bundles - so just pass'''
-
-    logger.info("Handling 'Update Bundles'")
-    res, auth_ok = await asyncio.wrap_future(ppe.submit(update_bundles, useAuthentication, user, password, tracUrl, parentTicketsField, cwd))
-    if not auth_ok:
-        common_app_server.invalidate_credentials(ssId)
-    logger.debug("Handling 'Update Bundles' finished")
-    return web.json_response(res)
+    return (None, session, ssId, (useAuthentication, user, password, tracUrl, parentTicketsField, cwd))
 
 
 def update_bundles(useAuthentication, user, password, tracUrl, parentTicketsField, cwd):
@@ -539,8 +789,9 @@ def update_bundles(useAuthentication, user, password, tracUrl, parentTicketsFiel
                     auth_ok = False
             except KeyError as e:
                 logger.warn("Missing Key {} in local trac configuration --> no synchronization with trac will be done!".format(e))
-            reprepro_bundle_compose.updateBundles(tracApi, parentTicketsField=parentTicketsField, cwd=cwd)
-            git_commit(repo, [BUNDLES_LIST_FILE], "UPDATED {}".format(BUNDLES_LIST_FILE))
+            reprepro_bundle_compose.updateBundles(tracApi, parentTicketsField=parentTicketsField, cwd=cwd, progress=common_jobs.reportProgress)
+            changedFiles = [f for f in [BUNDLES_LIST_FILE, BUNDLES_ARCHIVE_FILE] if os.path.isfile(os.path.join(cwd, f))]
+            git_commit(repo, changedFiles, "UPDATED {}".format(BUNDLES_LIST_FILE))
         except GitNotCleanException as e:
             logger.error(e)
         except Exception as e:
@@ -552,15 +803,19 @@ def update_bundles(useAuthentication, user, password, tracUrl, parentTicketsFiel
 
 
 async def handle_get_managed_bundles(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
     # faster (doesn't need to query apt-repos and resolve info file)
     logger.debug("handle_get_managed_bundles called")
-    res = await asyncio.wrap_future(ppe.submit(get_managed_bundles, cwd))
+    cache = await getStateCache(session, cwd)
+    res = cache.get('managedBundles')
+    if res == None:
+        res = await asyncio.wrap_future(ppe.submit(get_managed_bundles, cwd))
+        cache['managedBundles'] = res
     logger.debug("handle_get_managed_bundles finished")
     return web.json_response(res)
 
@@ -575,22 +830,27 @@ def get_managed_bundles(cwd):
 
 
 async def handle_get_managed_bundle_infos(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
     # slower (as it needs to resolve info files)
     ids = common_interfaces.BundleIDs_validate(json.loads(request.rel_url.query['bundles']))
     logger.debug("handle_get_managed_bundle_infos called, ids='{}'".format("', '".join(ids)))
-    res = await asyncio.wrap_future(ppe.submit(get_managed_bundle_infos, set(ids), cwd=cwd))
+    infos = (await getStateCache(session, cwd)).setdefault('managedBundleInfos', dict())
+    missing = set(ids).difference(infos.keys())
+    if len(missing) > 0:
+        for info in await asyncio.wrap_future(ppe.submit(get_managed_bundle_infos, missing, cwd=cwd)):
+            infos[info['id']] = info
+    res = [ infos[bid] for bid in ids if bid in infos ]
     logger.debug("handle_get_managed_bundle_infos finished")
     return web.json_response(res)
 
 
 def get_managed_bundle_infos(bundleIds, cwd):
-    repoSuites = getBundleRepoSuites(bundleIds, cwd=cwd)
+    repoSuites = getBundleRepoSuites(bundleIds, cwd=cwd, context=AptReposContext.forProject(cwd))
     bundles = parseBundles(repoSuites, selectIds=[str(s) for s in repoSuites], cwd=cwd)
     tracUrl = getTracConfig(cwd=cwd).get('TracUrl')
     res = [ common_interfaces.ManagedBundleInfo(bundle, tracBaseUrl = tracUrl)
@@ -599,18 +859,47 @@ def get_managed_bundle_infos(bundleIds, cwd):
 
 
 async def handle_get_configured_stages(request):
-    cwd = None
+    session, cwd = None, None
     try:
-        unused_session, cwd = validateSession(request)
+        session, cwd = validateSession(request)
     except Exception as e:
         return web.Response(text="Invalid Session: {}".format(e), status=401)
 
+    cache = await getStateCache(session, cwd)
+    res = cache.get('configuredStages')
+    if res == None:
+        res = await asyncio.wrap_future(tpe.submit(get_configured_stages, cwd))
+        cache['configuredStages'] = res
+    return web.json_response(res)
+
+
+def get_configured_stages(cwd):
+    '''
+        Returns the list of stages for which target suites are configured. The result is
+        cached per apt-repos base dir as long as the fingerprint of it's configuration
+        (see SuiteResolver.getFingerprint()) doesn't change. At most
+        MAX_CONFIGURED_STAGES_CACHE base dirs are cached.
+    '''
+    context = AptReposContext.forProject(cwd)
+    baseDir = context.getBaseDir()
+    fingerprint = getSuiteResolver(baseDir).getFingerprint()
+    with configuredStagesLock:
+        cached = configuredStagesCache.get(baseDir)
+        if cached and cached[0] == fingerprint:
+            configuredStagesCache.move_to_end(baseDir)
+            return list(cached[1])
     res = list()
+    targets = getTargetRepoSuites(cwd=cwd, context=context)
     for stage in sorted(BundleStatus.getAvailableStages()):
-        targets = getTargetRepoSuites(stage, cwd=cwd)
-        if len(targets) > 0:
+        stageTag = "bundle-stage.{}".format(stage)
+        if any(stageTag in target.getTags() for target in targets.values()):
             res.append(stage)
-    return web.json_response(res)
+    with configuredStagesLock:
+        configuredStagesCache[baseDir] = (fingerprint, res)
+        configuredStagesCache.move_to_end(baseDir)
+        while len(configuredStagesCache) > MAX_CONFIGURED_STAGES_CACHE:
+            configuredStagesCache.popitem(last=False)
+    return list(res)
 
 
 async def handle_get_configured_targets(request):
@@ -687,6 +976,80 @@ def validateSession(request):
     return session, cwd
 
 
+async def getStateCache(session, cwd):
+    '''
+        Returns the dict that caches parsed state (bundles, configs, ...) for the
+        session's working directory `cwd`. The cache is dropped as soon as the key
+        returned by getStateCacheKey() changes.
+    '''
+    key = await asyncio.wrap_future(tpe.submit(getStateCacheKey, cwd))
+    cache = session.get('stateCache')
+    if not cache or cache['key'] != key:
+        cache = { 'key': key }
+        session['stateCache'] = cache
+    return cache
+
+
+def getStateCacheKey(cwd):
+    '''
+        Returns the tuple (head, mtime, fingerprint) of the HEAD commit of the working
+        directory `cwd`, the mtime of its BUNDLES_LIST_FILE and a checksum of the
+        fingerprint of its apt-repos configuration (see SuiteResolver.getFingerprint()).
+        This function accesses the file system and should be run in the tpe.
+    '''
+    head, mtime = None, None
+    try:
+        head = git.Repo(cwd).head.commit.hexsha
+    except (ValueError, git.exc.GitError):
+        pass
+    try:
+        mtime = os.stat(os.path.join(cwd, BUNDLES_LIST_FILE)).st_mtime_ns
+    except FileNotFoundError:
+        pass
+    fingerprint = getSuiteResolver(AptReposContext.forProject(cwd).getBaseDir()).getFingerprint()
+    return (head, mtime, hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest())
+
+
+async def getStateETagKey(request):
+    '''
+        ETag key for responses that only depend on the state of the session's working
+        directory (see getStateCacheKey()).
+    '''
+    unused_session, cwd = validateSession(request)
+    (head, mtime, fingerprint) = await asyncio.wrap_future(tpe.submit(getStateCacheKey, cwd))
+    return "{}:{}:{}".format(head, mtime, fingerprint) if head else None
+
+
+async def getAptReposETagKey(request):
+    '''
+        ETag key for responses that only depend on the apt-repos configuration
+        of the session's working directory.
+    '''
+    unused_session, cwd = validateSession(request)
+    baseDir = AptReposContext.forProject(cwd).getBaseDir()
+    fingerprint = await asyncio.wrap_future(tpe.submit(getSuiteResolver(baseDir).getFingerprint))
+    return hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest()
+
+
+async def getCachedState(session, cwd, name, compute):
+    '''
+        Returns the cached value `name` from the session's state cache or
+        computes (and caches) it by calling `compute`.
+    '''
+    cache = await getStateCache(session, cwd)
+    if not name in cache:
+        cache[name] = compute()
+    return cache[name]
+
+
+def invalidateCachedState(session):
+    session.pop('stateCache', None)
+    cwd = session.get('cwd')
+    if cwd:
+        # the operation could have changed the apt-repos configuration (e.g. git pull)
+        getSuiteResolver(AptReposContext.forProject(cwd).getBaseDir()).invalidate()
+
+
 def createSession(cwd):
     session = common_app_server.create_session(sessionExpired)
     session['cwd'] = cwd
@@ -704,10 +1067,17 @@ def sessionExpired(session):
 
 
 def registerRoutes(args, app):
+    common_app_server.register_cacheable_route('/api/managedBundles', getStateETagKey)
+    common_app_server.register_cacheable_route('/api/managedBundleInfos', getStateETagKey)
+    common_app_server.register_cacheable_route('/api/getSuites', getAptReposETagKey)
+    common_app_server.register_cacheable_route('/api/workflowMetadata')
+    common_app_server.register_cacheable_route('/api/getCustomPackages')
     app.router.add_routes([
         # api routes
         web.get('/api/getSuites', handle_get_suites),
+        common_app_server.metrics_route(validateSession),
         web.get('/api/getCustomPackages', handle_get_custom_packages),
+        web.get('/api/whichBundles', handle_which_bundles),
         web.get('/api/workflowMetadata', handle_get_workflow_metadata),
         web.get('/api/configuredStages', handle_get_configured_stages),
         web.get('/api/configuredTargets', handle_get_configured_targets),
@@ -718,6 +1088,9 @@ def registerRoutes(args, app):
         web.get('/api/markForStatus', handle_mark_for_status),
         web.get('/api/setTarget', handle_set_target),
         web.get('/api/listChanges', handle_list_changes),
+        web.post('/api/jobs/updateBundles', handle_start_update_bundles),
+        web.post('/api/jobs/publishChanges', handle_start_publish_changes),
+        web.post('/api/jobs/gitPullRebase', handle_start_git_pull_rebase),
         web.get('/api/latestPublishedChange', handle_latest_published_change),
         web.get('/api/undoLastChange', handle_undo_last_change),
         web.get('/api/publishChanges', handle_publish_changes),
@@ -745,8 +1118,13 @@ if __name__ == "__main__":
         # A ProcessPoolExecutor is required (instead of ThreadPoolExecutor)
         # because apt-repo's suite.scan() uses global scope and only the
         # ProcessPoolExecutor separates these global scopes correctly.
-        with concurrent.futures.ProcessPoolExecutor(max_workers=5) as __ppe:
+        # Pure suite lookups are done via an AptReposContext, which is
+        # thread-safe, so they can use the cheaper ThreadPoolExecutor.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=5) as __ppe, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=5) as __tpe:
             ppe = __ppe
+            tpe = __tpe
+            packageIndexCache = PackageIndexCache(ppe, tpe)
             common_app_server.mainLoop(
                 progname = progname,
                 description =  __doc__,
@@ -0,0 +1,67 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+import os
+import copy
+import logging
+from reprepro_bundle.suite_resolver import getSuiteResolver
+
+logger = logging.getLogger(__name__)
+
+
+class AptReposContext:
+    '''
+        This class holds the apt-repos base directory of a project (typically the
+        folder `.apt-repos` inside the project). A context is passed explicitly to
+        functions that need to lookup apt-repos suites, so that these functions don't
+        depend on the global base directory of the apt_repos module.
+
+        All contexts for the same base directory share one SuiteResolver. Reading the
+        apt-repos configuration uses the global state of the apt_repos module and is
+        therefore serialized by a process wide lock, but this only happens if the
+        configuration changed (see SuiteResolver). The suites returned by getSuites()
+        are copies of the cached suites, so callers can scan() them without affecting
+        other callers. Scanning itself still uses apt_pkg's global state, so suites
+        should only be scanned in separate processes (see ppe in the app servers).
+    '''
+
+    def __init__(self, baseDir):
+        self.__baseDir = baseDir
+        self.__resolver = getSuiteResolver(baseDir)
+
+    @staticmethod
+    def forProject(cwd):
+        '''
+            Returns a new AptReposContext for the `.apt-repos` folder of the project `cwd`.
+        '''
+        return AptReposContext(os.path.join(cwd, ".apt-repos"))
+
+    def getBaseDir(self):
+        return self.__baseDir
+
+    def getSuites(self, selectors):
+        '''
+            Returns a sorted list of the apt_repos.RepoSuite objects matching the list of
+            suite `selectors` (e.g. ["bundle:"]). The returned suites are owned by the
+            caller.
+        '''
+        return [ copy.copy(suite) for suite in self.__resolver.getSuites(selectors) ]
+
+    def clearCache(self):
+        self.__resolver.clearCache()
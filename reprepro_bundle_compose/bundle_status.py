@@ -32,6 +32,7 @@ class BundleStatus(Enum):
         - tracStatus: propose a bundle for this status if the corresponding trac ticket is in this status.
         - tracResolution: if provided, the status is only proposed if both, tracStatus and tracResolution match.
         - override: the status can be automatically replaced by a better matching status. Don't set it for Status that is manually controlled.
+        - terminal: the bundle will not leave this status any more, so it could be moved to the archive after some time.
         - comment: comments the status
     '''
 
@@ -69,11 +70,11 @@ class BundleStatus(Enum):
         The bundle is visible in the `test`-Teststufe and under test by customers.
     '''}
 
-    PRODUCTION = { 'ord': 8, 'stage': 'prod', 'candidates': 'TEST_CUST', 'tracStatus': 'closed', 'tracResolution': 'fixed', 'comment': '''
+    PRODUCTION = { 'ord': 8, 'stage': 'prod', 'candidates': 'TEST_CUST', 'tracStatus': 'closed', 'tracResolution': 'fixed', 'terminal': True, 'comment': '''
         The bundle succesfully finished the customer tests and is now available for production.
     '''}
 
-    DROPPED = { 'ord': 9, 'stage': 'drop', 'tracStatus': 'closed', 'tracResolution': 'invalid', 'override': False, 'comment': '''
+    DROPPED = { 'ord': 9, 'stage': 'drop', 'tracStatus': 'closed', 'tracResolution': 'invalid', 'override': False, 'terminal': True, 'comment': '''
         A test for the bundle failed and the bundle has to be dropped.
         A new bundle has to be created instead of fixing the old one.
     '''}
@@ -101,6 +102,10 @@ class BundleStatus(Enum):
         # pylint: disable=E1101
         return self.value.get('override', False)
 
+    def isTerminal(self):
+        # pylint: disable=E1101
+        return self.value.get('terminal', False)
+
     def __hash__(self):
         return hash(self.value)
 
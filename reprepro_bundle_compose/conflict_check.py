@@ -0,0 +1,163 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module checks a proposed status change of bundles for binary packages
+   that conflict with the packages of the other bundles and the bundle-base
+   suites of the same target.
+'''
+
+import logging
+import apt_pkg
+from reprepro_bundle_compose import PROJECT_DIR, getBundleRepoSuites, getTargetRepoSuites, getTargetKeys, getBaseDist, parseBundles
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
+from reprepro_bundle_compose.package_index import PACKAGE_INDEX_FILE, getBundlePackageIndex
+
+logger = logging.getLogger(__name__)
+
+
+def compareVersions(a, b):
+    try:
+        return apt_pkg.version_compare(a, b)
+    except ValueError:
+        # apt_pkg is not initialized if no suite was scanned in this process
+        apt_pkg.init()
+        return apt_pkg.version_compare(a, b)
+
+
+class PackageConflict:
+    '''
+        Describes the binary package `packageName` of the bundle `bundleId` that is
+        provided in a different version by `otherId` (another bundle or a bundle-base
+        suite) within the target key `targetKey` (stage, dist, target). The conflict
+        is a downgrade if the bundle's version is lower than the other version.
+    '''
+
+    def __init__(self, bundleId, packageName, architecture, version, otherId, otherVersion, targetKey):
+        self.bundleId = bundleId
+        self.packageName = packageName
+        self.architecture = architecture
+        self.version = version
+        self.otherId = otherId
+        self.otherVersion = otherVersion
+        self.targetKey = targetKey
+
+    def isDowngrade(self):
+        return compareVersions(self.version, self.otherVersion) < 0
+
+    def __str__(self):
+        return "{} provides {} {} ({}) which {} {} from {} in target '{}'".format(
+            self.bundleId, self.packageName, self.version, self.architecture,
+            "downgrades" if self.isDowngrade() else "conflicts with",
+            self.otherVersion, self.otherId, "/".join(str(k) for k in self.targetKey))
+
+
+def findConflicts(bundleIds, status, cwd=PROJECT_DIR, context=None, update=True, indexFile=PACKAGE_INDEX_FILE):
+    '''
+        Returns the sorted list of PackageConflicts caused by putting the bundles
+        `bundleIds` into the status `status`. A bundle conflicts with
+
+        * every bundle already in the destination stage and target (or also changed
+          by this call) that provides one of it's binary packages in another version and
+        * the bundle-base suites of the target suites for this stage and target, if
+          they provide one of it's binary packages in a higher version (downgrade).
+
+        Bundles accumulate in terminal stages (like 'prod') and the target provides
+        the highest version of a package. So for terminal stages, only downgrades
+        against the highest version of the other bundles are reported.
+
+        Only stages and targets for which target suites are configured are checked. The
+        packages are taken from the BundlePackageIndex, which is updated for the involved
+        suites before if `update` is True.
+    '''
+    stage = status.getStage()
+    if not stage:
+        return []
+    context = context or AptReposContext.forProject(cwd)
+    repoSuites = getBundleRepoSuites(cwd=cwd, context=context)
+    # archived bundles in status 'production' are still part of their targets
+    bundles = parseBundles(repoSuites, cwd=cwd, includeArchived=True)
+
+    changed = dict() # of target key to the list of bundles changed into this key
+    for bid in sorted(set(bundleIds)):
+        bundle = bundles.get(bid)
+        if not bundle or bundle.getStatus() == status or not bid in repoSuites:
+            continue
+        (unused_stage, dist, target) = bundle.getTargetKey()
+        changed.setdefault((stage, dist, target), list()).append(bundle)
+
+    baseDists = dict() # of target key to the set of base-dists of it's target suites
+    for (unused_name, targetSuite) in sorted(getTargetRepoSuites(stage=stage, context=context).items()):
+        for key in getTargetKeys(targetSuite).intersection(changed.keys()):
+            baseDist = getBaseDist(targetSuite)
+            if baseDist:
+                baseDists.setdefault(key, set()).add(baseDist)
+    changedIds = set(b.getID() for key in changed for b in changed[key])
+    members = dict() # of target key to the list of bundle IDs already in this key
+    for (bid, bundle) in sorted(bundles.items()):
+        key = bundle.getTargetKey()
+        if key in baseDists and bid in repoSuites and not bid in changedIds:
+            members.setdefault(key, list()).append(bid)
+    baseSuites = dict() # of base-dist to the dict of suite name to bundle-base suite
+    for dist in set(d for key in baseDists for d in baseDists[key]):
+        baseSuites[dist] = dict((s.getSuiteName(), s) for s in context.getSuites(["bundle-base.{}:".format(dist)]))
+
+    index = getBundlePackageIndex(indexFile)
+    if update:
+        involved = changedIds.union(bid for key in members for bid in members[key])
+        index.update(dict((bid, repoSuites[bid]) for bid in involved), bundles)
+        for suites in baseSuites.values():
+            index.update(suites, None)
+
+    onlyDowngrades = status.isTerminal()
+    res = list()
+    for key in sorted(baseDists.keys(), key=str):
+        others = dict() # of (name, architecture) to list of (bundle ID, version)
+        for bid in members.get(key, []):
+            for (name, version, architecture, unused_source) in index.getPackages(repoSuites[bid]):
+                others.setdefault((name, architecture), list()).append((bid, version))
+        highestBase = dict() # of (name, architecture) to (suite name, version)
+        for dist in sorted(baseDists[key]):
+            for (suiteName, suite) in sorted(baseSuites[dist].items()):
+                for (name, version, architecture, unused_source) in index.getPackages(suite):
+                    current = highestBase.get((name, architecture))
+                    if not current or compareVersions(version, current[1]) > 0:
+                        highestBase[(name, architecture)] = (suiteName, version)
+        for bundle in changed[key]:
+            bid = bundle.getID()
+            packages = index.getPackages(repoSuites[bid])
+            for (name, version, architecture, unused_source) in packages:
+                candidates = others.get((name, architecture), [])
+                if onlyDowngrades and len(candidates) > 0:
+                    highest = candidates[0]
+                    for candidate in candidates[1:]:
+                        if compareVersions(candidate[1], highest[1]) > 0:
+                            highest = candidate
+                    candidates = [ highest ] if compareVersions(version, highest[1]) < 0 else []
+                for (otherId, otherVersion) in candidates:
+                    if compareVersions(version, otherVersion) != 0:
+                        res.append(PackageConflict(bid, name, architecture, version, otherId, otherVersion, key))
+                base = highestBase.get((name, architecture))
+                if base and compareVersions(version, base[1]) < 0:
+                    res.append(PackageConflict(bid, name, architecture, version, base[0], base[1], key))
+            # bundles changed by the same call must not conflict with each other
+            for (name, version, architecture, unused_source) in packages:
+                others.setdefault((name, architecture), list()).append((bid, version))
+    logger.debug("Found {} package conflicts for status '{}'".format(len(res), status))
+    return sorted(res, key=lambda c: (c.bundleId, c.packageName, c.architecture, c.otherId))
@@ -43,7 +43,7 @@ class ManagedBundle:
         and to modify single aspekts of the TagSection. It also provided methods to access information
         from the corresponding RepoSuite-object.
     '''
-    BUNDLE_KEYS = [ "ID", "Status", "Target", "Trac", "Ignores" ]
+    BUNDLE_KEYS = [ "ID", "Status", "Target", "Trac", "Ignores", "Terminal-Since" ]
 
     def __init__(self, tagSection, repoSuite=None):
         self.__repoSuite = repoSuite
@@ -54,6 +54,7 @@ class ManagedBundle:
             self.__target = tagSection['Target']
             self.__trac = tagSection.get('Trac', None)
             self.__ignores = str(tagSection.get('Ignores') or "").split(" ")
+            self.__terminalSince = tagSection.get('Terminal-Since', None)
         elif repoSuite:
             self.__id = repoSuite.getSuiteName()
             self.__tagSection = apt_pkg.TagSection("ID: {}\n".format(self.__id))
@@ -61,6 +62,7 @@ class ManagedBundle:
             self.__target = self.getInfo().get("Target", "unknown")
             self.__trac = None
             self.__ignores = []
+            self.__terminalSince = None
 
     def getInfoFileUrl(self):
         return urljoin(self.__repoSuite.getRepoUrl(), os.path.join('conf', 'info'))
@@ -111,6 +113,14 @@ class ManagedBundle:
                "bundle-dist.{}".format(self.getAptSuite()) in tags and \
                "bundle-target.{}".format(self.getTarget()) in tags
 
+    def getTargetKey(self):
+        '''
+            Returns the tuple (stage, dist, target) that is compared with the values of
+            the "bundle-stage.*", "bundle-dist.*" and "bundle-target.*" tags of target
+            suites (see isSupposedForTarget).
+        '''
+        return (self.getStatus().getStage(), self.getAptSuite(), self.getTarget())
+
     def getID(self):
         return self.__id
 
@@ -149,6 +159,13 @@ class ManagedBundle:
     def getIgnores(self):
         return self.__ignores
 
+    def getTerminalSince(self):
+        '''
+            Returns the date (in the form YYYY-MM-DD) at which the bundle was first seen
+            in a terminal status or None if this date is not known.
+        '''
+        return self.__terminalSince
+
     def setRepoSuite(self, repoSuite):
         self.__repoSuite = repoSuite
 
@@ -161,6 +178,9 @@ class ManagedBundle:
     def setTrac(self, tid):
         self.__trac = str(tid)
 
+    def setTerminalSince(self, date):
+        self.__terminalSince = date
+
     def setIgnoreTargetFromInfoFile(self, ignore=True):
         if ignore:
             if not self.ignoresTargetFromInfoFile():
@@ -181,6 +201,7 @@ class ManagedBundle:
             changeset.append(('Ignores', " ".join(self.__ignores)))
         else:
             changeset.append(('Ignores', None))
+        changeset.append(('Terminal-Since', self.__terminalSince))
         return apt_pkg.rewrite_section(self.__tagSection, self.BUNDLE_KEYS, changeset)
 
     def __str__(self):
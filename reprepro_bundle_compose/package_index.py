@@ -0,0 +1,261 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module contains the reverse index of binary and source package names to
+   the bundles providing them.
+'''
+
+import os
+import json
+import time
+import logging
+import concurrent.futures
+import contextvars
+from apt_repos import PackageField
+from reprepro_bundle_compose import PROJECT_DIR, BundleStatus, getBundleRepoSuites, getTargetRepoSuites, getBaseDist, parseBundles
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
+from reprepro_bundle_compose.package_search import getSuiteKey, getReleaseStamp
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_INDEX_FILE = os.path.join(os.path.expanduser("~"), ".cache", "bundle-compose", "package-index.json")
+PACKAGE_INDEX_FORMAT = 1
+# unsealed suites are checked for changes at most once in this interval
+PACKAGE_INDEX_CHECK_INTERVAL_S = 60
+# suites without a usable Release stamp are scanned again after this time
+PACKAGE_INDEX_TTL_S = 5*60
+MAX_PARALLEL_CHECKS = 8
+
+__indexes = dict() # of realpath of the index file to BundlePackageIndex
+
+
+def getBundlePackageIndex(filename=PACKAGE_INDEX_FILE):
+    '''
+        Returns the (shared) BundlePackageIndex stored in `filename`.
+    '''
+    global __indexes
+    path = os.path.realpath(filename)
+    index = __indexes.get(path)
+    if not index:
+        index = BundlePackageIndex(path)
+        __indexes[path] = index
+    return index
+
+
+def scanBundlePackages(suite):
+    '''
+        Returns the packages of the bundle suite `suite` as a sorted list of
+        [name, version, architecture, sourcePackageName].
+    '''
+    suite.scan(True)
+    res = list()
+    for package in suite.queryPackages(['.'], True, None, None, PackageField.getByFieldsString("pvaC")):
+        (name, version, architecture, source) = package.getData()
+        res.append([name, version, architecture, source])
+    return sorted(res)
+
+
+def isSealed(bid, suite, bundles):
+    '''
+        A bundle is sealed (so it's content will never change again) if it left the
+        status STAGING. Bundles not (yet) known in the bundles file are sealed if
+        their suite is not tagged as 'staging'. Suites that are no bundles (`bundles`
+        is None) are never sealed.
+    '''
+    if bundles is None:
+        return False
+    bundle = bundles.get(bid)
+    if bundle:
+        return bundle.getStatus() > BundleStatus.STAGING
+    return not BundleStatus.STAGING.getRepoSuiteTag() in suite.getTags()
+
+
+class BundlePackageIndex:
+    '''
+        This class describes the packages provided by each bundle suite. Suites are
+        identified by their suite key (see package_search.getSuiteKey()), so that the
+        index file could be shared by all working directories of a project.
+
+        The index is updated incrementally: sealed bundles are scanned only once, other
+        bundles are only scanned again if their Release file changed (or, if that can't
+        be determined, after PACKAGE_INDEX_TTL_S seconds). The index is stored as a json
+        file, which is loaded again as soon as another process changed it. A reverse
+        index of package names to the suites providing them is built in memory on demand.
+    '''
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__stat = None
+        self.__suites = dict() # of suite key (as json string) to dict with 'bundle', 'sealed', 'stamp', 'scanned' and 'packages'
+        self.__checked = dict() # of suite key to the time of the last check for changes
+        self.__reverse = None # of package name to list of (suite key, package)
+        self.__reload()
+
+    def __fileStat(self):
+        try:
+            st = os.stat(self.__filename)
+            return (st.st_size, st.st_mtime_ns, st.st_ino)
+        except FileNotFoundError:
+            return None
+
+    def __reload(self):
+        stat = self.__fileStat()
+        if stat == self.__stat:
+            return
+        self.__stat = stat
+        self.__reverse = None
+        if not stat:
+            return
+        try:
+            with open(self.__filename, encoding="utf-8") as fh:
+                data = json.load(fh)
+            if data.get('format') == PACKAGE_INDEX_FORMAT:
+                self.__suites = data['suites']
+            logger.debug("Loaded package index of {} bundle suites from {}".format(len(self.__suites), self.__filename))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Ignoring invalid package index {}: {}".format(self.__filename, e))
+
+    def __save(self):
+        os.makedirs(os.path.dirname(self.__filename), exist_ok=True)
+        tmpFile = "{}.{}.tmp".format(self.__filename, os.getpid())
+        with open(tmpFile, "w", encoding="utf-8") as fh:
+            json.dump({ 'format': PACKAGE_INDEX_FORMAT, 'suites': self.__suites }, fh)
+        os.replace(tmpFile, self.__filename)
+        self.__stat = self.__fileStat()
+
+    def isEmpty(self):
+        self.__reload()
+        return len(self.__suites) == 0
+
+    def update(self, repoSuites, bundles):
+        '''
+            Updates the index for the bundle suites `repoSuites` (a dict of bundle ID to
+            apt_repos.RepoSuite as returned by getBundleRepoSuites()) with the
+            ManagedBundles `bundles`. Other suites (e.g. bundle-base suites) could be
+            indexed with `bundles` set to None. Returns the number of scanned suites.
+        '''
+        self.__reload()
+        now = time.time()
+        toCheck = list()
+        for (bid, suite) in sorted(repoSuites.items()):
+            key = json.dumps(getSuiteKey(suite))
+            entry = self.__suites.get(key)
+            if entry and (entry['sealed'] or now - self.__checked.get(key, 0) < PACKAGE_INDEX_CHECK_INTERVAL_S):
+                continue
+            toCheck.append((bid, suite, key))
+        # the Release stamps are requested in parallel as they may need a HTTP request each.
+        # Each request runs in a copy of the current context, so that its log records
+        # reach the log collector of the calling operation (see common_logging).
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_CHECKS) as executor:
+            futures = [ executor.submit(contextvars.copy_context().run, getReleaseStamp, c[1].getDistsUrl()) for c in toCheck ]
+            stamps = [ f.result() for f in futures ]
+        scanned, changed = 0, False
+        for ((bid, suite, key), stamp) in zip(toCheck, stamps):
+            entry = self.__suites.get(key)
+            sealed = isSealed(bid, suite, bundles)
+            stamp = list(stamp) if stamp != None else None
+            self.__checked[key] = now
+            if entry and ((stamp != None and entry['stamp'] == stamp) or
+                          (stamp == None and now - entry.get('scanned', 0) < PACKAGE_INDEX_TTL_S)):
+                changed = changed or entry['sealed'] != sealed
+                entry['sealed'] = sealed
+                continue
+            logger.debug("Indexing packages of {}".format(bid))
+            self.__suites[key] = { 'bundle': bid, 'sealed': sealed, 'stamp': stamp, 'scanned': now, 'packages': scanBundlePackages(suite) }
+            scanned += 1
+        if scanned > 0:
+            self.__reverse = None
+        if scanned > 0 or changed:
+            self.__save()
+        if scanned > 0:
+            logger.debug("Indexed the packages of {} suites".format(scanned))
+        return scanned
+
+    def __getReverseIndex(self):
+        if self.__reverse == None:
+            reverse = dict()
+            for (key, entry) in self.__suites.items():
+                for package in entry['packages']:
+                    (name, unused_version, unused_arch, source) = package
+                    reverse.setdefault(name, list()).append((key, package))
+                    if source and source != name:
+                        reverse.setdefault(source, list()).append((key, package))
+            self.__reverse = reverse
+        return self.__reverse
+
+    def getPackages(self, suite):
+        '''
+            Returns the list of [name, version, architecture, source] of the indexed
+            suite `suite` or an empty list if the suite is not indexed.
+        '''
+        self.__reload()
+        entry = self.__suites.get(json.dumps(getSuiteKey(suite)))
+        return entry['packages'] if entry else []
+
+    def getProviders(self, packageName, repoSuites):
+        '''
+            Returns a sorted list of (bundleId, name, version, architecture, source) for
+            all packages of the bundle suites `repoSuites` (see update()) that have the
+            binary or source package name `packageName`.
+        '''
+        self.__reload()
+        keys = dict((json.dumps(getSuiteKey(suite)), bid) for (bid, suite) in repoSuites.items())
+        res = set()
+        for (key, package) in self.__getReverseIndex().get(packageName, []):
+            if key in keys:
+                res.add((keys[key], *package))
+        return sorted(res)
+
+
+def updateBundlePackageIndex(cwd=PROJECT_DIR, context=None, indexFile=PACKAGE_INDEX_FILE):
+    '''
+        Updates the package index for all bundles of the project `cwd` and for the
+        bundle-base suites of all target suites (as used by the conflict check).
+        Returns the number of scanned suites.
+    '''
+    context = context or AptReposContext.forProject(cwd)
+    repoSuites = getBundleRepoSuites(cwd=cwd, context=context)
+    bundles = parseBundles(cwd=cwd, includeArchived=True)
+    index = getBundlePackageIndex(indexFile)
+    scanned = index.update(repoSuites, bundles)
+    baseDists = set(getBaseDist(suite) for suite in getTargetRepoSuites(context=context).values())
+    for dist in sorted(d for d in baseDists if d):
+        baseSuites = dict((s.getSuiteName(), s) for s in context.getSuites(["bundle-base.{}:".format(dist)]))
+        scanned += index.update(baseSuites, None)
+    return scanned
+
+
+def whichBundles(packageName, cwd=PROJECT_DIR, context=None, update=True, indexFile=PACKAGE_INDEX_FILE):
+    '''
+        Returns a sorted list of (bundleId, name, version, architecture, source, status)
+        for all bundles of the project `cwd` providing the binary or source package
+        `packageName`. The status is None for bundles not contained in the bundles file.
+        If `update` is True, the package index is updated before.
+    '''
+    repoSuites = getBundleRepoSuites(cwd=cwd, context=context)
+    bundles = parseBundles(cwd=cwd, includeArchived=True)
+    index = getBundlePackageIndex(indexFile)
+    if update:
+        index.update(repoSuites, bundles)
+    res = list()
+    for (bid, name, version, architecture, source) in index.getProviders(packageName, repoSuites):
+        bundle = bundles.get(bid)
+        res.append((bid, name, version, architecture, source, bundle.getStatus() if bundle else None))
+    return res
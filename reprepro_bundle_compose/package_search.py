@@ -0,0 +1,193 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module keeps in-memory indexes of the packages contained in apt-repos
+   suites, so that package searches of the bundle-compose-app don't need to
+   scan the suites again for every request.
+'''
+
+import os
+import re
+import time
+import asyncio
+import logging
+import urllib.request
+from urllib.parse import urlparse
+from apt_repos import PackageField
+from reprepro_bundle_compose.apt_repos_context import AptReposContext
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_INDEX_TTL_S = 5*60
+PACKAGE_INDEX_IDLE_S = 30*60
+PACKAGE_FIELDS = "pvsaSC"
+
+
+def getSuiteKey(suite):
+    '''
+        Returns a tuple identifying the content of the apt-repos suite `suite`
+        independent from the apt-repos base directory it is configured in.
+    '''
+    return (suite.getSuiteName(), suite.getDistsUrl(), tuple(suite.getArchitectures()), tuple(suite.getComponents()))
+
+
+def getSuiteKeys(suiteSelectors, cwd):
+    '''
+        Returns the list of suite keys (see getSuiteKey()) of the suites matching
+        `suiteSelectors` in the project `cwd`.
+    '''
+    return [ getSuiteKey(suite) for suite in AptReposContext.forProject(cwd).getSuites(suiteSelectors) ]
+
+
+def scanSuitePackages(suiteName, cwd):
+    '''
+        Scans the suite `suiteName` and returns the sorted list of it's packages as
+        tuples (name, version, suite, architecture, section, source).
+        As apt-repos' scan() uses global state, this should be run in a separate process.
+    '''
+    requestFields = PackageField.getByFieldsString(PACKAGE_FIELDS)
+    res = list()
+    for suite in AptReposContext.forProject(cwd).getSuites([suiteName]):
+        suite.scan(True)
+        for package in suite.queryPackages(['.'], True, None, None, requestFields):
+            (packageName, version, packageSuite, architecture, section, source) = package.getData()
+            res.append((packageName, version, str(packageSuite), architecture, section, source))
+    logger.debug("Scanned {} packages of suite {}".format(len(res), suiteName))
+    return sorted(res)
+
+
+def getReleaseStamp(distsUrl):
+    '''
+        Returns a tuple describing the current state of the Release file in `distsUrl`
+        or None if it could not be determined.
+    '''
+    url = distsUrl.rstrip("/") + "/Release"
+    try:
+        if urlparse(url).scheme in ["", "file"]:
+            st = os.stat(urlparse(url).path)
+            return (st.st_mtime_ns, st.st_size)
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=10) as response:
+            return (response.headers.get("ETag"), response.headers.get("Last-Modified"), response.headers.get("Content-Length"))
+    except Exception as e:
+        logger.debug("Could not check {}: {}".format(url, e))
+        return None
+
+
+def searchPackages(indexes, searchStrings):
+    '''
+        Returns the sorted list of packages from `indexes` whose names match one of the
+        regular expressions `searchStrings` (like `apt-repos ls -r`).
+    '''
+    regexes = [ re.compile(s) for s in searchStrings ]
+    res = list()
+    for index in indexes:
+        res.extend(p for p in index.packages if any(r.search(p[0]) for r in regexes))
+    return sorted(res)
+
+
+class SuitePackageIndex:
+    '''
+        The packages of one suite (see scanSuitePackages()) at the time `loadedTime`.
+    '''
+
+    def __init__(self, key, packages, releaseStamp):
+        self.key = key
+        self.packages = packages
+        self.releaseStamp = releaseStamp
+        self.loadedTime = time.time()
+        self.usedTime = self.loadedTime
+
+    def isStale(self, ttl):
+        return time.time() - self.loadedTime > ttl
+
+    def isIdle(self, idle):
+        return time.time() - self.usedTime > idle
+
+
+class PackageIndexCache:
+    '''
+        Holds the SuitePackageIndexes in the main process. Missing indexes are loaded by
+        scanning the suite in the `scanExecutor`. Indexes older than `ttl` seconds are
+        still used, but refreshed in the background. The refresh only scans the suite
+        again if it's Release file changed (or couldn't be checked). Indexes that were
+        not used for `idle` seconds are dropped.
+    '''
+
+    def __init__(self, scanExecutor, ioExecutor, ttl=PACKAGE_INDEX_TTL_S, idle=PACKAGE_INDEX_IDLE_S):
+        self.__scanExecutor = scanExecutor
+        self.__ioExecutor = ioExecutor
+        self.__ttl = ttl
+        self.__idle = idle
+        self.__indexes = dict() # of suite key to SuitePackageIndex
+        self.__loading = dict() # of suite key to the future loading the index
+
+    async def getIndexes(self, suiteKeys, cwd):
+        self.__evictIdle()
+        missing = [ key for key in suiteKeys if not key in self.__indexes ]
+        # missing suites are scanned in parallel
+        loaded = dict(zip(missing, await asyncio.gather(*[ self.__load(key, cwd) for key in missing ])))
+        res = list()
+        for key in suiteKeys:
+            index = loaded.get(key) or self.__indexes.get(key)
+            if index.isStale(self.__ttl) and not key in self.__loading:
+                self.__loading[key] = asyncio.ensure_future(self.__refresh(index, cwd))
+            index.usedTime = time.time()
+            res.append(index)
+        return res
+
+    def __evictIdle(self):
+        for key in [ k for (k, index) in self.__indexes.items() if index.isIdle(self.__idle) ]:
+            if not key in self.__loading:
+                del self.__indexes[key]
+                logger.debug("Dropped idle package index of suite {}".format(key[0]))
+
+    async def __load(self, key, cwd):
+        future = self.__loading.get(key)
+        if not future:
+            future = asyncio.ensure_future(self.__scan(key, cwd))
+            self.__loading[key] = future
+        return await asyncio.shield(future)
+
+    async def __scan(self, key, cwd):
+        try:
+            (suiteName, distsUrl, unused_archs, unused_components) = key
+            stamp = await asyncio.wrap_future(self.__ioExecutor.submit(getReleaseStamp, distsUrl))
+            packages = await asyncio.wrap_future(self.__scanExecutor.submit(scanSuitePackages, suiteName, cwd))
+            index = SuitePackageIndex(key, packages, stamp)
+            self.__indexes[key] = index
+            logger.info("Indexed {} packages of suite {}".format(len(packages), suiteName))
+            return index
+        finally:
+            self.__loading.pop(key, None)
+
+    async def __refresh(self, index, cwd):
+        try:
+            (unused_suiteName, distsUrl, unused_archs, unused_components) = index.key
+            stamp = await asyncio.wrap_future(self.__ioExecutor.submit(getReleaseStamp, distsUrl))
+            if stamp != None and stamp == index.releaseStamp:
+                index.loadedTime = time.time()
+                self.__loading.pop(index.key, None)
+                return index
+            self.__loading.pop(index.key, None)
+            return await self.__load(index.key, cwd)
+        except Exception as e:
+            self.__loading.pop(index.key, None)
+            logger.warning("Refreshing the package index of {} failed: {}".format(index.key[0], e))
+            return index
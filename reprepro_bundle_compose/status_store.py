@@ -0,0 +1,239 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+import os
+import fcntl
+import shutil
+import logging
+import threading
+import collections
+import apt_pkg
+
+logger = logging.getLogger(__name__)
+
+MAX_STATUS_STORES = 100
+
+__stores = collections.OrderedDict() # of realpath to StatusStore (least recently used first)
+__storesLock = threading.Lock()
+
+
+def getStatusStore(filename):
+    '''
+        Returns the (shared) StatusStore for the file `filename`. At most
+        MAX_STATUS_STORES stores are kept, the least recently used store is dropped
+        first (e.g. stores of expired compose-app sessions).
+    '''
+    path = os.path.realpath(filename)
+    with __storesLock:
+        store = __stores.get(path)
+        if store:
+            __stores.move_to_end(path)
+        else:
+            store = StatusStore(path)
+            __stores[path] = store
+            while len(__stores) > MAX_STATUS_STORES:
+                __stores.popitem(last=False)
+        return store
+
+
+class StatusStore:
+    '''
+        This class keeps an index of the byte offsets of the sections in a
+        `bundle-compose.status` file. The index is built by a plain line scan (without
+        parsing the sections) and is rebuilt automatically if the file was changed
+        by someone else.
+
+        With this index it is possible to load only the sections of selected bundles
+        and to rewrite the sections of some bundles without serializing all other
+        bundles. Sections are kept in alphabetical order of their IDs, so the file
+        stays the same as if it was completely written by storeBundles().
+
+        Changes are written to a temporary file that replaces the original file, so
+        readers never see a partially written file. Concurrent writers (other threads
+        or processes) are serialized by an exclusive lock on the original file.
+    '''
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__stat = None
+        self.__index = dict() # of ID to (offset, length) of the section
+        self.__lock = threading.RLock()
+
+    def __open(self):
+        try:
+            return open(self.__filename, "rb")
+        except FileNotFoundError:
+            return None
+
+    def __getIndex(self, fh):
+        '''
+            Returns (a copy of) the index for the opened file `fh`. The index is rebuilt
+            if `fh` is not the file the index was built for or if it was changed since.
+        '''
+        with self.__lock:
+            st = os.fstat(fh.fileno())
+            stat = (st.st_size, st.st_mtime_ns, st.st_ino)
+            if stat != self.__stat:
+                self.__index = self.__buildIndex(fh)
+                self.__stat = stat
+            return dict(self.__index)
+
+    def __buildIndex(self, fh):
+        index = dict()
+        offset = 0
+        start, bid = None, None
+        fh.seek(0)
+        for line in fh:
+            if line.strip() == b"":
+                if start != None:
+                    self.__addToIndex(index, bid, start, offset - start)
+                start, bid = None, None
+            else:
+                if start == None:
+                    start = offset
+                if line.startswith(b"ID:"):
+                    bid = line[3:].strip().decode("utf-8")
+            offset += len(line)
+        if start != None:
+            self.__addToIndex(index, bid, start, offset - start)
+        logger.debug("Indexed {} sections in {}".format(len(index), self.__filename))
+        return index
+
+    def __addToIndex(self, index, bid, offset, length):
+        if not bid:
+            logger.warning("Skipping section without ID in bundles file at offset {}".format(offset))
+            return
+        index[bid] = (offset, length)
+
+    def getIds(self):
+        '''
+            Returns the set of bundle IDs contained in the file.
+        '''
+        fh = self.__open()
+        if not fh:
+            return set()
+        with fh:
+            return set(self.__getIndex(fh).keys())
+
+    def loadSections(self, selectIds=None):
+        '''
+            Returns a dict of ID to apt_pkg.TagSection for the bundles with an ID in
+            `selectIds` (or for all bundles if `selectIds` is None). Only the selected
+            sections are read from the file.
+        '''
+        res = dict()
+        fh = self.__open()
+        if not fh:
+            return res
+        with fh:
+            index = self.__getIndex(fh)
+            ids = sorted(index.keys()) if selectIds == None else sorted(set(selectIds).intersection(index.keys()))
+            for bid in ids:
+                (offset, length) = index[bid]
+                fh.seek(offset)
+                res[bid] = apt_pkg.TagSection(fh.read(length).decode("utf-8"))
+        return res
+
+    def rewriteSection(self, bid, sectionText):
+        '''
+            Replaces the section of the bundle `bid` by `sectionText` (as created by
+            ManagedBundle.serialize()), see rewriteSections().
+        '''
+        self.rewriteSections({ bid: sectionText })
+
+    def rewriteSections(self, sections):
+        '''
+            Expects a dict of ID to the section text (as created by ManagedBundle.serialize())
+            and replaces the sections of these bundles in one go. Sections that don't exist
+            yet are inserted at their alphabetical position. All other parts of the file are
+            copied unchanged.
+        '''
+        if len(sections) == 0:
+            return
+        data = dict()
+        for (bid, sectionText) in sections.items():
+            data[bid] = sectionText.encode("utf-8").rstrip(b"\n") + b"\n"
+        with self.__lock, self.__lockedFile() as fh:
+            content = self.__merge(fh.read(), self.__getIndex(fh), data)
+            tmpFile = "{}.{}.tmp".format(self.__filename, os.getpid())
+            try:
+                with open(tmpFile, "wb") as tmp:
+                    tmp.write(content)
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                shutil.copymode(self.__filename, tmpFile)
+                os.replace(tmpFile, self.__filename)
+            finally:
+                if os.path.exists(tmpFile):
+                    os.remove(tmpFile)
+        logger.debug("Rewrote {} sections in {}".format(len(sections), self.__filename))
+
+    def __lockedFile(self):
+        '''
+            Opens the file (it is created if it doesn't exist) and returns it after an
+            exclusive lock was acquired. The lock is released when the file is closed.
+            If the file was replaced while we were waiting for the lock, the new file
+            needs to be locked.
+        '''
+        while True:
+            fh = open(self.__filename, "a+b")
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fh.fileno()).st_ino == os.stat(self.__filename).st_ino:
+                    fh.seek(0)
+                    return fh
+            except FileNotFoundError:
+                pass
+            fh.close()
+
+    @staticmethod
+    def __merge(content, index, data):
+        '''
+            Returns `content` with the sections described by `index` replaced by (or
+            extended by) the sections from the dict of ID to section bytes `data`.
+        '''
+        inserts = sorted(bid for bid in data if not bid in index)
+        parts = list()
+        pos = 0
+        for (offset, length, bid) in sorted((o, l, bid) for (bid, (o, l)) in index.items()):
+            while len(inserts) > 0 and inserts[0] < bid:
+                parts.append(content[pos:offset])
+                parts.append(data[inserts.pop(0)] + b"\n")
+                pos = offset
+            if bid in data:
+                parts.append(content[pos:offset])
+                parts.append(data[bid])
+                pos = offset + length
+        parts.append(content[pos:])
+        res = b"".join(parts)
+        if len(inserts) > 0:
+            # append the remaining sections separated by exactly one blank line
+            if len(res) > 0 and not res.endswith(b"\n"):
+                res += b"\n"
+            if len(res) > 0 and not res.endswith(b"\n\n"):
+                res += b"\n"
+            res += b"\n".join(data[bid] for bid in inserts)
+        return res
+
+    def invalidate(self):
+        '''
+            Forces a rebuild of the index (e.g. after the file was completely rewritten).
+        '''
+        with self.__lock:
+            self.__stat = None
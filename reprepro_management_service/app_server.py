@@ -34,13 +34,15 @@ import asyncio
 import concurrent.futures
 import tempfile
 import shutil
-import subprocess
-import hashlib
 import traceback
 import re
+import signal
 from urllib.parse import urlparse
 import reprepro_management_service
-from reprepro_bundle_appserver import common_app_server
+from reprepro_bundle_appserver import common_app_server, common_interfaces
+from reprepro_management_service.command_scheduler import CommandScheduler, readExclusions
+from reprepro_management_service.execution_history import ExecutionHistory
+from reprepro_management_service.token_store import TokenStore
 
 
 progname = "reprepro-management-service"
@@ -49,36 +51,34 @@ logger = logging.getLogger("reprepro_bundle_appserver.reprepro_management_servic
 tpe = None # ThreadPoolExecutor set in main
 
 ALLOWED_TOKEN_HASHES = '.allowedTokenHashes'
+COMMAND_EXCLUSIONS = '.commandExclusions'
+EXECUTION_HISTORY = '.executionHistory'
 CMD_PATTERN = re.compile(r"^[a-zA-Z0-9_\-]{1,50}$")
+DEFAULT_COMMAND_TIMEOUT_S = 60*60
+DEFAULT_HISTORY_RETENTION_DAYS = 90
+MAX_EXECUTIONS_PER_PAGE = 200
 
-def getAllowedTokenHashes():
-    res = dict()
-    with open(ALLOWED_TOKEN_HASHES) as fh:
-        for line in fh:
-            line = line.rstrip()
-            parts = line.split("  - ", 1)
-            if len(parts) != 2:
-                logger.warning("Ignoring invalid line in {}: '{}'".format(ALLOWED_TOKEN_HASHES, line))
-                continue
-            res[parts[0]] = parts[1]
-    return res
-
+commandTimeout = DEFAULT_COMMAND_TIMEOUT_S # set from args in registerRoutes
+scheduler = None # CommandScheduler set in registerRoutes
+history = None # ExecutionHistory set in registerRoutes
+tokenStore = TokenStore(ALLOWED_TOKEN_HASHES)
 
 def validateToken(request):
     token = request.headers['X-Gitlab-Token']
     if len(token) != 100:
         raise Exception("Token is of wrong length (must be 100 chars)")
-    m = hashlib.md5()
-    m.update(token.encode("utf-8"))
-    md5sum = m.hexdigest()
-    allowed = getAllowedTokenHashes()
-    userinfo = allowed.get(md5sum)
+    userinfo = tokenStore.getUserinfo(token)
     if not userinfo:
         raise Exception("This Token is not allowed.")
     return userinfo
 
 
 async def handle_execute(request):
+    '''
+        Executes the command `cmd` and streams its log entries as ndjson. As the
+        response status is sent before the command is started, the last record is
+        a CommandResult containing the returncode of the command.
+    '''
     logger.debug("Handling 'execute'")
     userinfo = None
     try:
@@ -90,23 +90,153 @@ async def handle_execute(request):
     if not CMD_PATTERN.match(cmd):
         return web.Response(text="Illegal Arguments Provided: cmd", status=400)
     logger.info("Handling 'execute' with cmd='{}' for user {}".format(cmd, userinfo))
-    res = []
-    with common_app_server.logging_redirect_for_webapp() as logs:
-        logger.debug("Calling 'make {}' now".format(cmd))
-        try:
-            ret = subprocess.check_output(["make", cmd], stderr=subprocess.STDOUT)
-            logger.info(ret.decode('utf-8'))
-        except subprocess.CalledProcessError as e:
-            logger.error("Execute failed with returncode {}:\n{}".format(e.returncode, e.output.decode('utf-8')))
-        res = logs.toBackendLogEntryList()
-    response = web.json_response(res)
+    run = scheduler.submit(cmd, userinfo)
+    if request.rel_url.query.get('wait', 'true') == 'false':
+        return web.json_response(common_interfaces.CommandRunInfo(run), status=202)
+    response = web.StreamResponse(headers={ 'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache' })
+    await response.prepare(request)
+    if run.state == "queued":
+        await writeLogEntry(response, LogEntry(logging.INFO, "Waiting for run {} of '{}' to start".format(run.id, cmd)))
+    listener = run.subscribe()
+    try:
+        while True:
+            entry = await listener.get()
+            if entry == None:
+                break
+            await writeLogEntry(response, entry)
+    finally:
+        run.unsubscribe(listener)
+    await writeLogEntry(response, common_interfaces.CommandResult(run))
+    await response.write_eof()
     return response
 
 
+async def handle_queue(request):
+    try:
+        validateToken(request)
+    except Exception as e:
+        return web.Response(text="Invalid Access-Token: {}".format(e), status=401)
+    return web.json_response([ common_interfaces.CommandRunInfo(run) for run in scheduler.getRuns() ])
+
+
+async def handle_list_executions(request):
+    try:
+        validateToken(request)
+    except Exception as e:
+        return web.Response(text="Invalid Access-Token: {}".format(e), status=401)
+    try:
+        offset = int(request.rel_url.query.get('offset', 0))
+        limit = int(request.rel_url.query.get('limit', 50))
+        if offset < 0 or limit < 1:
+            raise ValueError("offset and limit must be positive")
+    except ValueError as e:
+        return web.Response(text="Illegal Arguments Provided: {}".format(e), status=400)
+    limit = min(limit, MAX_EXECUTIONS_PER_PAGE)
+    res = await asyncio.wrap_future(tpe.submit(history.getSummaries, offset, limit))
+    return web.json_response(res, headers={ 'X-Total-Count': str(history.count()) })
+
+
+async def handle_get_execution(request):
+    try:
+        validateToken(request)
+    except Exception as e:
+        return web.Response(text="Invalid Access-Token: {}".format(e), status=401)
+    executionId = request.match_info['executionId']
+    res = await asyncio.wrap_future(tpe.submit(history.getRecord, executionId))
+    if not res:
+        return web.Response(text="Unknown Execution: {}".format(executionId), status=404)
+    return web.json_response(res)
+
+
+def store_execution(run):
+    tpe.submit(history.append, common_interfaces.ExecutionRecord(run))
+
+
+async def run_command(run):
+    async def addLogEntry(entry):
+        run.addLogEntry(entry)
+    return await execute_command(["make", run.cmd], addLogEntry)
+
+
+async def writeLogEntry(response, entry):
+    try:
+        await response.write((json.dumps(entry) + "\n").encode("utf-8"))
+    except ConnectionResetError:
+        '''The client went away - the command should be completed anyway'''
+
+
+def LogEntry(level, message):
+    return common_interfaces.BackendLogEntry(logging.makeLogRecord({
+        'name': logger.name, 'levelname': logging.getLevelName(level), 'msg': message, 'message': message}))
+
+
+async def execute_command(args, onLogEntry):
+    '''
+        Runs the command `args` as a subprocess and calls the coroutine function
+        `onLogEntry` for each line of it's (combined) stdout and stderr, followed by an
+        entry describing the result. The command is killed if it doesn't finish within
+        `commandTimeout` seconds. Returns the returncode of the command (or None if
+        it timed out).
+    '''
+    logger.debug("Calling '{}' now".format(" ".join(args)))
+    await onLogEntry(LogEntry(logging.DEBUG, "Calling '{}' now".format(" ".join(args))))
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                start_new_session=True)
+    try:
+        await asyncio.wait_for(__streamOutput(proc, onLogEntry), timeout=commandTimeout)
+    except asyncio.TimeoutError:
+        os.killpg(proc.pid, signal.SIGKILL) # also kill the processes started by make
+        await proc.wait()
+        msg = "Execute timed out after {} seconds".format(commandTimeout)
+        logger.error(msg)
+        await onLogEntry(LogEntry(logging.ERROR, msg))
+        return None
+    if proc.returncode != 0:
+        msg = "Execute failed with returncode {}".format(proc.returncode)
+        logger.error(msg)
+        await onLogEntry(LogEntry(logging.ERROR, msg))
+    else:
+        await onLogEntry(LogEntry(logging.INFO, "Execute finished successfully"))
+    return proc.returncode
+
+
+async def __streamOutput(proc, onLogEntry):
+    while True:
+        line = await proc.stdout.readline()
+        if not line:
+            break
+        await onLogEntry(LogEntry(logging.INFO, line.decode('utf-8', errors='replace').rstrip("\n")))
+    await proc.wait()
+
+
+def addArguments(parser):
+    parser.add_argument("--command-timeout", type=int, default=DEFAULT_COMMAND_TIMEOUT_S, help="""
+            Kill commands that are running longer than the given number of seconds.
+            Default is '{}'.""".format(DEFAULT_COMMAND_TIMEOUT_S))
+    parser.add_argument("--exclusions-file", default=COMMAND_EXCLUSIONS, help="""
+            File describing groups of commands that must not run at the same time.
+            Default is '{}'. If this file doesn't exist, all commands are executed
+            one after the other.""".format(COMMAND_EXCLUSIONS))
+    parser.add_argument("--history-file", default=EXECUTION_HISTORY, help="""
+            File in which the finished executions are stored (see /api/executions).
+            Default is '{}'.""".format(EXECUTION_HISTORY))
+    parser.add_argument("--history-retention-days", type=int, default=DEFAULT_HISTORY_RETENTION_DAYS, help="""
+            Remove executions from the history that finished more than the given number
+            of days ago. Default is '{}'.""".format(DEFAULT_HISTORY_RETENTION_DAYS))
+
+
 def registerRoutes(args, app):
+    global commandTimeout, scheduler, history
+    commandTimeout = args.command_timeout
+    history = ExecutionHistory(args.history_file, args.history_retention_days)
+    scheduler = CommandScheduler(run_command, readExclusions(args.exclusions_file), onFinished=store_execution)
     app.router.add_routes([
         web.get('/api/execute', handle_execute),
         web.post('/api/execute', handle_execute),
+        web.get('/api/queue', handle_queue),
+        web.get('/api/executions', handle_list_executions),
+        web.get('/api/executions/{executionId}', handle_get_execution),
+        common_app_server.metrics_route(validateToken),
     ])
     #if not args.no_static_files:
     #    app.router.add_routes([])
@@ -120,7 +250,8 @@ if __name__ == "__main__":
                 progname = progname,
                 description =  __doc__,
                 registerRoutes = registerRoutes,
-                port = 8080
+                port = 8080,
+                addArguments = addArguments
             )
     except KeyboardInterrupt as e:
         logger.info("Stopping due to keyboard interrupt.")
@@ -0,0 +1,189 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2019 Landeshauptstadt München
+#           (c) 2019 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module contains the scheduler deciding when the commands requested
+   from the reprepro-management-service are executed.
+'''
+
+import asyncio
+import collections
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+ANY_COMMAND = "*"
+MAX_LOG_ENTRIES = 10000
+
+
+def readExclusions(filename):
+    '''
+        Reads the mutual exclusion matrix from the file `filename`. Each line of the file
+        contains a group of commands (separated by whitespace) that must not run at the
+        same time. The special command "*" stands for every command. Lines starting with
+        "#" are comments. Returns a list of sets of commands. If the file doesn't exist,
+        all commands are mutually exclusive.
+    '''
+    if not os.path.exists(filename):
+        return [ set([ANY_COMMAND]) ]
+    res = list()
+    with open(filename) as fh:
+        for line in fh:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            res.append(set(line.split()))
+    logger.debug("Read {} exclusion groups from {}".format(len(res), filename))
+    return res
+
+
+class CommandRun:
+    '''
+        This class describes one (queued, running or finished) execution of a command.
+        All requests that are coalesced into this run share it's log entries.
+    '''
+
+    def __init__(self, cmd, user):
+        self.id = str(uuid.uuid4())
+        self.cmd = cmd
+        self.users = [ user ]
+        self.state = "queued"
+        self.queuedTime = time.time()
+        self.startedTime = None
+        self.finishedTime = None
+        self.returncode = None
+        self.logs = collections.deque(maxlen=MAX_LOG_ENTRIES)
+        self.listeners = set()
+
+    def addLogEntry(self, entry):
+        self.logs.append(entry)
+        for listener in self.listeners:
+            listener.put_nowait(entry)
+
+    def subscribe(self):
+        '''
+            Returns an asyncio.Queue receiving all log entries of this run (starting
+            with the entries already collected) followed by None when the run finished.
+        '''
+        listener = asyncio.Queue()
+        for entry in list(self.logs):
+            listener.put_nowait(entry)
+        if self.isFinished():
+            listener.put_nowait(None)
+        else:
+            self.listeners.add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        self.listeners.discard(listener)
+
+    def finish(self, returncode):
+        self.state = "done"
+        self.returncode = returncode
+        self.finishedTime = time.time()
+        for listener in self.listeners:
+            listener.put_nowait(None)
+        self.listeners.clear()
+
+    def isFinished(self):
+        return self.finishedTime != None
+
+
+class CommandScheduler:
+    '''
+        Executes commands with coalescing semantics: A command is never executed
+        in parallel to itself. If a command is requested while it is already running,
+        it is executed exactly once more after the current run has finished, no matter
+        how many requests for this command arrive in the meantime. Different commands
+        run in parallel unless they are in the same group of the `exclusions` matrix
+        (see readExclusions()).
+
+        `runCommand` is a coroutine function that is called with the CommandRun to
+        execute and that returns the returncode of the command.
+    '''
+
+    def __init__(self, runCommand, exclusions, onFinished=None):
+        self.__runCommand = runCommand
+        self.__exclusions = exclusions
+        self.__onFinished = onFinished
+        self.__running = dict() # of cmd to the running CommandRun
+        self.__queued = collections.OrderedDict() # of cmd to the queued CommandRun
+
+    def submit(self, cmd, user):
+        '''
+            Requests the execution of the command `cmd` for the `user` and returns the
+            CommandRun that will execute it. This is an already queued run of `cmd` if
+            there is one.
+        '''
+        run = self.__queued.get(cmd)
+        if run:
+            run.users.append(user)
+            logger.info("Coalescing request of '{}' for user {} into the queued run {}".format(cmd, user, run.id))
+            return run
+        run = CommandRun(cmd, user)
+        self.__queued[cmd] = run
+        self.__schedule()
+        return run
+
+    def getRuns(self):
+        '''
+            Returns the list of running and queued CommandRuns (in this order).
+        '''
+        return list(self.__running.values()) + list(self.__queued.values())
+
+    def isExclusive(self, cmd, other):
+        for group in self.__exclusions:
+            if (cmd in group or ANY_COMMAND in group) and (other in group or ANY_COMMAND in group):
+                return True
+        return False
+
+    def __canStart(self, cmd):
+        if cmd in self.__running:
+            return False
+        return not any(self.isExclusive(cmd, other) for other in self.__running)
+
+    def __schedule(self):
+        for cmd, run in list(self.__queued.items()):
+            if not self.__canStart(cmd):
+                continue
+            del self.__queued[cmd]
+            self.__running[cmd] = run
+            run.state = "running"
+            run.startedTime = time.time()
+            asyncio.ensure_future(self.__execute(run))
+
+    async def __execute(self, run):
+        logger.info("Starting run {} of '{}' requested by {}".format(run.id, run.cmd, ", ".join(run.users)))
+        returncode = None
+        try:
+            returncode = await self.__runCommand(run)
+        except Exception as e:
+            logger.error("Run {} of '{}' failed: {}".format(run.id, run.cmd, e))
+        finally:
+            del self.__running[run.cmd]
+            run.finish(returncode)
+            if self.__onFinished:
+                try:
+                    self.__onFinished(run)
+                except Exception as e:
+                    logger.error("Finishing run {} of '{}' failed: {}".format(run.id, run.cmd, e))
+            self.__schedule()
@@ -0,0 +1,137 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2019 Landeshauptstadt München
+#           (c) 2019 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   This module stores the finished command runs of the reprepro-management-service
+   in an append-only file containing one JSON object per line.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRUNE_INTERVAL_S = 60*60
+
+
+class ExecutionHistory:
+    '''
+        This class appends records of finished executions to the file `filename` and
+        keeps an index of the byte offsets of these records, so that a single record
+        (including it's output) can be read without parsing the whole file. Records
+        older than `retentionDays` days are pruned (if `retentionDays` is not None).
+
+        All methods do file I/O and should not be called from the event loop directly.
+    '''
+
+    def __init__(self, filename, retentionDays=None):
+        self.__filename = filename
+        self.__retentionDays = retentionDays
+        self.__lock = threading.Lock()
+        self.__index = list() # of (summary, offset, length) in the order of the file
+        self.__byId = dict() # of execution id to the position in __index
+        self.__lastPruned = 0
+        with self.__lock:
+            self.__load()
+        self.prune()
+
+    def __load(self):
+        self.__index = list()
+        self.__byId = dict()
+        if not os.path.exists(self.__filename):
+            return
+        offset = 0
+        with open(self.__filename, "rb") as fh:
+            for line in fh:
+                try:
+                    self.__addToIndex(json.loads(line.decode("utf-8")), offset, len(line))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    logger.warning("Ignoring invalid record in {} at offset {}".format(self.__filename, offset))
+                offset += len(line)
+        logger.debug("Loaded {} executions from {}".format(len(self.__index), self.__filename))
+
+    def __addToIndex(self, record, offset, length):
+        summary = dict((k, v) for (k, v) in record.items() if k != 'output')
+        self.__byId[summary['id']] = len(self.__index)
+        self.__index.append((summary, offset, length))
+
+    def append(self, record):
+        '''
+            Appends the `record` (a dict as created by common_interfaces.ExecutionRecord())
+            to the history.
+        '''
+        data = (json.dumps(record) + "\n").encode("utf-8")
+        with self.__lock:
+            with open(self.__filename, "ab") as fh:
+                offset = fh.tell()
+                fh.write(data)
+            self.__addToIndex(record, offset, len(data))
+        if time.time() - self.__lastPruned > PRUNE_INTERVAL_S:
+            self.prune()
+
+    def count(self):
+        return len(self.__index)
+
+    def getSummaries(self, offset=0, limit=50):
+        '''
+            Returns up to `limit` summaries (records without output) of executions
+            starting at `offset`, newest first.
+        '''
+        with self.__lock:
+            newestFirst = list(reversed(self.__index))
+        return [ summary for (summary, unused_offset, unused_length) in newestFirst[offset:offset+limit] ]
+
+    def getRecord(self, executionId):
+        '''
+            Returns the complete record of the execution `executionId` or None if there
+            is no such execution.
+        '''
+        with self.__lock:
+            pos = self.__byId.get(executionId)
+            if pos == None:
+                return None
+            (unused_summary, offset, length) = self.__index[pos]
+            with open(self.__filename, "rb") as fh:
+                fh.seek(offset)
+                return json.loads(fh.read(length).decode("utf-8"))
+
+    def prune(self):
+        '''
+            Removes all records that finished more than `retentionDays` days ago by
+            rewriting the file.
+        '''
+        self.__lastPruned = time.time()
+        if self.__retentionDays == None:
+            return
+        limit = time.time() - self.__retentionDays * 24 * 60 * 60
+        with self.__lock:
+            keep = [ (offset, length) for (summary, offset, length) in self.__index if (summary.get('finishedTime') or 0) >= limit ]
+            if len(keep) == len(self.__index):
+                return
+            tmpFile = self.__filename + ".tmp"
+            with open(self.__filename, "rb") as src, open(tmpFile, "wb") as dest:
+                for (offset, length) in keep:
+                    src.seek(offset)
+                    dest.write(src.read(length))
+            os.replace(tmpFile, self.__filename)
+            logger.info("Pruned {} executions older than {} days from {}".format(len(self.__index) - len(keep), self.__retentionDays, self.__filename))
+            self.__load()
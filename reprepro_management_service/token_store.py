@@ -0,0 +1,91 @@
+#!/usr/bin/python3 -Es
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2019 Landeshauptstadt München
+#           (c) 2019 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+import os
+import hashlib
+import hmac
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ALGORITHM = "md5" # used for lines without an "<algorithm>:" prefix
+SUPPORTED_ALGORITHMS = [ "md5", "sha256" ]
+
+
+class TokenStore:
+    '''
+        This class holds the allowed token hashes read from a file like
+        `.allowedTokenHashes`. Each line of this file has the form
+
+            [<algorithm>:]<hexdigest>  - <userinfo>
+
+        as created by `bin/createSecretToken` (<algorithm> is "sha256" for new tokens,
+        lines without prefix contain md5 hashes). The file is parsed only once and
+        parsed again as soon as it was changed.
+    '''
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__stat = None
+        self.__entries = list() # of (algorithm, hexdigest, userinfo)
+        self.__lock = threading.Lock()
+
+    def __fileStat(self):
+        st = os.stat(self.__filename)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def __getEntries(self):
+        stat = self.__fileStat()
+        with self.__lock:
+            if stat != self.__stat:
+                self.__entries = self.__readEntries()
+                self.__stat = stat
+            return self.__entries
+
+    def __readEntries(self):
+        res = list()
+        with open(self.__filename) as fh:
+            for line in fh:
+                line = line.rstrip()
+                parts = line.split("  - ", 1)
+                if len(parts) != 2:
+                    logger.warning("Ignoring invalid line in {}: '{}'".format(self.__filename, line))
+                    continue
+                (algorithm, digest) = parts[0].split(":", 1) if ":" in parts[0] else (DEFAULT_ALGORITHM, parts[0])
+                if not algorithm in SUPPORTED_ALGORITHMS:
+                    logger.warning("Ignoring line with unsupported hash algorithm in {}: '{}'".format(self.__filename, line))
+                    continue
+                res.append((algorithm, digest.strip().lower(), parts[1]))
+        logger.debug("Read {} allowed token hashes from {}".format(len(res), self.__filename))
+        return res
+
+    def getUserinfo(self, token):
+        '''
+            Returns the userinfo for `token` or None if the token is not allowed. The
+            digests of all entries are compared in constant time.
+        '''
+        digests = dict()
+        res = None
+        for (algorithm, digest, userinfo) in self.__getEntries():
+            if not algorithm in digests:
+                digests[algorithm] = hashlib.new(algorithm, token.encode("utf-8")).hexdigest()
+            if hmac.compare_digest(digests[algorithm], digest) and not res:
+                res = userinfo
+        return res
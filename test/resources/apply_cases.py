@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   Reference test cases for the helpers of 'bundle-compose apply --incremental'
+   in reprepro_bundle_compose.BundleComposeCLI.
+
+   Usage: apply_cases.py <case>
+'''
+import os
+import sys
+import tempfile
+from reprepro_bundle_compose.BundleComposeCLI import writeIfChanged, getAffectedTargets
+
+
+class TargetSuite:
+    '''
+        Provides the parts of an apt_repos.RepoSuite used by getAffectedTargets.
+    '''
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def getSuiteName(self):
+        return self.name
+
+    def getTags(self):
+        return self.tags
+
+
+TARGETS = dict((t.getSuiteName(), t) for t in [
+    TargetSuite("target:mybionic/dev", ["bundle-dist.mybionic", "bundle-stage.dev", "bundle-stage.test", "bundle-target.plus"]),
+    TargetSuite("target:mybionic/test", ["bundle-dist.mybionic", "bundle-stage.test", "bundle-target.plus"]),
+    TargetSuite("target:mybionic", ["bundle-dist.mybionic", "bundle-stage.prod", "bundle-target.plus", "bundle-target.unattended"]),
+    TargetSuite("target:mybionic/unattended", ["bundle-dist.mybionic", "bundle-stage.prod", "bundle-target.unattended"]),
+])
+
+URL = "file:///repo/bundle/mybionic/{}/"
+BUNDLES = {
+    'bundle:mybionic/0001': [ "test", "mybionic", "plus", URL.format("0001"), ["main"], ["amd64"] ],
+    'bundle:mybionic/0002': [ "dev", "mybionic", "plus", URL.format("0002"), ["main"], ["amd64"] ],
+    'bundle:mybionic/0003': [ "prod", "mybionic", "unattended", URL.format("0003"), ["main"], ["amd64"] ],
+}
+
+
+def write_if_changed():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        filename = os.path.join(tmpDir, "bundle-compose_dynamic.conf")
+        for content in ["first\n", "first\n", "second\n"]:
+            written = writeIfChanged(filename, content)
+            with open(filename) as fh:
+                print("writeIfChanged({!r}) --> {}, file content: {!r}".format(content, written, fh.read()))
+
+
+def affected_targets():
+    changes = [
+        ("no change", BUNDLES),
+        ("new bundle for stage dev", dict(BUNDLES, **{ 'bundle:mybionic/0004': [ "dev", "mybionic", "plus", URL.format("0004"), ["main"], ["amd64"] ] })),
+        ("bundle moved from stage dev to test", dict(BUNDLES, **{ 'bundle:mybionic/0002': [ "test" ] + BUNDLES['bundle:mybionic/0002'][1:] })),
+        ("bundle dropped", dict(BUNDLES, **{ 'bundle:mybionic/0001': [ "drop" ] + BUNDLES['bundle:mybionic/0001'][1:] })),
+        ("bundle removed", dict((bid, s) for bid, s in BUNDLES.items() if bid != 'bundle:mybionic/0003')),
+        ("architectures changed", dict(BUNDLES, **{ 'bundle:mybionic/0003': BUNDLES['bundle:mybionic/0003'][:5] + [["amd64", "i386"]] })),
+    ]
+    for (title, newBundles) in changes:
+        affected = getAffectedTargets(TARGETS, BUNDLES, newBundles)
+        print("{}: {}".format(title, ", ".join(t.getSuiteName() for t in affected) or "-"))
+
+
+CASES = dict((f.__name__, f) for f in [write_if_changed, affected_targets])
+
+
+def main():
+    CASES[sys.argv[1]]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   Reference test cases for reprepro_bundle_appserver.common_logging. Each case
+   prints the messages collected by the LogCollectors involved.
+
+   Usage: common_logging_cases.py <case>
+'''
+import sys
+import logging
+import contextvars
+import concurrent.futures
+from reprepro_bundle_appserver import common_logging
+
+logger = logging.getLogger("reprepro_bundle_appserver.test")
+
+
+def nested_collectors():
+    forwarded = list()
+    with common_logging.collect_logs(forward=forwarded.append) as outer:
+        with common_logging.collect_logs() as inner:
+            logger.info("hello")
+        printMessages("inner", inner.toBackendLogEntryList())
+        logger.info("world")
+    printMessages("forwarded", forwarded)
+    printMessages("outer", outer.toBackendLogEntryList())
+
+
+def no_collector_after_block():
+    with common_logging.collect_logs():
+        print("collector in block: {}".format(common_logging.getCurrentCollector() != None))
+    print("collector after block: {}".format(common_logging.getCurrentCollector() != None))
+
+
+def executor_threads():
+    def work(i):
+        logger.info("thread {}".format(i))
+    with common_logging.collect_logs() as collector:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for f in [ executor.submit(work, i) for i in range(2) ]:
+                f.result()
+        printMessages("without context", sortedByMessage(collector.toBackendLogEntryList()))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for f in [ executor.submit(contextvars.copy_context().run, work, i) for i in range(2) ]:
+                f.result()
+        printMessages("with copied context", sortedByMessage(collector.toBackendLogEntryList()))
+
+
+def dropped_entries():
+    with common_logging.collect_logs(maxEntries=2) as collector:
+        for i in range(5):
+            logger.info("entry {}".format(i))
+    printMessages("collected", collector.toBackendLogEntryList())
+
+
+def sortedByMessage(entries):
+    # the threads may log in any order
+    return sorted(entries, key=lambda e: e['message'])
+
+
+def printMessages(title, entries):
+    print("{}: {}".format(title, ", ".join("{} {}".format(e['level'], e['message']) for e in entries) or "-"))
+
+
+CASES = dict((f.__name__, f) for f in [nested_collectors, no_collector_after_block, executor_threads, dropped_entries])
+
+
+def main():
+    logger.setLevel(logging.INFO)
+    CASES[sys.argv[1]]()
+
+
+if __name__ == "__main__":
+    main()
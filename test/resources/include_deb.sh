@@ -0,0 +1,24 @@
+#!/bin/bash
+#
+# Builds a (content-less) binary package and includes it into a reprepro repository,
+# e.g. to provide a package in another version than the other bundles.
+#
+# Usage: include_deb.sh <repo-basedir> <codename> <package> <version> <architecture> <section>
+#
+set -e
+repo="$1"; codename="$2"; package="$3"; version="$4"; arch="$5"; section="$6"
+tmp=$(mktemp -d)
+trap "rm -Rf $tmp" EXIT
+mkdir -p $tmp/pkg/DEBIAN
+cat >$tmp/pkg/DEBIAN/control <<EOC
+Package: $package
+Version: $version
+Architecture: $arch
+Section: $section
+Priority: optional
+Maintainer: Test Automation <test@localhost>
+Description: $package in version $version for the test automation
+EOC
+dpkg-deb --build $tmp/pkg $tmp/${package}_${version}_${arch}.deb >/dev/null
+reprepro -b "$repo" includedeb $codename $tmp/${package}_${version}_${arch}.deb >/dev/null
+echo "Included $package $version ($arch) into $repo"
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   Reference test cases for the dependencies computed by 'bundle-compose jsondeps'
+   (see computeBundleDependencies in reprepro_bundle_compose.BundleComposeCLI).
+   The cases print the json output with and without '--with-versions'.
+
+   Usage: jsondeps_cases.py <case>
+'''
+import sys
+import json
+import apt_pkg
+from reprepro_bundle_compose.BundleComposeCLI import computeBundleDependencies
+
+B1, B2, B3 = "bundle:mybionic/0001", "bundle:mybionic/0002", "bundle:mybionic/0003"
+
+PACKAGES = [
+    # Debian version ordering differs from string ordering
+    ("libfoo", "1.10-1", B1), ("libfoo", "1.9-1", B2),
+    ("libbar", "1:0.5-1", B2), ("libbar", "2.0-1", B3),
+    ("libbaz", "1.0~rc1-1", B3), ("libbaz", "1.0-1", B1),
+    # equal versions: the later bundle depends on the earlier one
+    ("libsame", "3.0-1", B3), ("libsame", "3.0-1", B2),
+    # each bundle depends on all bundles with lower versions
+    ("libtri", "1.0-1", B1), ("libtri", "2.0-1", B2), ("libtri", "3.0-1", B3),
+    # different versions within the same bundle don't cause a self-relation
+    ("libqux", "2.0-1", B1), ("libqux", "2.1-1", B1),
+]
+
+
+def without_versions():
+    printJson(computeBundleDependencies(PACKAGES))
+
+
+def with_versions():
+    printJson(computeBundleDependencies(PACKAGES, withVersions=True))
+
+
+def printJson(bundleDeps):
+    # same format as written by cmd_jsondeps
+    print(json.dumps(bundleDeps, sort_keys=True, indent=4))
+
+
+CASES = dict((f.__name__, f) for f in [without_versions, with_versions])
+
+
+def main():
+    # version_compare needs an initialized apt_pkg (done by scanning suites in cmd_jsondeps)
+    apt_pkg.init()
+    CASES[sys.argv[1]]()
+
+
+if __name__ == "__main__":
+    main()
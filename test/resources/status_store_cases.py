@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+##########################################################################
+# Copyright (c) 2018 Landeshauptstadt München
+#           (c) 2018 Christoph Lutz (InterFace AG)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the European Union Public Licence (EUPL),
+# version 1.1 (or any later version).
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# European Union Public Licence for more details.
+#
+# You should have received a copy of the European Union Public Licence
+# along with this program. If not, see
+# https://joinup.ec.europa.eu/collection/eupl/eupl-text-11-12
+##########################################################################
+'''
+   Reference test cases for reprepro_bundle_compose.status_store. Each case writes
+   a status file to a temporary folder, rewrites some sections and prints the
+   resulting file and the sections read back by a fresh StatusStore.
+
+   Usage: status_store_cases.py <case>
+'''
+import os
+import sys
+import tempfile
+from reprepro_bundle_compose.status_store import StatusStore
+
+A = "ID: bundle:mybionic/0001\nStatus: production\nTarget: plus\n"
+B = "ID: bundle:mybionic/0002\nStatus: staging\nTarget: plus\n"
+C = "ID: bundle:mybionic/0003\nStatus: new\nTarget: plus\n"
+D = "ID: bundle:mybionic/0004\nStatus: new\nTarget: plus\n"
+
+
+def insert(store, filename):
+    write(store, filename, "\n".join([A, C]))
+    store.rewriteSections({ 'bundle:mybionic/0002': B, 'bundle:mybionic/0004': D })
+
+
+def same_length(store, filename):
+    write(store, filename, "\n".join([A, B, C]))
+    store.rewriteSection('bundle:mybionic/0002', B.replace("staging", "testing"))
+
+
+def grow_shrink(store, filename):
+    write(store, filename, "\n".join([A, B, C]))
+    store.rewriteSections({
+        'bundle:mybionic/0001': A.replace("production", "dropped"),
+        'bundle:mybionic/0002': B + "Trac: 4711\n",
+        'bundle:mybionic/0003': C.replace("new", "dropped"),
+    })
+
+
+def trailing_blank_line(store, filename):
+    write(store, filename, "\n".join([A, B]) + "\n")
+    store.rewriteSections({ 'bundle:mybionic/0002': B.replace("staging", "dropped"), 'bundle:mybionic/0003': C })
+
+
+def write(store, filename, content):
+    with open(filename, "w") as fh:
+        fh.write(content)
+    # make sure the index is built for the original file
+    store.getIds()
+
+
+CASES = dict((f.__name__, f) for f in [insert, same_length, grow_shrink, trailing_blank_line])
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpDir:
+        filename = os.path.join(tmpDir, "bundle-compose.status")
+        store = StatusStore(filename)
+        CASES[sys.argv[1]](store, filename)
+        with open(filename) as fh:
+            print("----- file content -----")
+            print(fh.read().replace("\n", "$\n"), end="")
+            print("------------------------")
+        for (title, s) in [("rewritten", store), ("reloaded", StatusStore(filename))]:
+            sections = s.loadSections()
+            print("{} sections: {}".format(title, ", ".join("{} ({})".format(bid, sections[bid]['Status']) for bid in sorted(sections))))
+        print("remaining files: {}".format(", ".join(sorted(os.listdir(tmpDir)))))
+
+
+if __name__ == "__main__":
+    main()